@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+import re
+import sys
+import struct
+from itertools import chain
+from collections import OrderedDict
+from tempfile import TemporaryFile
+from string import maketrans
+from zopen import zopen, BgzfReader
+from instrument import date
+
+"""
+to convert primary alignments of paired-end reads in a BAM file (or SAM from stdin) into a pair of fastq files:
+prefix_1.fq.gz and prefix_2.fq.gz, which replaces util/bam2fq.sh without samtools or sqlite3.
+
+    primary alignment of read1: flag & 0x940 == 0x40
+    primary alignment of read2: flag & 0x980 == 0x80
+
+BAM files are read with zopen.BgzfReader, and records are parsed with struct, only sequences and qualities of primary
+alignments are decoded. Reads are paired with a dict of reads whose mates haven't been read, and a pair is written as soon
+as both reads are read, so the data is read only once.
+
+By default, reads aligned to the reverse strand (flag & 0x10) are reverse-complemented back to the original reads, as
+`samtools fastq` does. With --orient mate, read1 is written as it is in the BAM file, and read2 is always
+reverse-complemented, which is what util/bam2fq.sh did (but qualities of read2 are reversed as well here).
+
+If alignments are sorted by read names (with "SO:queryname" in the header, or --name_sorted), both reads of a pair are next
+to each other, and they are paired without the dict, in constant memory. Reads without adjacent mates are kept in a
+window, and reads pushed out of it are spilled to a temporary file, which is paired by the dict at the end, so pairs
+are not lost if the file is not really sorted by name (e.g. with a different collation of names).
+
+usage: bam2fq.py [-h] [-t N] [--orient {original,mate}] [-n] input [prefix]
+
+created: 2026.10.18
+"""
+
+#-----------------------------------------------------------------------------
+stderr_write = sys.stderr.write
+
+READ1, READ2 = 0x40, 0x80
+
+def is_primary_read1(flag):
+    return flag & 0x940 == READ1
+
+def is_primary_read2(flag):
+    return flag & 0x980 == READ2
+
+COMPLEMENT = maketrans("ACGTNacgtnRYKMBVDHrykmbvdh", "TGCANtgcanYRMKVBHDyrmkvbhd")
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+# BAM: 4-bit encoded bases, two bases in a byte; qualities are phred scores without +33, 0xff if not available
+BAM_BASES = "=ACMGRSVTWYHKDBN"
+BYTE2BASES = [BAM_BASES[i >> 4] + BAM_BASES[i & 0xf] for i in range(256)]
+PHRED33 = "".join(chr(min(i, 93) + 33) for i in range(256))
+BAM_CORE = struct.Struct("<iiiBBHHHiiii")     # block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+
+def read_exactly(fobj, n):
+    data = fobj.read(n)
+    if len(data) != n:
+        raise Exception("BAM file is truncated")
+    return data
+
+def read_bam_header(fobj):
+    """ To read the header of a BAM file from fobj (decompressed), return the header text """
+
+    if fobj.read(4) != "BAM\1":
+        raise Exception("Not a BAM file")
+    l_text = struct.unpack("<i", read_exactly(fobj, 4))[0]
+    text = read_exactly(fobj, l_text).rstrip("\0")
+    n_ref = struct.unpack("<i", read_exactly(fobj, 4))[0]
+    for i in range(n_ref):
+        l_name = struct.unpack("<i", read_exactly(fobj, 4))[0]
+        read_exactly(fobj, l_name + 4)
+    return text
+
+def bam_records(fobj, keep=None, chunk_size=2 ** 20):
+    """ To read alignments of a BAM file from fobj (decompressed, after the header), yield (qname, flag, seq, qual)
+
+    keep: function of flag to select records, sequences and qualities of other records are not decoded
+    """
+
+    data, pos = "", 0
+    while True:
+        if len(data) - pos < 4 or len(data) - pos < 4 + struct.unpack_from("<i", data, pos)[0]:
+            more = fobj.read(chunk_size)
+            if not more:
+                if pos < len(data):
+                    raise Exception("BAM file is truncated")
+                return
+            data, pos = data[pos:] + more, 0
+            continue
+
+        block_size, refID, p, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen = BAM_CORE.unpack_from(data, pos)
+        if keep is None or keep(flag):
+            o = pos + BAM_CORE.size
+            qname = data[o:o + l_read_name - 1]
+            o += l_read_name + 4 * n_cigar_op
+            n = (l_seq + 1) // 2
+            seq = "".join(map(BYTE2BASES.__getitem__, bytearray(data[o:o + n])))[:l_seq]
+            qual = data[o + n:o + n + l_seq]
+            qual = qual.translate(PHRED33) if qual[:1] != "\xff" else '"' * l_seq     # the same as `samtools fastq -v 1`
+            yield qname, flag, seq, qual
+        pos += 4 + block_size
+
+def sam_records(lines, keep=None):
+    """ To read alignments from lines of a SAM file (without header lines), yield (qname, flag, seq, qual)
+
+    keep: function of flag to select records
+
+    QUAL "*" (qualities not available) is replaced by '"' (phred score 1) for every base, as in bam_records().
+    """
+
+    for line in lines:
+        qname, flag, rest = line.split("\t", 2)
+        flag = int(flag)
+        if keep is None or keep(flag):
+            items = rest.split("\t", 9)
+            seq, qual = items[7], items[8].rstrip("\n")
+            if qual == "*":     # qualities not available, the same as in bam_records()
+                qual = '"' * len(seq)
+            yield qname, flag, seq, qual
+
+def open_alignments(f, threads=1, keep=None):
+    """ To open a BAM or SAM file ('-' for SAM from stdin), return (header text, iterator of (qname, flag, seq, qual))
+
+    threads: number of threads to decompress BAM files
+    keep:    function of flag to select records
+    """
+
+    if f == '-':
+        fobj = sys.stdin
+    else:
+        with open(f, 'rb') as fin:
+            magic = fin.read(4)
+        if magic.startswith("\x1f\x8b"):
+            fobj = BgzfReader(f, threads=threads)
+            return read_bam_header(fobj), bam_records(fobj, keep)
+        fobj = zopen(f, 'r')
+
+    # SAM: header lines start with "@"
+    header = []
+    for line in fobj:
+        if not line.startswith("@"):
+            return "".join(header), sam_records(chain([line], fobj), keep)
+        header.append(line)
+    return "".join(header), iter([])
+
+#-----------------------------------------------------------------------------
+def orient_reads(orient):
+    """ To get a function (flag, seq, qual) --> (seq, qual) to orient reads
+
+    orient: 'original' to reverse-complement reads aligned to the reverse strand,
+            'mate' to always reverse-complement read2, as util/bam2fq.sh did
+    """
+
+    if orient == "original":
+        def orient_read(flag, seq, qual):
+            return (reverse_complement(seq), qual[::-1]) if flag & 0x10 else (seq, qual)
+    elif orient == "mate":
+        def orient_read(flag, seq, qual):
+            return (reverse_complement(seq), qual[::-1]) if flag & READ2 else (seq, qual)
+    else:
+        raise Exception("orient %s is not valid, should be 'original' or 'mate'" % orient)
+    return orient_read
+
+def unpaired(qname, read):
+    """ (qname, read1, None) or (qname, None, read2) for a read without mate """
+
+    return (qname, read, None) if read[0] & READ1 else (qname, None, read)
+
+def pair_hash(records, pending=None):
+    """ To pair primary alignments of read1 and read2 with a dict of reads whose mates haven't been read
+
+    records: iterator of (qname, flag, seq, qual) of primary alignments of read1/read2
+    pending: dict of qname --> (flag, seq, qual) to start with
+
+    yield (qname, (flag1, seq1, qual1), (flag2, seq2, qual2)) for every pair, and (qname, read1, None) or
+    (qname, None, read2) for reads without mates at the end
+    """
+
+    pending = {} if pending is None else pending
+    for qname, flag, seq, qual in records:
+        mate = pending.pop(qname, None)
+        if mate is None or mate[0] & READ1 == flag & READ1:     # the latter if a read is duplicated
+            pending[qname] = (flag, seq, qual)
+        elif flag & READ1:
+            yield qname, (flag, seq, qual), mate
+        else:
+            yield qname, mate, (flag, seq, qual)
+    for qname, read in pending.iteritems():
+        yield unpaired(qname, read)
+
+def spilled_records(fobj):
+    """ To read (qname, flag, seq, qual) written by pair_adjacent() to a spill file, from the start of fobj """
+
+    fobj.seek(0)
+    for line in fobj:
+        qname, flag, seq, qual = line.rstrip("\n").split("\t")
+        yield qname, int(flag), seq, qual
+
+def pair_adjacent(records, window=100000, tmp_dir=None):
+    """ To pair primary alignments of read1 and read2 sorted by read names, so both reads of a pair are next to each other
+
+    records: iterator of (qname, flag, seq, qual) of primary alignments of read1/read2
+    window:  number of the last reads without adjacent mates to keep
+    tmp_dir: directory of the temporary file of reads pushed out of the window
+
+    yield the same as pair_hash(). Only the read waiting for the next read, and the last `window` reads whose mates are
+    not next to them are kept in memory. If the mate of a read turns out to be one of those reads (records are not sorted
+    by name), will fall back to pair_hash() for the rest. Reads pushed out of the window are written to a temporary
+    file, and paired again by pair_hash() at the end, so their mates arriving later are not lost.
+    """
+
+    records = iter(records)
+    last = None             # (qname, read) of the read waiting for the next read
+    dropped = OrderedDict() # qname --> read, the last `window` reads without adjacent mates
+    spill = None            # temporary file of reads pushed out of the window
+    for qname, flag, seq, qual in records:
+        read = (flag, seq, qual)
+        if last is not None and qname == last[0] and last[1][0] & READ1 != flag & READ1:
+            yield (qname, last[1], read) if last[1][0] & READ1 else (qname, read, last[1])
+            last = None
+            continue
+
+        mate = dropped.get(qname)
+        if mate is not None and mate[0] & READ1 != flag & READ1:
+            stderr_write("[%s] reads are not sorted by name, will fall back to pairing by hash.\n" % date())
+            del dropped[qname]
+            yield (qname, mate, read) if mate[0] & READ1 else (qname, read, mate)
+            if last is not None:
+                dropped[last[0]] = last[1]
+            if spill is not None:
+                records = chain(spilled_records(spill), records)
+            for item in pair_hash(records, dropped):
+                yield item
+            return
+
+        if last is not None:
+            dropped[last[0]] = last[1]
+            while len(dropped) > window:
+                if spill is None:
+                    spill = TemporaryFile(dir=tmp_dir)
+                qname_, (flag_, seq_, qual_) = dropped.popitem(last=False)
+                spill.write("%s\t%d\t%s\t%s\n" % (qname_, flag_, seq_, qual_))
+        last = (qname, read)
+
+    if last is not None:
+        dropped[last[0]] = last[1]
+    if spill is None:
+        for qname, read in dropped.iteritems():
+            yield unpaired(qname, read)
+        return
+
+    stderr_write("[%s] reads pushed out of the window of unpaired reads will be paired by hash.\n" % date())
+    for item in pair_hash(spilled_records(spill), dropped):
+        yield item
+    spill.close()
+
+def is_name_sorted(header):
+    """ To check if alignments are sorted by read names, by "SO:queryname" in @HD line of the header """
+
+    return re.search(r"^@HD\t.*\bSO:queryname\b", header, re.M) is not None
+
+def bam2fq(f, prefix, threads=1, orient="original", name_sorted=None, N_size=10000):
+    """ To convert primary alignments of paired reads in f (BAM or SAM, '-' for SAM from stdin) into prefix_1.fq.gz and prefix_2.fq.gz
+
+    threads:     number of threads to decompress the BAM file and to compress each output file
+    orient:      see orient_reads()
+    name_sorted: if alignments are sorted by read names, pair adjacent reads by pair_adjacent() in constant memory,
+                 default is to check "SO:queryname" in the header
+
+    return number of pairs, and number of reads without mates
+    """
+
+    keep = lambda flag: is_primary_read1(flag) or is_primary_read2(flag)
+    header, records = open_alignments(f, threads=threads, keep=keep)
+    orient_read = orient_reads(orient)
+    if name_sorted is None:
+        name_sorted = is_name_sorted(header)
+    stderr_write("[%s] Will pair reads %s.\n" % (date(), "next to each other (sorted by name)" if name_sorted else "by hash"))
+
+    fq1, fq2 = prefix + "_1.fq.gz", prefix + "_2.fq.gz"
+    stderr_write("[%s] Will output to %s and %s.\n" % (date(), fq1, fq2))
+    fout1, fout2 = zopen(fq1, 'w', threads=threads), zopen(fq2, 'w', threads=threads)
+
+    n = n_unpaired = 0
+    out1, out2 = [], []
+    for qname, read1, read2 in (pair_adjacent if name_sorted else pair_hash)(records):
+        if read1 is None or read2 is None:
+            n_unpaired += 1
+            continue
+        seq1, qual1 = orient_read(*read1)
+        seq2, qual2 = orient_read(*read2)
+        out1.append("@%s/1\n%s\n+\n%s\n" % (qname, seq1, qual1))
+        out2.append("@%s/2\n%s\n+\n%s\n" % (qname, seq2, qual2))
+        if len(out1) >= N_size:
+            fout1.write("".join(out1))
+            fout2.write("".join(out2))
+            n += len(out1)
+            out1, out2 = [], []
+    fout1.write("".join(out1))
+    fout2.write("".join(out2))
+    n += len(out1)
+    fout1.close()
+    fout2.close()
+
+    stderr_write("[%s] %d pairs, %d reads without mates.\n" % (date(), n, n_unpaired))
+    return n, n_unpaired
+
+#-----------------------------------------------------------------------------
+def test_sam_records():
+
+    lines = ["r1\t77\t*\t0\t0\t*\t*\t0\t0\tACGTA\t*\n",
+             "r1\t141\t*\t0\t0\t*\t*\t0\t0\tGGCC\tIIII\tNM:i:0\n",
+             "r2\t329\t*\t0\t0\t*\t*\t0\t0\tGGCC\tIIII\n"]
+    assert list(sam_records(lines)) == [("r1", 77, "ACGTA", '"""""'), ("r1", 141, "GGCC", "IIII"), ("r2", 329, "GGCC", "IIII")]
+    keep = lambda flag: is_primary_read1(flag) or is_primary_read2(flag)
+    assert [r[:2] for r in sam_records(lines, keep)] == [("r1", 77), ("r1", 141)]
+
+def test_pair_adjacent():
+
+    def read(i, mate):
+        return ("r%d" % i, READ1 | 1 if mate == 1 else READ2 | 1, "ACGT"[i % 4], "I")
+
+    def pairs_and_unpaired(items):
+        pairs, single = set(), set()
+        for qname, read1, read2 in items:
+            if read1 is None or read2 is None:
+                single.add((qname, 1 if read1 else 2))
+            else:
+                assert read1[0] & READ1 and read2[0] & READ2
+                pairs.add(qname)
+        return pairs, single
+
+    # sorted by name, r3 and r6 without mates
+    records = [read(i, m) for i in range(10) for m in (1, 2) if (i, m) not in ((3, 2), (6, 1))]
+    pairs, single = pairs_and_unpaired(pair_adjacent(records, window=3))
+    assert pairs == set("r%d" % i for i in range(10) if i not in (3, 6))
+    assert single == set([("r3", 1), ("r6", 2)])
+
+    # not sorted by name: all read1 and then all read2, mates arrive beyond the window
+    for n in (4, 10, 100):
+        records = [read(i, 1) for i in range(n)] + [read(i, 2) for i in range(n)]
+        for window in (0, 3, 2 * n):
+            items = list(pair_adjacent(records, window=window))
+            pairs, single = pairs_and_unpaired(items)
+            assert pairs == set("r%d" % i for i in range(n)) and not single
+            assert len(items) == n
+            assert pairs_and_unpaired(pair_hash(records)) == (pairs, single)
+
+    # out of order, with reads without mates on both sides
+    records = [read(i, 1) for i in range(0, 20, 2)] + [read(i, 2) for i in range(19, -1, -1) if i != 4] + [read(99, 1)]
+    pairs, single = pairs_and_unpaired(pair_adjacent(records, window=2))
+    assert pairs == set("r%d" % i for i in range(0, 20, 2) if i != 4)
+    assert single == set([("r4", 1), ("r99", 1)] + [("r%d" % i, 2) for i in range(1, 20, 2)])
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='To convert primary alignments of paired-end reads in a BAM/SAM file into a pair of fastq files.')
+    parser.add_argument('-t', '--threads', default=1, type=int, metavar="N", help="number of threads to decompress the BAM file and to compress each output file. Default is 1.")
+    parser.add_argument('--orient', default="original", choices=["original", "mate"], help="'original' to reverse-complement reads aligned to the reverse strand, as `samtools fastq` does; 'mate' to always reverse-complement read2, as util/bam2fq.sh did. Default is 'original'.")
+    parser.add_argument('-n', '--name_sorted', default=None, action="store_true", help="alignments are sorted by read names (e.g. by `samtools sort -n`), so adjacent reads are paired in constant memory. Default is to check 'SO:queryname' in the header.")
+    parser.add_argument('input', help="BAM or SAM file, '-' for SAM from stdin")
+    parser.add_argument('prefix', nargs='?', default=None, help="prefix of output files: prefix_1.fq.gz and prefix_2.fq.gz. Default is input without .bam/.sam")
+
+    args = parser.parse_args()
+    prefix = args.prefix
+    if prefix is None:
+        if args.input == '-':
+            parser.error("prefix is required when input is stdin")
+        prefix = args.input[:-4] if args.input.endswith((".bam", ".sam")) else args.input
+    bam2fq(args.input, prefix, threads=args.threads, orient=args.orient, name_sorted=args.name_sorted)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import gzip
+import random
+import platform
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from subprocess import Popen
+from multiprocessing import Process, Pipe
+
+import fastx
+import intersect_fastq
+from instrument import date, peak_rss
+
+"""
+benchmarks of fastx iterators, intersect_fastq engines and the util tools on reproducible synthetic data, with
+throughput and peak memory of every benchmark reported as JSON, so a regression could be found by comparing the
+results with those of an earlier version (--compare).
+
+synthetic data (the same seed always gives the same files):
+    pairs of fastq files for every header format, with read length, filter rate (fraction of reads removed from
+    each file independently) and shuffle degree (fraction of reads moved to random positions) set by options,
+    a fasta file and a tab-delimited table.
+
+every benchmark runs in a new process, so peak RSS of one benchmark is not affected by the others.
+
+usage: benchmark.py [-h] [-n N] [-l L] [-r RATE] [-s DEGREE] [--seed SEED] [-f FORMAT [FORMAT ...]]
+                    [-e ENGINE [ENGINE ...]] [-b BENCHMARK [BENCHMARK ...]] [-d work_dir] [-o OUTPUT]
+                    [-c baseline] [--tolerance T]
+
+created: 2026.10.18
+"""
+
+#-----------------------------------------------------------------------------
+# header lines of read r (1 or 2) of the i-th pair, for every header format
+HEADER_FORMATS = {
+    'illumina_old': lambda i, r: "@FCD0R5AACXX:6:%d:%d:%d#0/%d\n" % (1101 + i // 1000000, 1000 + i // 1000 % 1000, 1000 + i % 1000, r),
+    'illumina':     lambda i, r: "@FCD0R5AACXX:6:%d:%d:%d#CGATGT/%d\n" % (1101 + i // 1000000, 1000 + i // 1000 % 1000, 1000 + i % 1000, r),
+    'illumina_new': lambda i, r: "@HISEQ02:4:C4LU6ACXX:8:%d:%d:%d %d:N:0:ATCACG\n" % (1101 + i // 1000000, 1000 + i // 1000 % 1000, 1000 + i % 1000, r),
+    'AROS':         lambda i, r: "@HWI-ST301L:301:C1BRBACXX:3:%d:%d:%d %d:N:0:CGATGT\n" % (1101 + i // 1000000, 1000 + i // 1000 % 1000, 1000 + i % 1000, r),
+    'infer':        lambda i, r: "@SRR001666.%d %d length=100\n" % (i, r),    # no header2ID_* matches, the format will be inferred
+}
+
+def random_pool(rng, alphabet, size=2 ** 20):
+    """ To get a random string of size letters from alphabet, sequences and qualities are sliced from it """
+
+    return "".join(rng.choice(alphabet) for i in xrange(size))
+
+def positions(rng, n, shuffle):
+    """ To get the order of n records, with a fraction `shuffle` of them moved to random positions """
+
+    order = range(n)
+    moved = sorted(rng.sample(order, int(n * shuffle)))
+    targets = moved[:]
+    rng.shuffle(targets)
+    for i, j in zip(moved, targets):
+        order[i] = j
+    return order
+
+def make_fastq_pair(prefix, n=100000, read_length=100, filter_rate=0.1, shuffle=0.0, header_format="illumina_new", seed=0, gz=False):
+    """ To write a pair of synthetic fastq files: prefix_1.fq and prefix_2.fq (.gz if gz), and return their names
+
+    n:             number of pairs before filtering
+    read_length:   length of reads
+    filter_rate:   fraction of reads removed from each file independently
+    shuffle:       fraction of reads moved to random positions in each file, 0 to keep reads of both files in the same order
+    header_format: one of HEADER_FORMATS
+    """
+
+    rng = random.Random(seed)
+    bases, quals = random_pool(rng, "ACGT"), random_pool(rng, "#+5?@ABCDEFGHIJ")
+    header = HEADER_FORMATS[header_format]
+    fnames = []
+    for r in (1, 2):
+        kept = [i for i in xrange(n) if rng.random() >= filter_rate]
+        order = positions(rng, len(kept), shuffle)
+        fname = "%s_%d.fq%s" % (prefix, r, ".gz" if gz else "")
+        with (gzip.open(fname, 'wb', 1) if gz else open(fname, 'w')) as fout:
+            for k in xrange(0, len(order), 10000):
+                records = []
+                for j in order[k:k + 10000]:
+                    i = kept[j]
+                    o = (i * 7919 + r * 104729) % (len(bases) - read_length)
+                    records.append("%s%s\n+\n%s\n" % (header(i, r), bases[o:o + read_length], quals[o:o + read_length]))
+                fout.write("".join(records))
+        fnames.append(fname)
+    return fnames
+
+def make_fasta(fname, n=1000, length=100000, line_width=60, seed=0):
+    """ To write a synthetic fasta file with n sequences of `length` bases """
+
+    rng = random.Random(seed)
+    bases = random_pool(rng, "ACGTN")
+    with open(fname, 'w') as fout:
+        for i in xrange(n):
+            o = rng.randrange(len(bases) - length) if length < len(bases) else 0
+            seq = (bases * (length // len(bases) + 1))[o:o + length]
+            fout.write(">seq%d\n" % i)
+            fout.write("".join(seq[j:j + line_width] + "\n" for j in xrange(0, len(seq), line_width)))
+    return fname
+
+def make_table(fname, n=100000, columns=8, seed=0):
+    """ To write a synthetic tab-delimited table with n rows, the first column is the ID """
+
+    rng = random.Random(seed)
+    with open(fname, 'w') as fout:
+        for i in xrange(n):
+            fout.write("ID%d\t%s\n" % (i, "\t".join(str(rng.randrange(100000)) for c in range(columns - 1))))
+    return fname
+
+#-----------------------------------------------------------------------------
+# every benchmark is a function returning (number of records, number of bytes) processed
+
+def bench_fastq_iter(f):
+    return sum(1 for rec in fastx.fastq_iter(f)), os.path.getsize(f)
+
+def bench_fastq_mmap_iter(f):
+    return sum(1 for rec in fastx.fastq_mmap_iter(f)), os.path.getsize(f)
+
+def bench_fastq_batches(f):
+    return sum(len(batch.lengths) for batch in fastx.fastq_batches(f, 100000)), os.path.getsize(f)
+
+def bench_fasta_iter(f):
+    return sum(1 for rec in fastx.fasta_iter(f)), os.path.getsize(f)
+
+def bench_intersect_fastq(fq1, fq2, output_dir, engine="auto", gz=False, header_format="guess"):
+    # run in a child process by measure(), so logs of intersect_fastq could be discarded by redirecting stderr
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 2)
+    if header_format == "guess":
+        header2ID = intersect_fastq.guess_header_format(fq1, fq2)
+    else:
+        header2ID = intersect_fastq.infer_header_format(fq1, fq2)
+    NC, O1, O2 = intersect_fastq.intersect_fastq(fq1, fq2, header2ID=header2ID, output_dir=output_dir, prefix="out",
+                                                 force_overwrite=True, gz=gz, engine=engine, progress=0)
+    return NC * 2 + O1 + O2, os.path.getsize(fq1) + os.path.getsize(fq2)
+
+def run_command(cmd):
+    """ To run an external command with its output discarded, return its exit code and peak RSS (in MB) """
+
+    with open(os.devnull, 'w') as devnull:
+        p = Popen(cmd, stdout=devnull)
+        pid, status, rusage = os.wait4(p.pid, 0)
+    return os.WEXITSTATUS(status), rusage.ru_maxrss / (2.0 ** 20 if sys.platform == "darwin" else 2.0 ** 10)
+
+def _run(conn, func, args, kwds):
+    """ run in a child process: call func, and send the elapsed time, the result and peak RSS to conn """
+
+    try:
+        t = time()
+        records, nbytes = func(*args, **kwds)
+        conn.send((time() - t, records, nbytes, peak_rss()[0], None))
+    except Exception as e:
+        conn.send((None, None, None, None, "%s: %s" % (type(e).__name__, e)))
+    conn.close()
+
+def measure(name, func, *args, **kwds):
+    """ To run func(*args, **kwds) in a new process, return a dict of time, throughput and peak RSS """
+
+    parent, child = Pipe(False)
+    p = Process(target=_run, args=(child, func, args, kwds))
+    p.start()
+    child.close()       # so recv() raises EOFError instead of blocking if the child exits without sending
+    try:
+        seconds, records, nbytes, rss, error = parent.recv()
+    except (EOFError, OSError):
+        seconds = records = nbytes = rss = None
+        error = "the process exited without a result"
+    parent.close()
+    p.join()
+    if error and p.exitcode:
+        # killed by a signal (e.g. by the OOM killer) if exitcode < 0
+        error += ", exit code %d" % p.exitcode
+    result = {"name": name, "seconds": seconds, "records": records, "bytes": nbytes, "peak_rss_MB": rss}
+    if error:
+        result["error"] = error
+    else:
+        result["seconds"] = round(seconds, 4)
+        result["records_per_s"] = round(records / max(seconds, 1e-9), 1)
+        result["MB_per_s"] = round(nbytes / 1e6 / max(seconds, 1e-9), 3)
+        result["peak_rss_MB"] = round(rss, 1)
+    return result
+
+def measure_command(name, cmd, records, nbytes):
+    """ To run an external command, return a dict of time, throughput and peak RSS """
+
+    t = time()
+    status, rss = run_command(cmd)
+    seconds = time() - t
+    result = {"name": name, "seconds": round(seconds, 4), "records": records, "bytes": nbytes, "peak_rss_MB": round(rss, 1),
+              "records_per_s": round(records / max(seconds, 1e-9), 1), "MB_per_s": round(nbytes / 1e6 / max(seconds, 1e-9), 3)}
+    if status:
+        result["error"] = "exit status %d" % status
+    return result
+
+#-----------------------------------------------------------------------------
+BENCHMARKS = ['fastx', 'intersect', 'util']
+ENGINES = sorted(intersect_fastq.join_engines)
+
+def run_benchmarks(work_dir, n=100000, read_length=100, filter_rate=0.1, shuffle=0.0, seed=0,
+                   header_formats=None, engines=None, benchmarks=None, log=sys.stderr.write):
+    """ To generate synthetic data in work_dir and run benchmarks, return a list of results (dicts)
+
+    header_formats: header formats of fastq files for intersect_fastq, default is all of HEADER_FORMATS
+    engines:        intersect_fastq engines, default is all of them
+    benchmarks:     groups of benchmarks to run, default is all of BENCHMARKS
+    """
+
+    header_formats = header_formats or sorted(HEADER_FORMATS)
+    engines = engines or ENGINES
+    benchmarks = benchmarks or BENCHMARKS
+    results = []
+
+    def add(result, **params):
+        result.update(params)
+        results.append(result)
+        log("[%s] %-40s %8.3fs %12.0f records/s %8.1f MB/s %8.1f MB%s\n" % (date(), result["name"], result["seconds"] or 0,
+            result.get("records_per_s", 0), result.get("MB_per_s", 0), result["peak_rss_MB"] or 0,
+            "  " + result["error"] if "error" in result else ""))
+
+    params = dict(n=n, read_length=read_length, filter_rate=filter_rate, shuffle=shuffle, seed=seed)
+    if 'fastx' in benchmarks:
+        fq1, fq2 = make_fastq_pair(os.path.join(work_dir, "fastx"), **params)
+        fq1_gz, fq2_gz = make_fastq_pair(os.path.join(work_dir, "fastx"), gz=True, **params)
+        fa = make_fasta(os.path.join(work_dir, "fastx.fa"), n=max(n // 1000, 1), seed=seed)
+        add(measure("fastx.fastq_iter", bench_fastq_iter, fq1), gz=False)
+        add(measure("fastx.fastq_iter", bench_fastq_iter, fq1_gz), gz=True)
+        add(measure("fastx.fastq_mmap_iter", bench_fastq_mmap_iter, fq1), gz=False)
+        if fastx.np is not None:
+            add(measure("fastx.fastq_batches", bench_fastq_batches, fq1), gz=False)
+        add(measure("fastx.fasta_iter", bench_fasta_iter, fa), gz=False)
+
+    if 'intersect' in benchmarks:
+        for fmt in header_formats:
+            for gz in (False, True):
+                fq1, fq2 = make_fastq_pair(os.path.join(work_dir, fmt), header_format=fmt, gz=gz, **params)
+                output_dir = os.path.join(work_dir, "output")
+                for engine in engines:
+                    add(measure("intersect_fastq.%s" % engine, bench_intersect_fastq, fq1, fq2, output_dir, engine=engine, gz=gz,
+                                header_format="infer" if fmt == "infer" else "guess"),
+                        header_format=fmt, gz=gz, engine=engine)
+                rmtree(output_dir, ignore_errors=True)
+
+    if 'util' in benchmarks:
+        util = os.path.join(os.path.dirname(os.path.abspath(__file__)), "util")
+        table = make_table(os.path.join(work_dir, "table.txt"), n=n, seed=seed)
+        size = os.path.getsize(table)
+        add(measure_command("util/cut2.py", [sys.executable, os.path.join(util, "cut2.py"), "-f", "3,1,2", table], n, size))
+        mapping = make_table(os.path.join(work_dir, "mapping.txt"), n=n, columns=2, seed=seed)
+        add(measure_command("util/join2.py", [sys.executable, os.path.join(util, "join2.py"), mapping, table], n, size))
+
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    """ To find results slower (by records/s) than those in baseline by more than tolerance, return a list of messages """
+
+    key = lambda r: (r["name"], r.get("header_format"), r.get("gz"), r.get("engine"))
+    old = dict((key(r), r) for r in baseline if "error" not in r)
+    messages = []
+    for r in results:
+        b = old.get(key(r))
+        if b is None or "error" in r:
+            continue
+        if r["records_per_s"] < b["records_per_s"] * (1 - tolerance):
+            messages.append("%s: %.0f records/s, was %.0f records/s" % (" ".join(str(k) for k in key(r) if k is not None),
+                                                                      r["records_per_s"], b["records_per_s"]))
+    return messages
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='To benchmark fastx, intersect_fastq and the util tools on synthetic data.')
+    parser.add_argument('-n', default=100000, type=int, metavar="N", help="number of read pairs (before filtering) of every fastq pair. Default is 100000.")
+    parser.add_argument('-l', '--read_length', default=100, type=int, metavar="L", help="read length. Default is 100.")
+    parser.add_argument('-r', '--filter_rate', default=0.1, type=float, metavar="RATE", help="fraction of reads removed from each fastq file. Default is 0.1.")
+    parser.add_argument('-s', '--shuffle', default=0.0, type=float, metavar="DEGREE", help="fraction of reads moved to random positions in each fastq file, 0 to keep the order. Default is 0.")
+    parser.add_argument('--seed', default=0, type=int, help="seed of the random generator. Default is 0.")
+    parser.add_argument('-f', '--header_formats', nargs='+', default=None, choices=sorted(HEADER_FORMATS), metavar="FORMAT", help="header formats of fastq files for intersect_fastq, one or more of %s. Default is all." % ", ".join(sorted(HEADER_FORMATS)))
+    parser.add_argument('-e', '--engines', nargs='+', default=None, choices=ENGINES, metavar="ENGINE", help="intersect_fastq engines, one or more of %s. Default is all." % ", ".join(ENGINES))
+    parser.add_argument('-b', '--benchmarks', nargs='+', default=None, choices=BENCHMARKS, metavar="BENCHMARK", help="benchmarks to run, one or more of %s. Default is all." % ", ".join(BENCHMARKS))
+    parser.add_argument('-d', '--work_dir', default=None, metavar="work_dir", help="directory for the synthetic data, which will be kept. Default is a temporary directory, which will be removed.")
+    parser.add_argument('-o', '--output', default='-', help="output JSON file, default to stdout")
+    parser.add_argument('-c', '--compare', default=None, metavar="baseline", help="JSON output of an earlier run, exit with 1 if any benchmark is slower by more than --tolerance.")
+    parser.add_argument('--tolerance', default=0.2, type=float, metavar="T", help="fraction of records/s allowed to be slower than the baseline. Default is 0.2.")
+
+    args = parser.parse_args()
+    work_dir = args.work_dir or mkdtemp(prefix="ibl_benchmark.")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    try:
+        results = run_benchmarks(work_dir, n=args.n, read_length=args.read_length, filter_rate=args.filter_rate,
+                                 shuffle=args.shuffle, seed=args.seed, header_formats=args.header_formats,
+                                 engines=args.engines, benchmarks=args.benchmarks)
+    finally:
+        if not args.work_dir:
+            rmtree(work_dir, ignore_errors=True)
+
+    report = {"date": date(), "python": platform.python_version(), "platform": platform.platform(),
+              "params": {"n": args.n, "read_length": args.read_length, "filter_rate": args.filter_rate,
+                         "shuffle": args.shuffle, "seed": args.seed},
+              "results": results}
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(report, fout, indent=2, sort_keys=True)
+    fout.write("\n")
+    if fout is not sys.stdout:
+        fout.close()
+
+    if args.compare:
+        with open(args.compare) as fobj:
+            regressions = compare(results, json.load(fobj)["results"], args.tolerance)
+        for msg in regressions:
+            sys.stderr.write("[%s] regression: %s\n" % (date(), msg))
+        if regressions:
+            sys.exit(1)
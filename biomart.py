@@ -1,9 +1,28 @@
 #!/usr/bin/env python
 
+import io
+import os
+import re
 import sys
+import csv
+import copy
+import gzip
+import time
+import threading
+import sqlite3
+import hashlib
+from functools import partial
+from contextlib import nullcontext
+from itertools import islice, chain, product
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from shlex import split as shlex_split
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+from xml.etree.ElementTree import canonicalize
+from fastx import fasta_iter
 
 """
 to interact with martservice through www.biomart.org
@@ -11,6 +30,26 @@ to interact with martservice through www.biomart.org
 Author: Xiao Jianfeng
 last updated: 2013.08.21
               2022.10.06 - update to python3
+              2026.10.18 - post with a pooled requests.Session (keep-alive), retry with backoff on 5xx and truncated
+                           responses, use BioMart.timeout, request gzip transfer encoding, and report download
+                           progress every few seconds instead of for every chunk
+              2026.10.18 - add query_iter(), query_df() and query_to_file() to parse or save results while they are
+                           downloaded, instead of holding the whole response as a string
+              2026.10.18 - cache metadata (registry, datasets, attributes, filters and configuration) in a SQLite file,
+                           revalidated with ETag/Last-Modified after METADATA_TTL; archive sites are never expired
+              2026.10.18 - cache query results (gzip files keyed by hash of the canonical query xml and the site url),
+                           with the least recently used results removed if the cache is larger than RESULT_CACHE_SIZE
+              2026.10.18 - split long lists of filter values into chunks of FILTER_CHUNK_SIZE values, which are
+                           queried in a pool of threads, and merge their results in query()
+              2026.10.18 - split every list of filter values longer than FILTER_CHUNK_SIZE (queries are made for all
+                           combinations of the chunks), and split them in query_iter(), query_df() and query_to_file()
+                           as well, where the chunks are queried one after another and merged by merge_lines()
+              2026.10.18 - add query_many() to run many queries (e.g. of different datasets or sites) concurrently,
+                           with at most PER_SITE_LIMIT queries to a site at the same time
+              2026.10.18 - query_many() limits the number of requests to a site (per_site) around every request, as
+                           a query split into chunks sends several requests at the same time
+              2026.10.18 - ask for the completion stamp ([success] at the end of results) and check it, check
+                           Content-Length and number of columns of rows, and retry (only) the incomplete query
 
 http://www.biomart.org/martservice.html
 	
@@ -55,14 +94,35 @@ added on 2012.7.5:
 *) build_xml_query()
     build query xml string from dataset, attributes, filters.
 
+*) add_completion_stamp()
+    ask biomart to add "[success]" at the end of results, so incomplete results could be detected
+
+*) make_session()
+    a requests.Session with pooled keep-alive connections, which retries on connection errors and 5xx responses
+
+*) iter_response()
+    post with a session and yield the response as chunks of bytes, truncated responses are retried
+
 *) easy_response()
     a helper function to post with requests and get response
 
+*) split_filters(), merge_results()
+    split a long list of filter values into chunks for separate queries, and merge TSV results of them
+
+*) MetadataCache
+    an on-disk (SQLite) cache of metadata responses, used by BioMart.list_*() and configuration()
+
+*) ResultCache
+    an on-disk cache of query results, used by BioMart.query*()
+
+*) ResponseStream
+    a readable binary stream of the chunks of a response, so results could be parsed while they are downloaded
+
 *) query_xml()
    will call build_xml_query() and easy_response() to query biomart with xml string
 
 *) class BioMart
-    def __init__(self, mart=None, dataset=None, timeout=1000, site="ensembl"):
+    def __init__(self, mart=None, dataset=None, timeout=1000, site="ensembl", retries=3, cache_dir=CACHE_DIR, offline=False, result_cache_size=RESULT_CACHE_SIZE, chunk_size=FILTER_CHUNK_SIZE, max_workers=4, completion_stamp=True):
     def list_sites(self):
     def use_site(self, site):
     def registry_information(self):
@@ -74,7 +134,11 @@ added on 2012.7.5:
     def list_attributes(self, dataset=None):
     def list_filters(self, dataset=None):
     def configuration(self, dataset=None):
-    def query(self, attributes=None, xml=None, filters=None, dataset=None):
+    def query(self, attributes=None, xml=None, filters=None, dataset=None, refresh=False):
+    def query_iter(self, attributes=None, xml=None, filters=None, dataset=None, formatter="TSV", batch_size=100000, converters=None, refresh=False):
+    def query_df(self, attributes=None, xml=None, filters=None, dataset=None, chunksize=None, dtype=None, refresh=False):
+    def query_to_file(self, output, attributes=None, xml=None, filters=None, dataset=None, formatter="TSV", refresh=False):
+    def query_many(self, specs, max_workers=None, per_site=PER_SITE_LIMIT, retries=1, refresh=False):
     def get_BM(self, *args, **kwds):
 """
 
@@ -109,8 +173,28 @@ mart_urls = {
     "ensemblv86": "http://oct2016.archive.ensembl.org/biomart/martservice?",
 }
 
+# metadata and query results are cached in CACHE_DIR, default is ~/.cache/biomart
+CACHE_DIR = os.environ.get(
+    "BIOMART_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "biomart")
+)
+# seconds before cached metadata of a live site is revalidated
+METADATA_TTL = 7 * 24 * 3600
+RESULT_TTL = 7 * 24 * 3600  # seconds before cached results of a live site are expired
+RESULT_CACHE_SIZE = 2 * 2**30  # max bytes of (compressed) cached results
+FILTER_CHUNK_SIZE = 500  # max number of values of a filter in one query, the server times out with too many values
+PER_SITE_LIMIT = 4  # max number of requests to a site at the same time by query_many()
+
+
+def is_archive_site(site):
+    """archive sites (e.g. ensemblv75) never change, so their metadata and results could be cached forever"""
+
+    return bool(re.match(r"ensemblv\d+$", site or ""))
+
+
 # -----------------------------------------------------------------
-def build_xml_query(dataset, attributes, filters=None, formatter="TSV"):
+def build_xml_query(
+    dataset, attributes, filters=None, formatter="TSV", completion_stamp=False
+):
     """
     Only dataset, filters, and attributes are needed to build a query, while database is not needed.
     I guess this is because the dataset name is enough to identify itself.
@@ -123,6 +207,7 @@ def build_xml_query(dataset, attributes, filters=None, formatter="TSV"):
     attributes: should be list
 
     formatter: TSV or FASTA
+    completion_stamp: to ask biomart to add "[success]" at the end of results, see add_completion_stamp()
 
     """
 
@@ -194,60 +279,651 @@ def build_xml_query(dataset, attributes, filters=None, formatter="TSV"):
         + mart_query_attributes
         + mart_query_tail
     )
+    if completion_stamp:
+        xml = add_completion_stamp(xml)
 
     return xml
 
 
-def easy_response(params_dict, base_url=None, site=None, echo=False):
-    """a helper function to post with requests and get response"""
+COMPLETION_STAMP = b"[success]"
+
+
+def add_completion_stamp(xml):
+    """
+    To add completionStamp = "1" to a query xml, so biomart adds a line of "[success]" at the end of results, which
+    is missing if the results are incomplete (e.g. the server is stopped in the middle of a query).
+    """
+
+    if has_completion_stamp(xml):
+        return xml
+    return re.sub(r"<Query\s+", '<Query  completionStamp = "1" ', xml, count=1)
+
+
+def has_completion_stamp(xml):
+    return bool(re.search(r'completionStamp\s*=\s*"1"', xml))
+
+
+def check_tsv(text, n_columns):
+    """
+    To check that every row of a TSV result (str) ends with "\n" and has n_columns values, as a row truncated in the
+    middle has less values.
+
+    return None, or description of the first problem found
+    """
+
+    if text and not text.endswith("\n"):
+        return "the last row doesn't end with a newline"
+    for i, ln in enumerate(text.split("\n")[:-1]):
+        n = ln.count("\t") + 1
+        if n != n_columns:
+            return f"row {i + 1} has {n} columns instead of {n_columns}"
+    return None
+
+
+# -----------------------------------------------------------------
+RETRY_STATUS = (429, 500, 502, 503, 504)
+PROGRESS_INTERVAL = 5  # seconds between two progress reports of a download
+# bytes held back by iter_response() to check the completion stamp
+STAMP_HOLD = len(COMPLETION_STAMP) + 2
+
+
+class TruncatedResponse(Exception):
+    """a response shorter than its Content-Length, or without the completion stamp"""
+
+
+# errors raised when a response is truncated or the connection is broken while reading it
+TRUNCATED_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+    requests.exceptions.ConnectionError,
+    TruncatedResponse,
+)
+
+
+def make_session(retries=3, backoff_factor=1.0, pool_maxsize=10):
+    """
+    To make a requests.Session, which keeps connections alive and reuses them for requests to the same host,
+    and retries (with backoff_factor * 2 ** n seconds between retries) on connection errors and 5xx responses.
+    """
+
+    retry_kwds = dict(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False,
+    )
+    try:
+        retry = Retry(allowed_methods=None, **retry_kwds)  # retry POST as well
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=False, **retry_kwds)
+
+    adapter = HTTPAdapter(
+        max_retries=retry, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+_default_session = None
+
+
+def default_session():
+    """the session shared by functions called without a session"""
+
+    global _default_session
+    if _default_session is None:
+        _default_session = make_session()
+    return _default_session
+
+
+def iter_response(
+    params_dict,
+    base_url=None,
+    site=None,
+    session=None,
+    timeout=None,
+    retries=3,
+    backoff_factor=1.0,
+    chunk_size=2**16,
+    progress=True,
+    completion_stamp=False,
+):
+    """
+    To post params_dict to martservice, and yield the response as chunks of bytes.
+
+    session: a requests.Session made by make_session(), default is default_session()
+    timeout: seconds to wait for the server to send data
+    retries: number of times to request again if the response is truncated. As the server gives the same response to
+             the same request, data already yielded will be skipped in the new response.
+    progress: to report size of downloaded data to stderr every PROGRESS_INTERVAL seconds
+    completion_stamp: the query asks for the completion stamp (see add_completion_stamp()), which is checked and
+                      removed. A response without it is retried like a truncated one, unless it is an error message.
+
+    A response shorter than its Content-Length is also retried.
+    """
 
     if site:
         base_url = mart_urls[site]
     else:
         if base_url is None:
             base_url = mart_urls["ensembl"]
+    session = session or default_session()
+
+    size, attempt = 0, 0  # bytes yielded, and number of retries
+    t0 = last = time.time()
+    while True:
+        if DEBUG:
+            sys.stderr.write(f"requests.post -\n{base_url}: {params_dict}\n")
+        # connection errors and 5xx responses are retried by the adapter of session
+        r = session.post(base_url, data=params_dict, timeout=timeout, stream=True)
+        if DEBUG:
+            sys.stderr.write(f"response -\n{r.headers}\n")
+        if not r.ok:
+            r.close()
+            raise Exception(f"Got error: {r.status_code} {r.reason} from {base_url}")
+
+        skip = size  # data already yielded before the response was truncated
+        head = None  # the beginning of the response, to recognize error messages
+        tail = b""  # the end of the response held back, which should be the completion stamp
+        try:
+            for buf in r.iter_content(chunk_size):
+                if head is None:
+                    head = buf[:64]
+                if completion_stamp:
+                    buf = tail + buf
+                    buf, tail = buf[:-STAMP_HOLD], buf[-STAMP_HOLD:]
+                buf, skip = buf[skip:], max(0, skip - len(buf))
+                if not buf:
+                    continue
+                size += len(buf)
+                yield buf
+                if progress and time.time() - last >= PROGRESS_INTERVAL:
+                    last = time.time()
+                    sys.stderr.write(
+                        f"downloaded {size / 1e6:.1f} MB in {last - t0:.0f}s\n"
+                    )
 
-    r = requests.post(base_url, data=params_dict)
-    if DEBUG:
-        sys.stderr.write(f"requests.post -\n{base_url}: {params_dict}\n")
+            # urllib3 < 2 doesn't check Content-Length, r.raw.tell() is number of (compressed) bytes received
+            length = r.headers.get("Content-Length")
+            if length and r.raw.tell() < int(length):
+                raise TruncatedResponse(
+                    f"{r.raw.tell()} of {length} bytes (Content-Length) received"
+                )
+            if completion_stamp:
+                stripped = tail.rstrip(b"\r\n")
+                if stripped.endswith(COMPLETION_STAMP):
+                    tail = stripped[: -len(COMPLETION_STAMP)]
+                elif not (head or b"").startswith((b"Query ERROR", b"ERROR")):
+                    raise TruncatedResponse("the completion stamp is missing")
+                buf, skip = tail[skip:], max(0, skip - len(tail))
+                if buf:
+                    size += len(buf)
+                    yield buf
+            break
+        except TRUNCATED_ERRORS as e:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            sys.stderr.write(
+                f"response is truncated after {size} bytes ({e}), will retry ({attempt}/{retries}).\n"
+            )
+            time.sleep(backoff_factor * 2 ** (attempt - 1))
+        finally:
+            r.close()
 
-    if DEBUG:
-        sys.stderr.write(f"response -\n{r.headers}\n")
-    if r.ok:
-        r.headers["Content-Length"] if "Content-Length" in r.headers else None
+    if progress and last > t0:
+        sys.stderr.write(
+            f"downloaded {size / 1e6:.1f} MB in {time.time() - t0:.0f}s, done.\n"
+        )
 
-        sys.stderr.write("Start to download ")
-        current_size, data = 0, []
-        for buf in r.iter_content(1024 * 10, decode_unicode=True):
-            if buf:
-                data.append(buf)
-                current_size += len(buf)
-                sys.stderr.write("\b- ")
-        sys.stderr.write("\bdone.\n")
 
-    else:
-        raise Exception("Got error: %s" % r.error)
+def easy_response(params_dict, base_url=None, site=None, echo=False, **kwds):
+    """
+    a helper function to post with requests and get response
+
+    kwds: session, timeout, retries, ..., see iter_response()
+    """
+
+    data = b"".join(iter_response(params_dict, base_url=base_url, site=site, **kwds))
+    data = data.decode("utf-8")
 
     if echo or DEBUG:
         print(data)
 
-    return "".join(data)
+    return data
+
+
+def split_filters(filters, chunk_size=FILTER_CHUNK_SIZE):
+    """
+    To split every list of filter values longer than chunk_size into chunks of chunk_size values, return a list of
+    filters, one for every combination of the chunks (of different filters), i.e. one for every query.
+    As values of a filter are ORed and filters are ANDed, results of the queries together are the same as the result
+    of filters.
+
+    filters: a list of dict, the same as in build_xml_query()
+    """
+
+    if not filters or not chunk_size:
+        return [filters]
+
+    chunks = []  # chunks of every filter
+    for filt in filters:
+        values = filt.get("value")
+        if isinstance(values, str):
+            values = values.split(",")
+        if isinstance(values, (tuple, list)) and len(values) > chunk_size:
+            values = list(values)
+            chunks.append(
+                [
+                    dict(filt, value=values[i : i + chunk_size])
+                    for i in range(0, len(values), chunk_size)
+                ]
+            )
+        else:
+            chunks.append([filt])
+    if all(len(c) == 1 for c in chunks):
+        return [filters]
+    return [list(p) for p in product(*chunks)]
+
+
+def merge_results(results, header=True, unique=False):
+    """
+    To merge TSV results (str) of queries into one, with only the header line of the first result.
+
+    unique: to remove duplicate rows (the first one is kept), as rows are only unique in every result with
+            uniqueRows = "1"
+    """
+
+    lines, seen = [], set()
+    for result in results:
+        rows = result.split("\n")
+        if rows[-1] == "":
+            rows.pop()
+        if header and rows:
+            if not lines:
+                lines.append(rows[0])
+            rows = rows[1:]
+        for row in rows:
+            if unique:
+                if row in seen:
+                    continue
+                seen.add(row)
+            lines.append(row)
+    return "".join(ln + "\n" for ln in lines)
+
+
+def merge_lines(streams, header=True, unique=False):
+    """
+    To merge TSV results of queries like merge_results(), but the results are binary file objects, which are read
+    while the lines (bytes) are yielded. Rows yielded are kept in memory if unique.
+    """
+
+    seen, has_header = set(), False
+    for fobj in streams:
+        with fobj:
+            if header:
+                line = fobj.readline()
+                if line and not has_header:
+                    has_header = True
+                    yield line
+            for line in fobj:
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                if unique:
+                    if line in seen:
+                        continue
+                    seen.add(line)
+                yield line
+
+
+class MetadataCache:
+    """
+    To cache metadata responses of martservice (registry, datasets, attributes, filters and configuration) in a SQLite
+    file, keyed by the url of the site (so every archive version has its own entries) and the request parameters.
+
+    path: the SQLite file, default is CACHE_DIR/metadata.sqlite
+    ttl: seconds before a cached response is revalidated, None for never. Responses of archive sites never expire.
+    offline: to use cached responses however old they are, and never connect to the server
+
+    A cached response older than ttl is revalidated with If-None-Match/If-Modified-Since, and used as it is if the
+    server answers "304 Not Modified", or if the server couldn't be reached.
+    """
+
+    def __init__(self, path=None, ttl=METADATA_TTL, offline=False):
+        self.path = path or os.path.join(CACHE_DIR, "metadata.sqlite")
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (url TEXT, params TEXT, body BLOB, etag TEXT, "
+                "last_modified TEXT, fetched REAL, PRIMARY KEY (url, params))"
+            )
+
+    def _connect(self):
+        # a new connection for every access, so a cache could be shared by threads and processes
+        return sqlite3.connect(self.path, timeout=60)
+
+    @staticmethod
+    def key(params_dict):
+        return "&".join(f"{k}={params_dict[k]}" for k in sorted(params_dict))
+
+    def get(self, url, params_dict):
+        """return (body, etag, last_modified, fetched) of a cached response, or None"""
+
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT body, etag, last_modified, fetched FROM metadata WHERE url = ? AND params = ?",
+                (url, self.key(params_dict)),
+            ).fetchone()
+
+    def put(self, url, params_dict, body, etag=None, last_modified=None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                (url, self.key(params_dict), body, etag, last_modified, time.time()),
+            )
+
+    def touch(self, url, params_dict):
+        """To mark a cached response as validated now"""
+
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE metadata SET fetched = ? WHERE url = ? AND params = ?",
+                (time.time(), url, self.key(params_dict)),
+            )
+
+    def clear(self, url=None):
+        """To remove cached responses of url, or all cached responses"""
+
+        with self._connect() as conn:
+            if url is None:
+                conn.execute("DELETE FROM metadata")
+            else:
+                conn.execute("DELETE FROM metadata WHERE url = ?", (url,))
+
+    def response(self, params_dict, site, session=None, timeout=None, refresh=False):
+        """
+        To get the response (str) of a metadata request from the cache, or from the server if it is not cached,
+        expired or refresh is True.
+        """
+
+        url = mart_urls[site]
+        cached = None if refresh else self.get(url, params_dict)
+        if cached is not None:
+            body, etag, last_modified, fetched = cached
+            if (
+                self.offline
+                or is_archive_site(site)
+                or self.ttl is None
+                or time.time() - fetched < self.ttl
+            ):
+                return body.decode("utf-8")
+        elif self.offline:
+            raise Exception(
+                f"{self.key(params_dict)} of site {site} is not cached, couldn't get it in offline mode"
+            )
+
+        headers = {}
+        if cached is not None:
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        # martservice answers metadata requests with GET, so they could be revalidated
+        session = session or default_session()
+        try:
+            r = session.get(url, params=params_dict, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            if cached is None:
+                raise
+            sys.stderr.write(
+                f"couldn't connect to {url} ({e}), cached metadata is used.\n"
+            )
+            return cached[0].decode("utf-8")
+
+        if r.status_code == 304 and cached is not None:
+            self.touch(url, params_dict)
+            return cached[0].decode("utf-8")
+        if not r.ok:
+            raise Exception(f"Got error: {r.status_code} {r.reason} from {url}")
+
+        self.put(
+            url,
+            params_dict,
+            r.content,
+            r.headers.get("ETag"),
+            r.headers.get("Last-Modified"),
+        )
+        return r.content.decode("utf-8")
+
+
+class ResultCache:
+    """
+    To cache query results as gzip files in a directory, named by the sha256 of the canonical query xml (so
+    differences in whitespace and order of xml attributes don't matter) and the url of the site, with an SQLite index
+    of their sizes and last access times.
+
+    directory: default is CACHE_DIR/results
+    max_size: max bytes of cached (compressed) results, the least recently used results are removed if it's exceeded
+    ttl: seconds before cached results of live sites are expired, None for never. Results of archive sites are
+         never expired (but could be removed as least recently used).
+    """
+
+    def __init__(self, directory=None, max_size=RESULT_CACHE_SIZE, ttl=RESULT_TTL):
+        self.directory = directory or os.path.join(CACHE_DIR, "results")
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, url TEXT, size INTEGER, "
+                "created REAL, accessed REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.directory, "index.sqlite"), timeout=60)
+
+    @staticmethod
+    def key(xml, url):
+        try:
+            xml = canonicalize(xml, strip_text=True)
+        except Exception:  # not a valid xml, which will be reported by the server
+            pass
+        return hashlib.sha256(f"{url}\n{xml}".encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".gz")
+
+    def get(self, key, site):
+        """return the path of a cached result, or None if it is not cached or is expired"""
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or not os.path.exists(self.path(key)):
+                return None
+            if (
+                not is_archive_site(site)
+                and self.ttl is not None
+                and time.time() - row[0] >= self.ttl
+            ):
+                return None
+            conn.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+        return self.path(key)
+
+    def iter_cached(self, path, chunk_size=2**20):
+        """To yield a cached result as chunks of bytes"""
+
+        with gzip.open(path, "rb") as fobj:
+            for buf in iter(partial(fobj.read, chunk_size), b""):
+                yield buf
 
+    def write(self, key, url, chunks):
+        """
+        To yield chunks of a result, and write them to the cache at the same time.
+        The result is added to the cache only after all chunks are yielded.
+        """
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{id(chunks)}.tmp"
+        complete = False
+        try:
+            with gzip.open(tmp, "wb", compresslevel=6) as fout:
+                for buf in chunks:
+                    fout.write(buf)
+                    yield buf
+            complete = True
+        finally:
+            if complete:
+                os.replace(tmp, path)
+                self.add(key, url, os.path.getsize(path))
+            elif os.path.exists(tmp):
+                os.remove(tmp)
+
+    def add(self, key, url, size):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, url, size, now, now),
+            )
+        self.evict()
+
+    def evict(self):
+        """To remove the least recently used results until the cache is not larger than max_size"""
+
+        with self._connect() as conn:
+            total = conn.execute("SELECT SUM(size) FROM results").fetchone()[0] or 0
+            if total <= self.max_size:
+                return
+            for key, size in conn.execute(
+                "SELECT key, size FROM results ORDER BY accessed"
+            ).fetchall():
+                if total <= self.max_size:
+                    break
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+                total -= size
+
+    def clear(self):
+        with self._connect() as conn:
+            for (key,) in conn.execute("SELECT key FROM results").fetchall():
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+            conn.execute("DELETE FROM results")
+
+
+class ResponseStream(io.RawIOBase):
+    """
+    a readable binary stream of chunks of bytes (e.g. yielded by iter_response()), to be wrapped by io.BufferedReader
+    and io.TextIOWrapper, so the response is parsed while it is downloaded.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+
+    def readable(self):
+        return True
 
-def query_xml(xml=None, site=None):
+    def readinto(self, b):
+        while not self.buf:
+            self.buf = next(self.chunks, None)
+            if self.buf is None:
+                self.buf = b""
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        # a generator is closed, so the response it's reading is closed as well
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        super().close()
+
+
+# rows of a TSV result: columns is the header line (None if there is no header), rows is a list of lists of values
+RowBatch = namedtuple("RowBatch", "columns rows")
+
+# result of a query in query_many(): index and spec of the query, status ("ok" or "failed"), result (str) or error,
+# seconds spent by all attempts, and number of attempts
+QueryResult = namedtuple(
+    "QueryResult", "index spec status result error seconds attempts"
+)
+
+
+def query_xml(xml=None, site=None, **kwds):
+    """kwds: session, timeout, retries, ..., see iter_response()"""
 
     if xml is None:
         raise Exception("not valid input for query_xml")
 
     params_dict = {"query": xml}
+    kwds.setdefault("completion_stamp", has_completion_stamp(xml))
 
-    return easy_response(params_dict, site=site)
+    return easy_response(params_dict, site=site, **kwds)
 
 
 # -----------------------------------------------------------------
 class BioMart:
-    def __init__(self, mart=None, dataset=None, timeout=1000, site="ensembl"):
-        """it seems mart is not necessary to query biomart, dataset+[filters+]attributes is enough"""
+    def __init__(
+        self,
+        mart=None,
+        dataset=None,
+        timeout=1000,
+        site="ensembl",
+        retries=3,
+        cache_dir=CACHE_DIR,
+        offline=False,
+        result_cache_size=RESULT_CACHE_SIZE,
+        chunk_size=FILTER_CHUNK_SIZE,
+        max_workers=4,
+        completion_stamp=True,
+    ):
+        """
+        it seems mart is not necessary to query biomart, dataset+[filters+]attributes is enough
+
+        timeout: seconds to wait for the server to send data
+        retries: number of retries on connection errors, 5xx responses and truncated responses
+        cache_dir: directory to cache metadata and query results in, None to disable the cache
+        offline: to use cached metadata only, see MetadataCache
+        result_cache_size: max bytes of cached query results, 0 to disable the cache of results, see ResultCache
+        chunk_size: max number of values of a filter in one query, longer lists are split into chunks by query()
+        max_workers: number of threads to query the chunks
+        completion_stamp: to ask for the completion stamp in queries and check it, see add_completion_stamp()
+        """
+
+        self.timeout = timeout
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.completion_stamp = completion_stamp
+        # a semaphore held by every request to the server, set by query_many() to limit requests to a site
+        self.site_limit = None
+        # all requests of a BioMart share the pooled connections of a session
+        self.session = make_session(retries=retries, pool_maxsize=max(10, max_workers))
+        self.metadata_cache = (
+            MetadataCache(os.path.join(cache_dir, "metadata.sqlite"), offline=offline)
+            if cache_dir
+            else None
+        )
+        self.result_cache = (
+            ResultCache(os.path.join(cache_dir, "results"), max_size=result_cache_size)
+            if cache_dir and result_cache_size
+            else None
+        )
 
         self.available_sites = list(mart_urls.keys())
         self.available_databases = None
@@ -268,8 +944,6 @@ class BioMart:
         else:
             self.dataset = dataset
 
-        self.timeout = timeout
-
     def list_sites(self):
 
         return list(mart_urls.keys())
@@ -286,6 +960,31 @@ class BioMart:
                 )
             )
 
+    def _response(self, params_dict, echo=False):
+        """To post params_dict to self.site with self.session"""
+
+        return easy_response(
+            params_dict,
+            site=self.site,
+            echo=echo,
+            session=self.session,
+            timeout=self.timeout,
+            retries=self.retries,
+        )
+
+    def _metadata(self, params_dict, refresh=False):
+        """To get a metadata response of self.site from self.metadata_cache, or from the server if it isn't cached"""
+
+        if self.metadata_cache is None:
+            return self._response(params_dict)
+        return self.metadata_cache.response(
+            params_dict,
+            self.site,
+            session=self.session,
+            timeout=self.timeout,
+            refresh=refresh,
+        )
+
     # -------------------------------------------------
 
     def registry_information(self):
@@ -322,7 +1021,7 @@ class BioMart:
 
         params_dict = {"type": "registry"}
 
-        data = easy_response(params_dict, site=self.site, echo=False)
+        data = self._metadata(params_dict)
 
         db_dict = {}
         # column 'name' should be used by self.use_database()
@@ -377,7 +1076,7 @@ class BioMart:
             sys.stderr.write("Mart being used is: {}\n".format(mart))
 
         params_dict = {"type": "datasets", "mart": mart}
-        data = easy_response(params_dict, site=self.site, echo=False)
+        data = self._metadata(params_dict)
 
         # parse the output to make it more readable
         data2 = [ln.split("\t") for ln in data.strip().split("\n") if ln.strip()]
@@ -436,7 +1135,7 @@ class BioMart:
         print("Dataset being used is: ", dataset)
 
         params_dict = {"type": "attributes", "dataset": dataset}
-        data = easy_response(params_dict, site=self.site, echo=False)
+        data = self._metadata(params_dict)
 
         # parse the output to make it more readable
         data2 = [ln.split("\t") for ln in data.strip().split("\n")]
@@ -459,7 +1158,7 @@ class BioMart:
         print("Dataset being used is: ", dataset)
 
         params_dict = {"type": "filters", "dataset": dataset}
-        data = easy_response(params_dict, site=self.site, echo=False)
+        data = self._metadata(params_dict)
 
         # parse the output to make it more readable
         data2 = [ln.split("\t") for ln in data.strip().split("\n")]
@@ -482,19 +1181,85 @@ class BioMart:
         print("Dataset being used is: ", dataset)
 
         params_dict = {"type": "configuration", "dataset": dataset}
+        data = self._metadata(params_dict)
+        print(data)
 
-        return easy_response(params_dict, site=self.site, echo=True)
+        return data
 
-    def query(self, attributes=None, xml=None, filters=None, dataset=None):
+    def query(
+        self, attributes=None, xml=None, filters=None, dataset=None, refresh=False
+    ):
         """
         example:
             filters: {"affy_hg_u133a_2": ("202763_at","209310_s_at","207500_at")}
             attributes: ["ensembl_gene_id", "ensembl_transcript_id", "affy_hg_u133a_2"]
             dataset: "hsapiens_gene_ensembl"
 
+        refresh: to query the server even if the result is cached, and update the cache
+
+        If there are more than self.chunk_size values of a filter, they are split into chunks (see split_filters()),
+        which are queried in self.max_workers threads, and results of the chunks are merged (with duplicate rows
+        removed if uniqueRows is set in the query).
+
         Note: "mart" or "database" info is not needed by query().
         """
 
+        xmls = self._query_xmls(attributes, xml, filters, dataset)
+        if len(xmls) > 1:
+            return self._query_filter_chunks(xmls, refresh)
+
+        output = self._query_text(xmls[0], refresh)
+
+        # TODO: check the output format as this only works for TSV format with header
+        # results = [ln.split("\t") for ln in output.rstrip("\n").split("\n")]
+
+        return output
+
+    def _query_filter_chunks(self, xmls, refresh=False):
+        """To run queries of chunks of filters (see _query_xmls()) in a pool of threads, and merge their results"""
+
+        def run(xml):
+            return self._query_text(xml, refresh)
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            results = list(pool.map(run, xmls))
+        for result in results:
+            if result.startswith("Query ERROR") or result.startswith("ERROR"):
+                raise Exception(f"biomart query failed: {result.strip()}")
+
+        return merge_results(
+            results,
+            header='header = "1"' in xmls[0],
+            unique='uniqueRows = "1"' in xmls[0],
+        )
+
+    def _query_text(self, xml, refresh=False):
+        """
+        To get the result of a query as str. A TSV result with rows truncated (see check_tsv()) is queried again,
+        as a result cached or downloaded without the completion stamp may be incomplete.
+        """
+
+        for attempt in range(self.retries + 1):
+            text = b"".join(self._query_chunks(xml, refresh or attempt > 0))
+            text = text.decode("utf-8")
+            if (
+                not re.search(r'formatter\s*=\s*"TSV"', xml)
+                or text.startswith("Query ERROR")
+                or text.startswith("ERROR")
+            ):
+                return text
+            problem = check_tsv(text, xml.count("<Attribute "))
+            if problem is None:
+                return text
+            if attempt < self.retries:
+                sys.stderr.write(
+                    f"result is incomplete ({problem}), will retry ({attempt + 1}/{self.retries}).\n"
+                )
+        raise Exception(f"result is incomplete after {self.retries} retries: {problem}")
+
+    def _query_xml(self, attributes, xml, filters, dataset, formatter="TSV"):
+        """To build the query xml if xml is not given, with the completion stamp if self.completion_stamp"""
+
         if xml is None:  # query with xml
             dataset = dataset if dataset else self.dataset
             if dataset is None:
@@ -503,15 +1268,327 @@ class BioMart:
                 )
 
             xml = build_xml_query(
-                dataset=dataset, attributes=attributes, filters=filters
+                dataset=dataset,
+                attributes=attributes,
+                filters=filters,
+                formatter=formatter,
             )
+        if self.completion_stamp:
+            xml = add_completion_stamp(xml)
+        return xml
 
-        output = query_xml(xml, site=self.site)
+    def _query_xmls(self, attributes, xml, filters, dataset, formatter="TSV"):
+        """To build query xmls, one for every chunk of filters (see split_filters()), or [xml] if xml is given"""
 
-        # TODO: check the output format as this only works for TSV format with header
-        # results = [ln.split("\t") for ln in output.rstrip("\n").split("\n")]
+        chunks = (
+            [filters] if xml is not None else split_filters(filters, self.chunk_size)
+        )
+        return [self._query_xml(attributes, xml, f, dataset, formatter) for f in chunks]
 
-        return output
+    def _query_chunks(self, xml, refresh=False):
+        """
+        To yield the result of a query as chunks of bytes, from self.result_cache if it is cached, otherwise from the
+        server, and the result is cached after it is downloaded completely (unless it is an error message).
+        """
+
+        if self.result_cache is None:
+            cached = key = None
+        else:
+            url = mart_urls[self.site]
+            key = self.result_cache.key(xml, url)
+            cached = None if refresh else self.result_cache.get(key, self.site)
+        if cached is not None:
+            if DEBUG:
+                sys.stderr.write(f"use cached result: {cached}\n")
+            yield from self.result_cache.iter_cached(cached)
+            return
+
+        with self.site_limit or nullcontext():
+            chunks = iter_response(
+                {"query": xml},
+                site=self.site,
+                session=self.session,
+                timeout=self.timeout,
+                retries=self.retries,
+                completion_stamp=has_completion_stamp(xml),
+            )
+            first = next(chunks, b"")
+            if (
+                key is None
+                or first.startswith(b"Query ERROR")
+                or first.startswith(b"ERROR")
+            ):
+                yield first
+                yield from chunks
+            else:
+                yield from self.result_cache.write(key, url, chain([first], chunks))
+
+    def _query_stream(self, xml, refresh=False):
+        """
+        To get the result of a query as a binary file object, which is read while it is downloaded.
+        Errors reported by biomart at the beginning of the response (e.g. "Query ERROR: ...") are raised as an Exception.
+        """
+
+        fobj = io.BufferedReader(
+            ResponseStream(self._query_chunks(xml, refresh)), 2**20
+        )
+        head = fobj.peek(1024)[:1024]
+        if head.startswith(b"Query ERROR") or head.startswith(b"ERROR"):
+            raise Exception(
+                f"biomart query failed: {head.decode('utf-8', 'replace').strip()}"
+            )
+        return fobj
+
+    def _query_streams(self, xmls, refresh=False):
+        """
+        To get the results of queries of chunks of filters (see _query_xmls()) as one binary file object, merged by
+        merge_lines(). The queries are run one after another, and errors of the first one are raised at once.
+        """
+
+        first = self._query_stream(xmls[0], refresh)
+        if len(xmls) == 1:
+            return first
+
+        tsv = re.search(r'formatter\s*=\s*"TSV"', xmls[0]) is not None
+        streams = chain([first], (self._query_stream(x, refresh) for x in xmls[1:]))
+        lines = merge_lines(
+            streams,
+            header=tsv and ('header = "1"' in xmls[0] or 'header = "true"' in xmls[0]),
+            unique=tsv and 'uniqueRows = "1"' in xmls[0],
+        )
+        return io.BufferedReader(ResponseStream(lines), 2**20)
+
+    def _query_lines(self, xmls, refresh=False):
+        """To get the results of queries as a text file object, see _query_streams()"""
+
+        return io.TextIOWrapper(self._query_streams(xmls, refresh), encoding="utf-8")
+
+    def query_iter(
+        self,
+        attributes=None,
+        xml=None,
+        filters=None,
+        dataset=None,
+        formatter="TSV",
+        batch_size=100000,
+        converters=None,
+        refresh=False,
+    ):
+        """
+        To query biomart, and yield results in batches while they are downloaded, so the whole response is never
+        kept in memory.
+
+        formatter: "TSV" - yield RowBatch(columns, rows), rows is a list of at most batch_size lists of values
+                   "FASTA" - yield lists of at most batch_size (name_line, seq) records, parsed by fastx.fasta_iter
+        converters: a dict of column name (or index) --> function to convert (non-empty) values of the column,
+                    e.g. {"Gene start (bp)": int}. Columns could only be given by names if the query has a header.
+        xml: a query built by build_xml_query(), with the same formatter
+        refresh: to query the server even if the result is cached, and update the cache
+
+        Long lists of filter values are split as in query(), but the chunks are queried one after another.
+
+        example:
+            for batch in bm.query_iter(attributes, filters=filters):
+                for row in batch.rows:
+                    ...
+        """
+
+        xmls = self._query_xmls(attributes, xml, filters, dataset, formatter)
+        xml = xmls[0]
+        header = 'header = "1"' in xml or 'header = "true"' in xml
+        names = [k for k in (converters or {}) if isinstance(k, str)]
+        if formatter != "FASTA" and names and not header:
+            raise ValueError(
+                f"converters of columns {names} need the header line, give the columns by indexes instead"
+            )
+        fobj = self._query_lines(xmls, refresh)
+
+        if formatter == "FASTA":
+            records = fasta_iter(fobj)
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                yield batch
+            return
+
+        columns = None
+        if header:
+            line = fobj.readline()
+            if not line:  # no results
+                return
+            columns = line.rstrip("\n").split("\t")
+            missing = [k for k in names if k not in columns]
+            if missing:
+                raise ValueError(
+                    f"converters of columns {missing} are not in the results: {columns}"
+                )
+
+        funcs = [
+            (columns.index(k) if isinstance(k, str) else k, func)
+            for k, func in (converters or {}).items()
+        ]
+
+        n_columns = xml.count("<Attribute ")
+        while True:
+            rows = [ln.rstrip("\n").split("\t") for ln in islice(fobj, batch_size)]
+            if not rows:
+                break
+            for row in rows:
+                if len(row) != n_columns:
+                    raise Exception(
+                        f"result is incomplete: a row has {len(row)} columns instead of {n_columns}: {row}"
+                    )
+            for i, func in funcs:
+                for row in rows:
+                    if row[i] != "":
+                        row[i] = func(row[i])
+            yield RowBatch(columns, rows)
+
+    def query_df(
+        self,
+        attributes=None,
+        xml=None,
+        filters=None,
+        dataset=None,
+        chunksize=None,
+        dtype=None,
+        refresh=False,
+    ):
+        """
+        To query biomart (TSV with header), and parse the results into a pandas.DataFrame while they are downloaded.
+
+        chunksize: if given, return an iterator of DataFrames with at most chunksize rows, instead of one DataFrame
+        dtype: the same as in pandas.read_csv, e.g. {"Chromosome/scaffold name": str}, default is inferred by pandas
+
+        refresh: to query the server even if the result is cached, and update the cache
+
+        Only empty values are parsed as NaN, so gene names like "NA" are kept.
+        Long lists of filter values are split as in query(), but the chunks are queried one after another.
+        """
+
+        xmls = self._query_xmls(attributes, xml, filters, dataset)
+        return pd.read_csv(
+            self._query_lines(xmls, refresh),
+            sep="\t",
+            quoting=csv.QUOTE_NONE,
+            keep_default_na=False,
+            na_values=[""],
+            dtype=dtype,
+            chunksize=chunksize,
+        )
+
+    def query_to_file(
+        self,
+        output,
+        attributes=None,
+        xml=None,
+        filters=None,
+        dataset=None,
+        formatter="TSV",
+        refresh=False,
+    ):
+        """
+        To query biomart, and write results to output (will be compressed if it ends with .gz) while they are
+        downloaded.
+
+        refresh: to query the server even if the result is cached, and update the cache
+
+        Long lists of filter values are split as in query(), but the chunks are queried one after another.
+
+        return number of bytes of the results
+        """
+
+        xmls = self._query_xmls(attributes, xml, filters, dataset, formatter)
+        fobj = self._query_streams(xmls, refresh)
+        size = 0
+        with (gzip.open if output.endswith(".gz") else open)(output, "wb") as fout:
+            for buf in iter(partial(fobj.read1, 2**20), b""):
+                fout.write(buf)
+                size += len(buf)
+        return size
+
+    def query_many(
+        self,
+        specs,
+        max_workers=None,
+        per_site=PER_SITE_LIMIT,
+        retries=1,
+        refresh=False,
+    ):
+        """
+        To run many queries concurrently, and yield a QueryResult for every query as soon as it's finished.
+
+        specs: a list of dict of arguments of query() (attributes, filters, dataset or xml), and optionally "site",
+               default is self.site
+        max_workers: number of queries running at the same time, default is self.max_workers
+        per_site: max number of requests to a site at the same time, including requests of chunks of queries
+                  split by query()
+        retries: number of times to rerun a failed query, queries that succeeded are never rerun
+
+        example:
+            specs = [{"dataset": ds, "attributes": ["ensembl_gene_id", "external_gene_name"]} for ds in datasets]
+            for r in bm.query_many(specs):
+                if r.status == "ok":
+                    ...
+
+        queries failed after all retries could be run again by bm.query_many([r.spec for r in failed])
+        """
+
+        specs = list(specs)
+        sites = set(spec.get("site", self.site) for spec in specs)
+        for site in sites:
+            if site not in mart_urls:
+                raise Exception(f"site {site} is not valid.")
+        marts = {}
+        for site in sites:
+            # a copy sharing the session and caches, with the limit of requests to its site
+            marts[site] = copy.copy(self)
+            marts[site].site = site
+            marts[site].site_limit = threading.BoundedSemaphore(per_site)
+
+        def run(spec):
+            kwds = dict(spec)
+            site = kwds.pop("site", self.site)
+            t0 = time.time()
+            try:
+                result = marts[site].query(refresh=refresh, **kwds)
+                if result.startswith("Query ERROR") or result.startswith("ERROR"):
+                    raise Exception(f"biomart query failed: {result.strip()}")
+                return result, None, time.time() - t0
+            except Exception as e:
+                return None, e, time.time() - t0
+
+        attempts = [0] * len(specs)
+        seconds = [0.0] * len(specs)
+        with ThreadPoolExecutor(max_workers or self.max_workers) as pool:
+
+            def submit(i):
+                attempts[i] += 1
+                return pool.submit(run, specs[i])
+
+            pending = {submit(i): i for i in range(len(specs))}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    result, error, t = future.result()
+                    seconds[i] += t
+                    if error is not None and attempts[i] <= retries:
+                        sys.stderr.write(
+                            f"query {i} failed ({error}), will retry ({attempts[i]}/{retries}).\n"
+                        )
+                        pending[submit(i)] = i
+                        continue
+                    yield QueryResult(
+                        i,
+                        specs[i],
+                        "ok" if error is None else "failed",
+                        result,
+                        error,
+                        seconds[i],
+                        attempts[i],
+                    )
 
     def get_BM(self, *args, **kwds):
         return self.query(*args, **kwds)
@@ -549,6 +1626,100 @@ def test_build_xml_query():
     assert s == expected_output
 
 
+def test_split_filters():
+
+    short = {"name": "biotype", "value": ["protein_coding", "lncRNA"]}
+    genes = [f"G{i}" for i in range(5)]
+    chroms = [str(i) for i in range(1, 4)]
+
+    # nothing to split
+    assert split_filters(None, 2) == [None]
+    assert split_filters([short], 2) == [[short]]
+    assert split_filters([short, {"name": "g", "value": genes}], 0) == [
+        [short, {"name": "g", "value": genes}]
+    ]
+
+    # a list, a tuple or a comma separated str longer than chunk_size
+    for value in (genes, tuple(genes), ",".join(genes)):
+        chunks = split_filters([short, {"name": "g", "value": value}], 2)
+        assert chunks == [
+            [short, {"name": "g", "value": ["G0", "G1"]}],
+            [short, {"name": "g", "value": ["G2", "G3"]}],
+            [short, {"name": "g", "value": ["G4"]}],
+        ]
+
+    # every long list is split, with a query for every combination of the chunks
+    chunks = split_filters(
+        [{"name": "g", "value": genes}, short, {"name": "chr", "value": chroms}], 2
+    )
+    assert len(chunks) == 3 * 2
+    for filters in chunks:
+        assert [f["name"] for f in filters] == ["g", "biotype", "chr"]
+        assert all(len(f["value"]) <= 2 for f in filters)
+    pairs = set((g, c) for f in chunks for g in f[0]["value"] for c in f[2]["value"])
+    assert pairs == set((g, c) for g in genes for c in chroms)
+
+
+def test_merge_results():
+
+    r1 = "Gene\tName\nG1\tA\nG2\tB\n"
+    r2 = "Gene\tName\nG2\tB\nG3\tC\n"
+    assert merge_results([r1, r2]) == "Gene\tName\nG1\tA\nG2\tB\nG2\tB\nG3\tC\n"
+    assert merge_results([r1, r2], unique=True) == "Gene\tName\nG1\tA\nG2\tB\nG3\tC\n"
+    assert (
+        merge_results(["", r2, r1], unique=True) == "Gene\tName\nG2\tB\nG3\tC\nG1\tA\n"
+    )
+    assert merge_results(["G1\tA\n", "G2\tB"], header=False) == "G1\tA\nG2\tB\n"
+    assert merge_results([]) == ""
+
+    # merge_lines() gives the same results, reading them from file objects
+    for results, kwds in (
+        ([r1, r2], {}),
+        ([r1, r2], {"unique": True}),
+        (["", r2, r1], {"unique": True}),
+        (["G1\tA\n", "G2\tB"], {"header": False}),
+    ):
+        streams = [io.BytesIO(r.encode()) for r in results]
+        merged = b"".join(merge_lines(streams, **kwds)).decode()
+        assert merged == merge_results(results, **kwds)
+
+
+def test_check_tsv():
+
+    assert check_tsv("", 2) is None
+    assert check_tsv("Gene\tName\nG1\tA\n", 2) is None
+    assert check_tsv("Gene\tName\nG1\t\n\tA\n", 2) is None  # empty values
+    assert check_tsv("G1\n", 1) is None
+
+    # truncated in the middle of the last row, with or without the newline
+    assert (
+        check_tsv("Gene\tName\nG1\tA\nG2", 2)
+        == "the last row doesn't end with a newline"
+    )
+    assert check_tsv("Gene\tName\nG1\tA\nG2\n", 2) == "row 3 has 1 columns instead of 2"
+    assert check_tsv("Gene\tName\nG1\tA\tx\n", 2) == "row 2 has 3 columns instead of 2"
+
+
+def test_completion_stamp():
+
+    xml = build_xml_query("hsapiens_gene_ensembl", ["ensembl_gene_id"])
+    assert not has_completion_stamp(xml)
+
+    stamped = add_completion_stamp(xml)
+    assert has_completion_stamp(stamped)
+    assert stamped.count("completionStamp") == 1
+    assert '<Query  completionStamp = "1" virtualSchemaName = "default"' in stamped
+    assert add_completion_stamp(stamped) == stamped
+
+    # the same as build_xml_query(..., completion_stamp=True), and the rest of the query is kept
+    assert stamped == build_xml_query(
+        "hsapiens_gene_ensembl", ["ensembl_gene_id"], completion_stamp=True
+    )
+    assert stamped.replace('completionStamp = "1" ', "") == xml
+    assert has_completion_stamp('<Query completionStamp="1">')
+    assert not has_completion_stamp('<Query completionStamp = "0" >')
+
+
 def test_query():
     # mart_query_database = 'ensembl'  # not needed, as the dataset name itself is enough to identify itself.
     # could be one dataset or more, how to explain multiple datasets remains to be determined
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import mmap
+from collections import namedtuple, OrderedDict
+
+"""
+random access to regions of an (uncompressed) fasta file with a .fai index, which is the same as generated by `samtools faidx`.
+
+    >>> fa = FastaIndex("hg19.fa")      # hg19.fa.fai will be built if it doesn't exist
+    >>> fa.fetch("chr1", 10000, 10010)  # 0-based, end is not included, the same as python slicing
+    'TAACCCTAAC'
+
+sequences are sliced from the memory-mapped file, and sequences that are fetched frequently are kept in memory with an LRU cache.
+
+usage: faidx.py [-h] fasta [region [region ...]]
+
+created: 2026.10.18
+"""
+
+#-----------------------------------------------------------------------------
+FaiEntry = namedtuple('FaiEntry', 'name length offset linebases linewidth')
+
+def build_fai(f, fai=None):
+    """ To build .fai index of fasta file f, and write it to fai (default is f + ".fai")
+
+    every line of .fai: name, length, offset of the first base, bases per line, bytes per line (with "\n")
+    return a list of FaiEntry
+    """
+
+    entries = []
+    with open(f, 'rb') as fobj:
+        name, length, offset, linebases, linewidth = None, 0, 0, 0, 0
+        pos, last = 0, False    # last: a shorter line has been read, which should be the last line of the sequence
+        for line in fobj:
+            pos += len(line)
+            if line.startswith(">"):
+                if name is not None:
+                    entries.append(FaiEntry(name, length, offset, linebases, linewidth))
+                name = line[1:].split()[0] if line[1:].strip() else ""
+                length, offset, linebases, linewidth, last = 0, pos, 0, 0, False
+                continue
+
+            n = len(line.rstrip("\r\n"))
+            if not n:
+                last = True
+                continue
+            if last or (linebases and n > linebases):
+                raise Exception("Different line length in sequence %s of %s" % (name, f))
+            if not linebases:
+                linebases, linewidth = n, len(line)
+            elif n < linebases or len(line) != linewidth:
+                last = True
+            length += n
+        if name is not None:
+            entries.append(FaiEntry(name, length, offset, linebases, linewidth))
+
+    with open(fai or f + ".fai", 'w') as fout:
+        for e in entries:
+            fout.write("%s\t%d\t%d\t%d\t%d\n" % e)
+    return entries
+
+def read_fai(fai):
+    """ To read a .fai index, return an OrderedDict of name --> FaiEntry """
+
+    index = OrderedDict()
+    with open(fai) as fobj:
+        for line in fobj:
+            items = line.rstrip("\n").split("\t")
+            index[items[0]] = FaiEntry(items[0], *map(int, items[1:5]))
+    return index
+
+class FastaIndex(object):
+    """ random access to regions of a fasta file with .fai index
+
+    f:           an uncompressed fasta file
+    cache_bases: max number of bases of sequences kept in memory
+    hot:         a sequence will be kept in memory after it is fetched `hot` times
+    """
+
+    def __init__(self, f, cache_bases=2 ** 28, hot=3):
+        if f.endswith(".gz"):
+            raise Exception("Couldn't index gzip file: %s" % f)
+        self.f = f
+        fai = f + ".fai"
+        if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(f):
+            build_fai(f, fai)
+        self.index = read_fai(fai)
+
+        with open(f, 'rb') as fobj:
+            self.mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f) else ""
+
+        self.cache_bases, self.hot = cache_bases, hot
+        self.cache = OrderedDict()      # name --> sequence, the most recently used is at the end
+        self.cached_bases = 0
+        self.hits = {}                  # name --> number of fetches
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    def keys(self):
+        return self.index.keys()
+
+    def length(self, name):
+        return self.index[name].length
+
+    def _slice(self, e, start, end):
+        """ To get bases [start, end) of sequence e (a FaiEntry) from the mmap """
+
+        if start >= end:
+            return ""
+        offset = lambda pos: e.offset + pos // e.linebases * e.linewidth + pos % e.linebases
+        return self.mm[offset(start):offset(end - 1) + 1].translate(None, "\r\n")
+
+    def _cache(self, name, seq):
+        if len(seq) > self.cache_bases:
+            return
+        self.cache[name] = seq
+        self.cached_bases += len(seq)
+        while self.cached_bases > self.cache_bases:
+            k, v = self.cache.popitem(last=False)
+            self.cached_bases -= len(v)
+
+    def fetch(self, name, start=None, end=None):
+        """ To get bases [start, end) (0-based, end is not included) of sequence name
+
+        start, end: the same as python slicing, default is the whole sequence
+        """
+
+        seq = self.cache.pop(name, None)
+        if seq is not None:
+            self.cache[name] = seq      # move to the end as the most recently used
+            return seq[start:end]
+
+        try:
+            e = self.index[name]
+        except KeyError:
+            raise KeyError("sequence %s is not in %s" % (name, self.f))
+        start, end, step = slice(start, end).indices(e.length)
+
+        self.hits[name] = self.hits.get(name, 0) + 1
+        if self.hits[name] >= self.hot and e.length <= self.cache_bases:
+            seq = self._slice(e, 0, e.length)
+            self._cache(name, seq)
+            return seq[start:end]
+        return self._slice(e, start, end)
+
+    def fetch_region(self, region):
+        """ To get bases of a samtools-style region: "chr1", "chr1:1001-2000" (1-based, end is included) """
+
+        name, sep, pos = region.rpartition(":")
+        if not sep or name not in self.index:
+            return self.fetch(region)
+        start, sep, end = pos.replace(",", "").partition("-")
+        return self.fetch(name, int(start) - 1, int(end) if end else None)
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='To build .fai index of a fasta file, and print regions of it, like `samtools faidx`.')
+    parser.add_argument('fasta', help="uncompressed fasta file")
+    parser.add_argument('regions', nargs='*', metavar="region", help="chr, or chr:start-end (1-based, end is included)")
+
+    args = parser.parse_args()
+    fa = FastaIndex(args.fasta)
+    for region in args.regions:
+        seq = fa.fetch_region(region)
+        sys.stdout.write(">%s\n" % region)
+        for i in range(0, len(seq), 60):
+            sys.stdout.write(seq[i:i + 60] + "\n")
@@ -1,15 +1,42 @@
 #!/usr/bin/env python
 
+import os
 import time
-from functools import partial
-# import os.path
-# import numpy as np
+import mmap
+from functools import partial, reduce
+from itertools import islice
+from collections import namedtuple
+from contextlib import closing
+from multiprocessing import Pool
+from zopen import zopen
+
+try:
+    from cStringIO import StringIO
+except ImportError:     # python3, fasta_iter and fastq_iter are also used by biomart.py
+    from io import BytesIO as StringIO
+    basestring = str
+
+try:
+    import numpy as np
+except ImportError:     # numpy is only needed by fastq_batches/fasta_batches
+    np = None
 
 """
 functions to iter over .fasta and .fastq files. and I believe fasta_iter and fastq_iter are faster than many iterators available.
 
 created: long time ago
-last modified: 2014.01.26 - use partial to read blocks from file
+last modified: 2026.10.18 - fastq_offsets raises if the quality line of the last record is missing, instead of yielding
+                           the record with an empty quality
+               2026.10.18 - pad_strings fills the array with a bool mask (or a reshape if all lengths are the same), instead
+                           of int64 row/column indexes, which took 16 times the memory of the data
+               2026.10.18 - could be imported in python3, so fasta_iter could parse FASTA results of biomart.py
+               2026.10.18 - time iterating over files given in the command line, instead of ./sample/s2.fa which doesn't exist
+               2026.10.18 - add parallel_map, parallel_reduce and parallel_write to process chunks of records in a pool of processes
+               2026.10.18 - remove Fastq/Fasta classes which were commented out, alphabet_percycle is now in seqstats.py
+               2026.10.18 - add fastq_batches and fasta_batches to get batches of records as numpy arrays
+               2026.10.18 - add fastq_mmap_iter and fasta_mmap_iter to scan uncompressed files with mmap
+               2026.10.18 - open files with zopen(), so gzip files could also be used
+               2014.01.26 - use partial to read blocks from file
 """
 
 #-----------------------------------------------------------------------------
@@ -18,13 +45,13 @@ def fasta_iter(f, blocksize=int(1e7)):
     fasta generator
     a fasta record is a tuple of (name_line, seq)
 
-    f:         a file name or a file object
+    f:         a file name (could be gzip file) or a file object
     blocksize: the same as in file_block_iter
     """
 
     if isinstance(f, basestring):
-        fobj = open(f, 'r')
-    elif isinstance(f, file):
+        fobj = zopen(f, 'r')
+    elif hasattr(f, "readlines") and callable(f.readlines):
         fobj = f
     else:
         raise Exception("Invalid file: %s" % f)
@@ -48,15 +75,15 @@ def fastq_iter(f, blocksize=int(1e7)):
     fastq generator
     a fastq record is a list of 4 lines
 
-    f:         a file name or a file object
+    f:         a file name (could be gzip file) or a file object
     blocksize: the same as in file_block_iter
 
     Note: "\n" at the end of each line are retained.
     """
 
     if isinstance(f, basestring):
-        fobj = open(f, 'r')
-    elif isinstance(f, file):
+        fobj = zopen(f, 'r')
+    elif hasattr(f, "readlines") and callable(f.readlines):
         fobj = f
     else:
         raise Exception("Invalid file: %s" % f)
@@ -79,91 +106,370 @@ def fastq_iter(f, blocksize=int(1e7)):
             raise Exception("Error, the lines of the file should be 4*n!")
         yield lines_left
 
-# #-----------------------------------------------------------------------------
-# class Fastq:
-#     def __init__(self, f):
-#         if os.path.exists(f):
-#             self.f = f
-#         else:
-#             raise Exception("file %s doesn't exists" % f)
-#     def alphabet_frequency(self, baseonly=True):
-#         pass
-#     def alphabet_percycle(self, percent=False):
-#         results = []
-#         fq_generator = fastq_iter(self.f)
-#         # lines generated with fastq_iter have "\n" at the end, so use .strip() to remove it
-#         seqs = [fq[1].strip() for fq in islice(fq_generator, 0, 500000)] 
-#         while seqs:
-#             counts = izip_longest(*[[p.count(k) for k in "ATGCN"] for p in izip_longest(*seqs, fillvalue='')], fillvalue=0)
-#             results.extend(counts)
-#             seqs = [fq[1].strip() for fq in islice(fq_generator, 0, 500000)]
-# 
-#         results2 = np.array(list(izip_longest(*results, fillvalue=0)))
-#         m = results2.shape[0]
-#         n = len("ATGCN")
-#         counts = np.zeros((m, n), dtype=np.int)
-#         for i in range(n):
-#             counts[:,i] = results2[:,i::n].sum(axis=1)
-# 
-#         if percent:
-#             counts = counts*1.0/counts.sum(axis=1).reshape((counts.shape[0], 1))
-#         return counts
-# 
-#     def dinucleotide_frequency(self):
-#         pass
-# 
-#     def alphabet_percycle2(self, percent=False):
-#         def func(fq_item):
-#             seq = fq_item[1]
-#             return [seq.count(k) for k in "ATGCN"]
-#         return alphabet_percycle(fastq_iter(self.f), func, percent=percent)
-# 
-# 
-# #-----------------------------------------------------------------------------
-# class Fasta:
-#     def __init__(self, f):
-#         if os.path.exists(f):
-#             self.f = f
-#         else:
-#             raise Exception("file %s doesn't exists" % f)
-# 
-#     def fasta_iter(self):
-#         for fa in fasta_iter(self.f):
-#             yield fa
-# 
-#     def _alphabet_percycle(self, percent=False):
-#         seqs = [fa[1] for fa in fasta_iter(self.f)]
-#         counts = np.array([[p.count(k) for k in "ATGCN"] for p in izip_longest(*seqs, fillvalue='')])
-#         if percent:
-#             counts = counts*1.0/counts.sum(axis=1).reshape((counts.shape[0], 1))
-#         return counts
-# 
-#     def alphabet_percycle(self, percent=False):
-#         results = []
-#         fa_generator = fasta_iter(self.f)
-#         seqs = [fa[1] for fa in islice(fa_generator, 0, 500000)]
-#         while seqs:
-#             counts = izip_longest(*[[p.count(k) for k in "ATGCN"] for p in izip_longest(*seqs, fillvalue='')], fillvalue=0)
-#             results.extend(counts)
-#             seqs = [fa[1] for fa in islice(fa_generator, 0, 500000)]
-# 
-#         results2 = np.array(list(izip_longest(*results, fillvalue=0)))
-#         m = results2.shape[0]
-#         n = len("ATGCN")
-#         counts = np.zeros((m, n), dtype=np.int)
-#         for i in range(n):
-#             counts[:,i] = results2[:,i::n].sum(axis=1)
-# 
-#         if percent:
-#             counts = counts*1.0/counts.sum(axis=1).reshape((counts.shape[0], 1))
-#         return counts
+#-----------------------------------------------------------------------------
+# mmap-based scanners for uncompressed files: records are located by offsets in the memory-mapped file, and strings
+# are created only when a field is accessed, so no string is created for lines that are never used.
+
+def mmap_file(f):
+    """ memory-map a file (uncompressed) for reading, return None if the file is empty """
+
+    if f.endswith(".gz"):
+        raise Exception("Couldn't mmap gzip file: %s" % f)
+    with open(f, 'rb') as fobj:
+        if not os.fstat(fobj.fileno()).st_size:
+            return None
+        return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+def fastq_offsets(mm):
+    """
+    fastq record scanner
+    yield offsets of a fastq record in mm: (header_start, seq_start, plus_start, qual_start, end)
+
+    mm: a memory-mapped file, or a str
+
+    Note: offsets of all lines include "\n"; end is the start of the next record.
+    """
+
+    find, size = mm.find, len(mm)
+    start = 0
+    while start < size:
+        s = find("\n", start) + 1
+        p = find("\n", s) + 1
+        q = find("\n", p) + 1
+        end = find("\n", q) + 1
+        if not (s and p and q) or q >= size:    # the last record without quality line
+            raise Exception("Error, the lines of the file should be 4*n!")
+        if not end:     # the last quality line without "\n"
+            end = size
+        yield (start, s, p, q, end)
+        start = end
+
+def fasta_offsets(mm):
+    """
+    fasta record scanner
+    yield offsets of a fasta record in mm: (name_start, seq_start, end)
+
+    mm: a memory-mapped file, or a str
+    """
+
+    find, size = mm.find, len(mm)
+    start = find(">")
+    while 0 <= start < size:
+        s = find("\n", start) + 1 or size
+        end = find("\n>", s - 1) + 1 or size
+        yield (start, s, end)
+        start = end
+
+class FastqView(object):
+    """ a fastq record in a memory-mapped file, which could be used as a list of 4 lines as generated by fastq_iter()
+
+    .header, .seq, .plus, .qual: lines without "\n"
+    .raw:                        the whole record as a str
+    """
+
+    __slots__ = ('mm', 'offsets')
+
+    def __init__(self, mm, offsets):
+        self.mm = mm
+        self.offsets = offsets
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, i):
+        o = self.offsets
+        return self.mm[o[i]:o[i + 1]]
+
+    def __iter__(self):
+        o, mm = self.offsets, self.mm
+        return (mm[o[i]:o[i + 1]] for i in range(4))
+
+    @property
+    def header(self):
+        return self.mm[self.offsets[0]:self.offsets[1] - 1]
+
+    @property
+    def seq(self):
+        return self.mm[self.offsets[1]:self.offsets[2] - 1]
+
+    @property
+    def plus(self):
+        return self.mm[self.offsets[2]:self.offsets[3] - 1]
+
+    @property
+    def qual(self):
+        return self.mm[self.offsets[3]:self.offsets[4]].rstrip("\n")
+
+    @property
+    def raw(self):
+        return self.mm[self.offsets[0]:self.offsets[4]]
+
+class FastaView(object):
+    """ a fasta record in a memory-mapped file
+
+    .name: name line without "\n"
+    .seq:  sequence with line breaks removed
+    .raw:  the whole record as a str
+    """
+
+    __slots__ = ('mm', 'offsets')
+
+    def __init__(self, mm, offsets):
+        self.mm = mm
+        self.offsets = offsets
+
+    @property
+    def name(self):
+        return self.mm[self.offsets[0]:self.offsets[1]].rstrip("\n")
+
+    @property
+    def seq(self):
+        return self.mm[self.offsets[1]:self.offsets[2]].translate(None, "\r\n")
+
+    @property
+    def raw(self):
+        return self.mm[self.offsets[0]:self.offsets[2]]
+
+def fastq_mmap_iter(f):
+    """
+    fastq generator for uncompressed files, yield FastqView of every record
+
+    f: a file name
+    """
+
+    mm = mmap_file(f)
+    if mm is None:
+        return
+    for offsets in fastq_offsets(mm):
+        yield FastqView(mm, offsets)
+
+def fasta_mmap_iter(f):
+    """
+    fasta generator for uncompressed files, yield FastaView of every record
+
+    f: a file name
+    """
+
+    mm = mmap_file(f)
+    if mm is None:
+        return
+    for offsets in fasta_offsets(mm):
+        yield FastaView(mm, offsets)
+
+#-----------------------------------------------------------------------------
+# batches of records as numpy arrays, so whole batches could be processed by vectorized operations
+
+class RecordBatch(namedtuple('RecordBatch', 'headers header_offsets seqs quals lengths')):
+    """ a batch of fastq/fasta records
+
+    headers:        all header lines (without "\n") joined into one str
+    header_offsets: header of record i is headers[header_offsets[i]:header_offsets[i+1]]
+    seqs:           2D uint8 array of sequences, one row per record, padded with 0
+    quals:          2D uint8 array of quality strings, padded with 0 (None for fasta)
+    lengths:        length of every sequence
+    """
+
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def header(self, i):
+        return self.headers[self.header_offsets[i]:self.header_offsets[i + 1]]
+
+def pad_strings(strings, lengths):
+    """ To convert a list of str into a 2D uint8 array, with every str in a row, padded with 0 """
+
+    n = len(strings)
+    L = lengths.max() if n else 0
+    if not n:
+        return np.zeros((0, 0), dtype=np.uint8)
+    flat = np.frombuffer("".join(strings), dtype=np.uint8)
+    if lengths.min() == L:      # all of the same length, no padding is needed
+        return flat.reshape(n, L).copy()
+    out = np.zeros((n, L), dtype=np.uint8)
+    # a bool mask (1 byte per cell) of the cells to fill, which are in the same order as flat
+    out[np.arange(L) < lengths[:, None]] = flat
+    return out
+
+def make_batch(headers, seqs, quals=None):
+    """ To make a RecordBatch from lists of headers, seqs and quals (all without "\n") """
+
+    lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+    header_offsets = np.zeros(len(headers) + 1, dtype=np.int64)
+    header_offsets[1:] = np.cumsum([len(h) for h in headers])
+    return RecordBatch("".join(headers), header_offsets, pad_strings(seqs, lengths),
+                       None if quals is None else pad_strings(quals, lengths), lengths)
+
+def fastq_batches(f, n=int(1e6)):
+    """
+    fastq batch generator
+    yield a RecordBatch of (at most) n records each time
+
+    f: a file name (could be gzip file) or a file object
+    n: number of records in each batch
+    """
+
+    if np is None:
+        raise Exception("numpy is needed by fastq_batches")
+
+    records = fastq_iter(f)
+    while True:
+        block = list(islice(records, n))
+        if not block:
+            break
+        yield make_batch([rec[0].rstrip("\n") for rec in block],
+                         [rec[1].rstrip("\n") for rec in block],
+                         [rec[3].rstrip("\n") for rec in block])
+
+def fasta_batches(f, n=int(1e5)):
+    """
+    fasta batch generator
+    yield a RecordBatch of (at most) n records each time, .quals is None
+
+    f: a file name (could be gzip file) or a file object
+    n: number of records in each batch
+    """
+
+    if np is None:
+        raise Exception("numpy is needed by fasta_batches")
+
+    records = fasta_iter(f)
+    while True:
+        block = list(islice(records, n))
+        if not block:
+            break
+        yield make_batch([rec[0].rstrip("\n") for rec in block], [rec[1] for rec in block])
+
+#-----------------------------------------------------------------------------
+# parallel map/reduce over records of a file: uncompressed files are split into byte ranges aligned at the start of
+# records, which are read by the workers themselves; gzip files are read by the main process and sent to the workers
+# in chunks of records.
+
+def guess_format(f):
+    """ To guess if f is a 'fasta' or 'fastq' file by its extension, default is 'fastq' """
+
+    name = f[:-3] if f.endswith(".gz") else f
+    return "fasta" if name.endswith((".fa", ".fasta", ".fna", ".fas")) else "fastq"
+
+def is_record_start(lines, fmt):
+    """ To check if lines (at least 4 lines for fastq) start with a new record """
+
+    if fmt == "fasta":
+        return lines[0].startswith(">")
+    # a quality line may also start with '@', but it couldn't be followed by a sequence line and a '+' line
+    return (len(lines) >= 4 and lines[0].startswith("@") and lines[2].startswith("+")
+            and len(lines[1]) == len(lines[3]))
+
+def record_ranges(f, chunk_size=2 ** 26, fmt=None):
+    """ To split an uncompressed file into byte ranges of about chunk_size bytes, aligned at the start of records
+
+    return a list of (start, end)
+    """
+
+    fmt = fmt or guess_format(f)
+    size = os.path.getsize(f)
+    starts = [0]
+    with open(f, 'rb') as fobj:
+        for pos in range(chunk_size, size, chunk_size):
+            if pos <= starts[-1]:
+                continue
+            fobj.seek(pos - 1)
+            fobj.readline()         # skip the rest of the current line
+            offset, lines = fobj.tell(), [fobj.readline() for i in range(4)]
+            n = 0                   # a fastq record should be found in 4 lines, but a fasta record may have many lines
+            while lines[0]:
+                if is_record_start(lines, fmt):
+                    starts.append(offset)
+                    break
+                n += 1
+                if fmt == "fastq" and n > 4:
+                    raise Exception("Couldn't find the start of a fastq record around %d in %s" % (pos, f))
+                offset += len(lines.pop(0))
+                lines.append(fobj.readline())
+            else:
+                break               # no record starts before the end of the file, so none after later positions
+    starts.append(size)
+    return [(a, b) for a, b in zip(starts[:-1], starts[1:]) if a < b]
+
+def record_chunks(f, n_records=200000, fmt=None):
+    """ To read records of f (could be gzip file) in chunks of n_records records, yield a list of records each time """
+
+    records = (fasta_iter if (fmt or guess_format(f)) == "fasta" else fastq_iter)(f)
+    while True:
+        chunk = list(islice(records, n_records))
+        if not chunk:
+            break
+        yield chunk
+
+def run_chunk(args):
+    """ worker of parallel_map(): call func with records in a byte range of a file, or a list of records """
+
+    func, f, fmt, chunk = args
+    if f is None:
+        return func(iter(chunk))
+    start, end = chunk
+    with open(f, 'rb') as fobj:
+        fobj.seek(start)
+        data = StringIO(fobj.read(end - start))
+    return func(fasta_iter(data) if fmt == "fasta" else fastq_iter(data))
+
+def parallel_map(func, f, processes=None, fmt=None, chunk_size=2 ** 26, n_records=200000, ordered=True):
+    """ To call func on chunks of records of f in a pool of processes, and yield the results
+
+    func:       a function which accepts an iterator of records (as generated by fastq_iter/fasta_iter), should be
+                defined at the top level of a module, so it could be pickled
+    f:          a fastq/fasta file name (could be gzip file)
+    processes:  number of processes, default is the number of cpus
+    fmt:        'fastq' or 'fasta', default is guessed by the extension of f
+    chunk_size: number of bytes in each chunk for uncompressed files
+    n_records:  number of records in each chunk for gzip files
+    ordered:    to yield results in the order of chunks
+    """
+
+    fmt = fmt or guess_format(f)
+    if f.endswith(".gz"):
+        tasks = ((func, None, fmt, chunk) for chunk in record_chunks(f, n_records, fmt))
+    else:
+        tasks = ((func, f, fmt, chunk) for chunk in record_ranges(f, chunk_size, fmt))
+
+    pool = Pool(processes)
+    try:
+        for result in (pool.imap if ordered else pool.imap_unordered)(run_chunk, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def parallel_reduce(func, f, reducer, initial=None, **kwds):
+    """ To call func on chunks of records of f in a pool of processes, and merge the results by reducer
+
+    kwds: the same as in parallel_map()
+    """
+
+    results = parallel_map(func, f, ordered=False, **kwds)
+    return reduce(reducer, results) if initial is None else reduce(reducer, results, initial)
+
+def parallel_write(func, f, output, threads=1, **kwds):
+    """ To call func on chunks of records of f in a pool of processes, and write the results (str) to output in order
+
+    output: output file name (will be compressed if it ends with .gz)
+    kwds:   the same as in parallel_map()
+    """
+
+    with closing(zopen(output, 'w', threads=threads)) as fout:
+        for result in parallel_map(func, f, ordered=True, **kwds):
+            fout.write(result)
 
 #-----------------------------------------------------------------------------
 if __name__ == '__main__':
-    f = "./sample/s2.fa"
 
-    t = time.time()
-    for i,j in enumerate(fasta_iter(f, blocksize=int(1e7))):
-        pass
-    print i
-    print "fasta_iter", time.time() - t
+    # time iterating over fastq/fasta files, see benchmark.py for benchmarks on synthetic data
+    import sys
+
+    for f in sys.argv[1:]:
+        t = time.time()
+        iterator = fasta_iter if guess_format(f) == "fasta" else fastq_iter
+        n = sum(1 for rec in iterator(f))
+        sys.stdout.write("%s\t%s\t%d records\t%.3fs\n" % (f, iterator.__name__, n, time.time() - t))
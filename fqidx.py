@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import struct
+from array import array
+from hashlib import md5
+import numpy as np
+
+import intersect_fastq
+from fastx import mmap_file, fastq_offsets
+from zopen import zopen
+
+"""
+on-disk index of read IDs of (uncompressed) fastq files, so the same raw files could be intersected, searched or
+re-synchronised many times without parsing the sequence data again.
+
+The index is saved next to the fastq file (reads_1.fq --> reads_1.fq.idx), with the (packed) read ID of every record
+as an int64 key, sorted by the key, and the byte offset of every record:
+
+    magic "FQIDX001" | header2ID name (32 bytes) | n (uint64) | keys (int64 * n) | offsets (int64 * n) | flowcells
+
+flowcells are the "run:flowcell" strings interned by packed IDs (see intersect_fastq.pack_casava_ID), one per line, in
+the order of their indexes, so packed IDs of two indexes could be compared even if the flowcells are in different order.
+
+keys and offsets are read with numpy.memmap, so an index could be used without loading it into memory.
+
+IDs are generated by the packed header2ID_* functions in intersect_fastq.py if possible (packed IDs are >= 0); other
+IDs are hashed into 60 bits and stored as negative keys, so they are never taken as packed IDs, and records found by
+hashed keys are checked by their headers.
+
+usage: fqidx.py build fq_file [fq_file ...]
+       fqidx.py intersect fq1 fq2 out1 out2
+       fqidx.py extract fq_file ID_file output
+
+created: 2026.10.18
+last modified: 2026.10.18 - hashed keys are negative, so only packed keys have their flowcells remapped; flowcells of
+                            an index are collected in a table of its own instead of intersect_fastq.flowcells; text
+                            IDs given to extract() are packed with flowcells of the index; only header2ID_* functions
+                            of intersect_fastq could be used, and an index is rebuilt if it was built with another one
+"""
+
+#-----------------------------------------------------------------------------
+MAGIC = "FQIDX001"
+HEADER = struct.Struct("<8s32sQ")
+
+def detect_header2ID(fq, n=100):
+    """ To find the header2ID_* function in intersect_fastq that works for fq, using its packed version if available """
+
+    matched = intersect_fastq.matched_header2IDs(intersect_fastq.sample_headers(fq, n))
+    if not matched:
+        raise Exception("Couldn't recognize header format of %s" % fq)
+    return intersect_fastq.packed_header2ID(matched[0])
+
+def unpacked_header2ID(header2ID):
+    """ To get the header2ID_* function in intersect_fastq of which header2ID is the packed version, or header2ID itself """
+
+    name = header2ID.__name__
+    return getattr(intersect_fastq, name[:-len("_packed")]) if name.endswith("_packed") else header2ID
+
+def check_header2ID(header2ID):
+    """ To make sure header2ID is a header2ID_* function of intersect_fastq, so it could be found by its name saved in an index """
+
+    name = getattr(header2ID, '__name__', "")
+    if not (name.startswith("header2ID_") and len(name) <= 32 and getattr(intersect_fastq, name, None) is header2ID):
+        raise Exception("header2ID of an index should be one of header2ID_* functions in intersect_fastq, got %s" % (name or header2ID))
+    return name
+
+def read_header(idx):
+    """ To read (magic, header2ID name, number of reads) from index idx """
+
+    with open(idx, 'rb') as fobj:
+        magic, name, n = HEADER.unpack(fobj.read(HEADER.size))
+    if magic != MAGIC:
+        raise Exception("%s is not a valid index file" % idx)
+    return magic, name.rstrip("\0"), n
+
+def ID2key(ID):
+    """ To convert a read ID into an int64 key: packed IDs are used as they are, others are hashed into negative keys """
+
+    if isinstance(ID, (int, long)) and 0 <= ID < 2 ** 63:
+        return ID
+    return int(md5(str(ID)).hexdigest()[:15], 16) - 2 ** 63
+
+def build_index(fq, header2ID=None, idx=None):
+    """ To build the index of fq, and save it to idx (default is fq + ".idx")
+
+    header2ID: a header2ID_* function in intersect_fastq to extract read ID from header line, default is detected by
+               detect_header2ID()
+    """
+
+    header2ID = header2ID or detect_header2ID(fq)
+    name = check_header2ID(header2ID)
+    table = {}      # flowcells of this file, which are saved in the index
+    pack, unpacked = getattr(header2ID, 'pack', None), unpacked_header2ID(header2ID)
+    mm = mmap_file(fq)
+    keys, offsets = array('l'), array('l')
+    if mm is not None:
+        for o in fastq_offsets(mm):
+            header = mm[o[0]:o[1]]
+            keys.append(ID2key(header2ID(header) if pack is None else pack(unpacked(header), table)))
+            offsets.append(o[0])
+        mm.close()
+
+    keys, offsets = np.frombuffer(keys, dtype=np.int64), np.frombuffer(offsets, dtype=np.int64)
+    order = np.argsort(keys, kind="mergesort")      # stable, so duplicate keys are in the order of the file
+    with open(idx or fq + ".idx", 'wb') as fout:
+        fout.write(HEADER.pack(MAGIC, name, len(keys)))
+        fout.write(keys[order].tobytes())
+        fout.write(offsets[order].tobytes())
+        fout.write("\n".join(sorted(table, key=table.get)))
+
+def outdated(fq, idx):
+    """ To check whether index idx of fq doesn't exist or is older than fq """
+
+    return not os.path.exists(idx) or os.path.getmtime(idx) < os.path.getmtime(fq)
+
+class FastqIndex(object):
+    """ index of read IDs of a fastq file, built by build_index() if it doesn't exist, is older than the fastq file, or
+    was built with a header2ID other than the given one
+
+    .keys:      sorted keys of all reads
+    .offsets:   offsets of reads in the fastq file, in the same order as .keys
+    .flowcells: flowcells of packed IDs in keys
+    """
+
+    def __init__(self, fq, header2ID=None, rebuild=False):
+        self.fq = fq
+        self.idx = fq + ".idx"
+        if (rebuild or outdated(fq, self.idx) or
+                header2ID is not None and read_header(self.idx)[1] != check_header2ID(header2ID)):
+            build_index(fq, header2ID, self.idx)
+
+        magic, name, n = read_header(self.idx)
+        with open(self.idx, 'rb') as fobj:
+            fobj.seek(HEADER.size + 16 * n)
+            flowcells = fobj.read()
+        self.flowcells = flowcells.split("\n") if flowcells else []
+        self.header2ID = getattr(intersect_fastq, name)
+        # IDs not packed, used to check reads found by keys
+        self.unpacked_header2ID = unpacked_header2ID(self.header2ID)
+        # flowcell --> index, to pack IDs the same way as they are in keys
+        self.table = dict((fc, i) for i, fc in enumerate(self.flowcells))
+        if n:
+            self.keys = np.memmap(self.idx, dtype=np.int64, mode='r', offset=HEADER.size, shape=(n,))
+            self.offsets = np.memmap(self.idx, dtype=np.int64, mode='r', offset=HEADER.size + 8 * n, shape=(n,))
+        else:
+            self.keys = self.offsets = np.zeros(0, dtype=np.int64)
+        self.mm = mmap_file(fq)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def record_at(self, offset):
+        """ To get the record (a str of 4 lines) at offset """
+
+        end = offset
+        for i in range(4):
+            end = self.mm.find("\n", end) + 1 or len(self.mm)
+        return self.mm[offset:end]
+
+    def key(self, ID):
+        """ To get the key of read ID (as generated by self.unpacked_header2ID), packed with flowcells of the index """
+
+        pack = getattr(self.header2ID, 'pack', None)
+        return ID2key(ID if pack is None else pack(ID, self.table))
+
+    def get(self, ID):
+        """ To get records (a list of str) with read ID (as generated by self.unpacked_header2ID) """
+
+        key = self.key(ID)
+        lo, hi = np.searchsorted(self.keys, [key, key + 1])
+        records = [self.record_at(o) for o in self.offsets[lo:hi]]
+        # hashed keys may collide, so check the IDs
+        return [rec for rec in records if self.unpacked_header2ID(rec[:rec.index("\n") + 1]) == ID]
+
+    def other_keys(self, other):
+        """ To get keys of other (a FastqIndex), with flowcells of packed IDs changed to the indexes in self.flowcells """
+
+        keys = np.asarray(other.keys)
+        if not other.flowcells or other.flowcells == self.flowcells:
+            return keys
+        # flowcells not in self could never match, so they are changed to an unused index
+        unused = min(len(self.flowcells), 127)
+        table = np.array([self.flowcells.index(fc) if fc in self.flowcells else unused for fc in other.flowcells], dtype=np.int64)
+        fc = keys >> 56
+        packed = (keys >= 0) & (fc < len(other.flowcells))       # hashed keys are negative
+        keys = keys.copy()
+        keys[packed] = (keys[packed] & (2 ** 56 - 1)) | (table[fc[packed]] << 56)
+        return keys
+
+    def intersect(self, other):
+        """ To find reads in both self and other, return their offsets in self and other, sorted by offsets in self
+
+        Reads with the same key are paired in the order of the files, i.e. if a key is found m times in self and n times
+        in other, the first min(m, n) reads of it in each file are paired.
+        """
+
+        if self.header2ID is not other.header2ID:
+            raise Exception("Couldn't intersect indexes built with different header2ID: %s, %s" % (self.header2ID.__name__, other.header2ID.__name__))
+        if not (len(self) and len(other)):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys1 = np.asarray(self.keys)
+        keys2 = self.other_keys(other)
+        order2 = np.argsort(keys2, kind="mergesort")        # flowcells may be remapped, so keys2 need to be sorted again
+        keys2 = keys2[order2]
+        comm = np.intersect1d(keys1, keys2)
+        # ranges of every common key in keys1 and keys2, and number of pairs in each range
+        lo1, hi1 = np.searchsorted(keys1, comm, 'left'), np.searchsorted(keys1, comm, 'right')
+        lo2, hi2 = np.searchsorted(keys2, comm, 'left'), np.searchsorted(keys2, comm, 'right')
+        counts = np.minimum(hi1 - lo1, hi2 - lo2)
+        rank = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts, counts)
+        i = np.repeat(lo1, counts) + rank
+        j = order2[np.repeat(lo2, counts) + rank]
+        order = np.argsort(self.offsets[i])
+        return np.asarray(self.offsets[i][order]), np.asarray(other.offsets[j][order])
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+
+def intersect_indexed(fq1, fq2, out1, out2, header2ID=None, threads=1):
+    """ To get intersection of a pair of fastq files with their indexes, records are written in the order of fq1
+
+    return number of common records
+    """
+
+    idx1, idx2 = FastqIndex(fq1, header2ID), FastqIndex(fq2, header2ID)
+    offsets1, offsets2 = idx1.intersect(idx2)
+    fout1, fout2 = zopen(out1, 'w', threads=threads), zopen(out2, 'w', threads=threads)
+    ID1, ID2 = idx1.unpacked_header2ID, idx2.unpacked_header2ID
+    n = 0
+    for o1, o2 in zip(offsets1, offsets2):
+        rec1, rec2 = idx1.record_at(o1), idx2.record_at(o2)
+        # hashed keys may collide, so check the IDs
+        if ID1(rec1[:rec1.index("\n") + 1]) == ID2(rec2[:rec2.index("\n") + 1]):
+            fout1.write(rec1)
+            fout2.write(rec2)
+            n += 1
+    fout1.close()
+    fout2.close()
+    return n
+
+def extract(fq, IDs, output, header2ID=None):
+    """ To extract records with read IDs (header lines, or text IDs generated by the unpacked header2ID of the index) from fq, and write them to output
+
+    return number of records written
+    """
+
+    idx = FastqIndex(fq, header2ID)
+    fout = sys.stdout if output == '-' else zopen(output, 'w')
+    n = 0
+    for ID in IDs:
+        ID = ID.rstrip("\n")
+        if ID.startswith("@"):
+            ID = idx.unpacked_header2ID(ID + "\n")
+        for rec in idx.get(ID):
+            fout.write(rec)
+            n += 1
+    if fout is not sys.stdout:
+        fout.close()
+    return n
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='To build and use on-disk read ID indexes of fastq files.')
+    subparsers = parser.add_subparsers(dest="command")
+    p = subparsers.add_parser('build', help="build indexes")
+    p.add_argument('fq_files', nargs='+', metavar="fq_file", help="uncompressed fastq files")
+    p = subparsers.add_parser('intersect', help="get intersection of a pair of fastq files")
+    p.add_argument('fq1')
+    p.add_argument('fq2')
+    p.add_argument('out1', help="output of fq1 (will be compressed if it ends with .gz)")
+    p.add_argument('out2', help="output of fq2 (will be compressed if it ends with .gz)")
+    p = subparsers.add_parser('extract', help="extract reads by ID")
+    p.add_argument('fq')
+    p.add_argument('ID_file', help="header lines or IDs, one per line, '-' for stdin")
+    p.add_argument('output', help="output file, '-' for stdout")
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        for fq in args.fq_files:
+            build_index(fq)
+    elif args.command == 'intersect':
+        n = intersect_indexed(args.fq1, args.fq2, args.out1, args.out2)
+        sys.stderr.write("%d records in common\n" % n)
+    elif args.command == 'extract':
+        n = extract(args.fq, sys.stdin if args.ID_file == '-' else open(args.ID_file), args.output)
+        sys.stderr.write("%d records extracted\n" % n)
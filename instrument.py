@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import resource
+from time import time, strftime
+from threading import Thread, Event
+
+"""
+lightweight in-process instrumentation for long runs: timestamps without calling `date` in a shell, number of records
+and bytes processed by every stage with their rates, time spent by every stage, peak memory (RSS), periodic progress
+reports, and statistics saved as JSON at the end.
+
+    >>> stats = RunStats("intersect_fastq")
+    >>> read = stats.stage("read fq1")
+    >>> ...                       # read.records += n; read.bytes += size; read.busy += seconds
+    >>> stats.start_progress(60)  # report progress to stderr every 60 seconds
+    >>> ...
+    >>> stats.stop_progress()
+    >>> stats.report()            # one line for every stage, and peak RSS
+    >>> stats.save("stats.json")
+
+created: 2026.10.18
+"""
+
+#-----------------------------------------------------------------------------
+def date():
+    """ current local time in the same format as output of `date`, e.g. "Sun Oct 18 05:31:29 UTC 2026" """
+
+    return strftime("%a %b %d %H:%M:%S %Z %Y")
+
+def peak_rss():
+    """ peak resident set size (in MB) of this process and of its finished child processes """
+
+    # ru_maxrss is in KB on Linux, and in bytes on Mac OS X
+    scale = 2.0 ** 20 if sys.platform == "darwin" else 2.0 ** 10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+#-----------------------------------------------------------------------------
+class StageCounter(object):
+    """ number of records and bytes processed by a stage, and time spent by it
+
+    busy: time spent on processing by the stage itself
+    wait: time the other stages were blocked by this stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.records = self.bytes = 0
+        self.busy = self.wait = 0.0
+
+    def rates(self, seconds=None):
+        """ records/s and MB/s in `seconds`, default is the busy time of the stage """
+
+        seconds = seconds or self.busy or 1e-9
+        return self.records / seconds, self.bytes / 1e6 / seconds
+
+    def report(self):
+        records_rate, mb_rate = self.rates()
+        return "%s: %.2f M records, %.1f MB in %.1fs (%.0f records/s, %.1f MB/s), waited for %.1fs" % (
+                self.name, self.records/1e6, self.bytes/1e6, self.busy, records_rate, mb_rate, self.wait)
+
+    def as_dict(self):
+        records_rate, mb_rate = self.rates()
+        return {"name": self.name, "records": self.records, "bytes": self.bytes, "busy": round(self.busy, 3),
+                "wait": round(self.wait, 3), "records_per_s": round(records_rate, 1), "MB_per_s": round(mb_rate, 3)}
+
+class RunStats(object):
+    """ statistics of a run: a StageCounter for every stage, and other values to report (e.g. number of pairs)
+
+    name:  name of the run, e.g. name of the program
+    write: function to write reports, default is sys.stderr.write
+    """
+
+    def __init__(self, name, write=None):
+        self.name = name
+        self.write = write or sys.stderr.write
+        self.stages = []
+        self.values = {}
+        self.t0 = time()
+        self._stop = None
+
+    def stage(self, name):
+        """ To add a stage and return its StageCounter """
+
+        counter = StageCounter(name)
+        self.stages.append(counter)
+        return counter
+
+    def __getitem__(self, name):
+        for counter in self.stages:
+            if counter.name == name:
+                return counter
+        raise KeyError(name)
+
+    def elapsed(self):
+        return time() - self.t0
+
+    def progress(self):
+        """ one line of progress: records processed by every stage and their rates since the start of the run """
+
+        elapsed = self.elapsed()
+        stages = ", ".join("%s %.2f M (%.0f/s)" % (c.name, c.records/1e6, c.rates(elapsed)[0]) for c in self.stages)
+        return "[%s] %s: %.0fs elapsed, %s, peak RSS %.1f MB\n" % (date(), self.name, elapsed, stages, peak_rss()[0])
+
+    def start_progress(self, interval=60):
+        """ To write progress every `interval` seconds in a background thread, until stop_progress() is called """
+
+        if self._stop is not None or not interval:
+            return
+        self._stop = Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                self.write(self.progress())
+
+        thread = Thread(target=run, args=(self._stop,))
+        thread.daemon = True
+        thread.start()
+
+    def stop_progress(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def report(self):
+        """ To write one line for every stage, total time and peak RSS """
+
+        for counter in self.stages:
+            self.write("[%s] %s\n" % (date(), counter.report()))
+        rss, children = peak_rss()
+        self.write("[%s] %s: %.1fs in total, peak RSS %.1f MB (child processes: %.1f MB)\n" % (date(), self.name, self.elapsed(), rss, children))
+
+    def as_dict(self):
+        rss, children = peak_rss()
+        d = {"name": self.name, "elapsed": round(self.elapsed(), 3), "peak_rss_MB": round(rss, 1),
+             "children_peak_rss_MB": round(children, 1), "stages": [c.as_dict() for c in self.stages]}
+        d.update(self.values)
+        return d
+
+    def save(self, f):
+        """ To write statistics as JSON to file f ('-' for stdout) """
+
+        fout = sys.stdout if f == '-' else open(f, 'w')
+        json.dump(self.as_dict(), fout, indent=2, sort_keys=True)
+        fout.write("\n")
+        if fout is not sys.stdout:
+            fout.close()
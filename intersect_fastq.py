@@ -1,22 +1,30 @@
 #!/novo/users/jfgx/local/bin/python
 import sys
 import re
-import gzip
 import sqlite3
 import os.path as path
-from os import makedirs
-from subprocess import check_output
-from multiprocessing import Process
-from itertools import islice, izip
+from os import makedirs, remove
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from functools import partial
+from zopen import zopen
+from instrument import date, RunStats
+from time import time
+from threading import Thread
+from Queue import Queue
+from itertools import islice, izip, izip_longest, chain, imap
+from collections import OrderedDict
 
 """
 function: fastx toolkit couldn't do trimming or filtering on paired-end reads,
           so we can use fastx to do trimming, clipping or filtering on separate
           file, and then use this script to extract fastq records common in both files.
 usage: intersect_fastqsqlite3_guess.py [-h]
-                                       [-f {guess,infer,custom,illumina,AROS,illumina_old}]
+                                       [-f {guess,infer,custom,illumina,AROS,illumina_old}] [-k/--packed_ID]
                                        [-o output_dir] [-p prefix] [-F/--force_overwrite] [-z/--gzip]
-                                       [-m/--multiprocessing]
+                                       [-m/--multiprocessing] [-t N] [-e {auto,hash,merge,partition,sqlite}] [-s/--assume-sorted]
+                                       [-n N] [-M MB] [-T tmp_dir] [--no_pipeline] [-O/--orphans]
+                                       [-P SECONDS] [-S stats_file]
                                        fq_file fq_file
 
 To get intersection of a pair of fastq files that have been filtered
@@ -30,6 +38,9 @@ optional arguments:
   -f {guess,infer,custom,illumina,AROS,illumina_old}, --header_format {guess,infer,custom,illumina,AROS,illumina_old}
                         header line format of the fastq file, default is
                         'guess'
+  -k, --packed_ID       pack lane, tile, x and y of read IDs into integers to
+                        save memory, only for 'illumina', 'illumina_new' and
+                        'AROS' header formats. Default is 'False'.
   -o output_dir, --output_dir output_dir
                         directory of the output files
   -p prefix, --prefix prefix
@@ -41,13 +52,78 @@ optional arguments:
                         is 'False'.
   -z, --gzip            output file in gzip format. Default is 'True'.
   -m, --multi_processing
-                        to use multiprocessing to speed up the writing of
-                        output files. Default if 'False'. Note: 1) if you
-                        submit job with PBS, you may need to assign ncpus=3
-                        for every job; 2) multi_processing could only help if
-                        the output is in .gzip format.
+                        deprecated, the same as '--threads 2'.
+  -t N, --threads N     number of threads to compress each output file, only
+                        used if the output is in .gzip format. pigz will be
+                        used if it is available. Note: if you submit job with
+                        PBS, you may need to assign ncpus=2*N+1 for every
+                        job. Default is 1.
+  -e {auto,hash,merge,partition,sqlite}, --engine {auto,hash,merge,partition,sqlite}
+                        engine to find the intersection. 'hash' keeps only
+                        unmatched records in memory and writes each pair as
+                        soon as both reads are read; 'merge' walks both files
+                        in lockstep with constant memory, assuming reads in
+                        both files are in the same order, and falls back to
+                        'hash' if not; 'partition' splits both files into
+                        bucket files on disk and processes them bucket by
+                        bucket, for files too large to fit in memory;
+                        'sqlite' is the old engine using an
+                        in-memory sqlite3 database; 'auto' will use 'merge' if
+                        the first reads of both files are in the same order,
+                        and 'hash' otherwise. Default is 'auto'.
+  -s, --assume-sorted   reads in both files are in the same order, the same
+                        as '--engine merge'.
+  -n N, --partitions N  number of bucket files for each input used by
+                        '--engine partition'. Default is 64.
+  -M MB, --memory MB    max memory (in MB) used to find common records in a
+                        pair of buckets by '--engine partition', larger
+                        buckets will be partitioned again. Default is 2048.
+  -T tmp_dir, --tmp_dir tmp_dir
+                        directory for the bucket files used by '--engine
+                        partition' and records spilled by '--engine merge', a
+                        local disk is preferred. Default is the system temp
+                        directory.
+  --no_pipeline         not to read, join and write in different threads.
+                        Default is to use the pipeline.
+  -O, --orphans         also output records without mates to
+                        prefix_1.orphan.fq and prefix_2.orphan.fq (with .gz
+                        if --gzip), not supported by '--engine sqlite'.
+                        Default is 'False'.
+  -P SECONDS, --progress SECONDS
+                        interval (in seconds) to report progress, 0 not to
+                        report. Default is 60.
+  -S stats_file, --stats stats_file
+                        save statistics of the run (records, throughput and
+                        time of every stage, peak RSS) to stats_file as JSON.
 
 last modified:
+    2026.10.18 -- add tests of the hash, merge and partition engines (test_join_engines() and test_intersect_fastq()).
+    2026.10.18 -- rank matched header2ID_* functions by how specific their patterns are (illumina_new before AROS,
+                  illumina_old only if nothing else matches), timing only functions giving the same IDs; inferred
+                  functions slice at a fixed offset only if there is no number between the indicator and the start (or
+                  the end) of the header line.
+    2026.10.18 -- pack_casava_ID()/pack_illumina_ID() take a table of flowcells, and are the .pack of header2ID_*_packed,
+                  so IDs could be packed with flowcells other than the global ones (e.g. those of an index).
+    2026.10.18 -- merge engine spills records pushed out of its window to temporary files and joins them again at the
+                  end, so mates arriving more than `window` records late are not written as orphans.
+    2026.10.18 -- get timestamps with time.strftime instead of calling `date` in a shell, count records, bytes and time of
+                  every stage with instrument.RunStats (also without the pipeline), report peak RSS and progress
+                  (--progress), and save statistics as JSON (--stats).
+    2026.10.18 -- detect header format from header lines read only once (the first 100 records were only checked against
+                  the first candidate format), use the fastest of the matched header2ID_* functions, and make
+                  infer_header_format() return a function slicing the header line if possible.
+    2026.10.18 -- add --orphans to write records without mates to prefix_1.orphan.fq and prefix_2.orphan.fq as they are
+                  found by the join engines (not supported by sqlite engine), and report numbers of pairs and orphans.
+    2026.10.18 -- read fq1/fq2 and write output files in background threads (pipe_reader, QueueWriter), with bounded
+                  queues, and report throughput of every stage. Add --no_pipeline.
+    2026.10.18 -- read and write gzip files with zopen(), which decompresses/compresses in other threads or a pigz process,
+                  add --threads, and --multi_processing is deprecated.
+    2026.10.18 -- add packed IDs (header2ID_*_packed, --packed_ID) to store read IDs as integers.
+    2026.10.18 -- add partition engine (join_partition) to spill records into bucket files on disk, with --partitions,
+                  --memory and --tmp_dir.
+    2026.10.18 -- add merge engine (join_merge) and --assume-sorted for files keeping the order of reads, and make
+                  --engine default to 'auto'.
+    2026.10.18 -- add --engine, and use a hash join (join_hash) by default instead of joining all records left in sqlite3 for every batch.
     2014.7.9  -- add new format support for new illumin header format (the same with header2ID_AROS)
                  fix a small bug when the input fastq files are blank.
     2013.9.29 -- make --gzip default to True
@@ -66,27 +142,18 @@ last modified:
 DEBUG = False
 
 stderr_write = sys.stderr.write
-#-------------------------------------------------
-def date():
-    """ get output of `date` by calling shell"""
-
-    return check_output("date", shell=True).rstrip()
-
 #-------------------------------------------------
 def fastq_iter(f, buffsize=int(1e5)):
     """
     fastq generator
     a fastq record is a list of 4 lines
 
-    f:        a file name or a file-like object(should have .readline(); both generated by open() or gzip.open() will work)
+    f:        a file name or a file-like object(should have .readline(); both generated by open() or zopen() will work)
     buffsize: number of lines to read in each chunk
     """
 
     if isinstance(f, basestring):
-        if f.endswith(".gz"):
-            fobj = gzip.open(f, 'rb')
-        else:
-            fobj = open(f, 'r')
+        fobj = zopen(f, 'r')     # gzip file will be decompressed in another thread or process
     elif hasattr(f, "readline") and callable(f.readline):
         fobj = f
     else:
@@ -104,6 +171,113 @@ def fastq_iter(f, buffsize=int(1e5)):
         else:
             break
 
+#-------------------------------------------------
+# pipeline: fq1 and fq2 are read (and decompressed) in reader threads, and the output files are written (and compressed)
+# in writer threads, so reading, joining and writing could run at the same time. The queues between stages are bounded,
+# so a fast stage will wait for a slow one instead of using more and more memory.
+# Every stage counts its records, bytes and time with an instrument.StageCounter.
+
+def count_reader(fq_iter, counter, N_size=10000):
+    """ fastq generator, the same as fq_iter, with records, bytes and time counted by counter, used without the pipeline """
+
+    while True:
+        t = time()
+        records = list(islice(fq_iter, N_size))
+        counter.busy += time() - t
+        if not records:
+            break
+        counter.records += len(records)
+        counter.bytes += sum(imap(len, chain.from_iterable(records)))
+        for record in records:
+            yield record
+
+def pipe_reader(fq_iter, counter, N_size=10000, maxsize=64):
+    """ fastq generator, with records read from fq_iter by a background thread, in chunks of N_size records
+
+    fq_iter: fastq record iterator, as generated by fastq_iter()
+    counter: a StageCounter
+    maxsize: max number of chunks read ahead
+    """
+
+    queue = Queue(maxsize)
+
+    def read():
+        try:
+            while True:
+                t = time()
+                records = list(islice(fq_iter, N_size))
+                counter.busy += time() - t
+                counter.records += len(records)
+                counter.bytes += sum(imap(len, chain.from_iterable(records)))
+                queue.put(records)
+                if not records:
+                    break
+        except Exception as e:
+            queue.put(e)
+
+    thread = Thread(target=read)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        t = time()
+        records = queue.get()
+        counter.wait += time() - t
+        if isinstance(records, Exception):
+            raise records
+        if not records:
+            break
+        for record in records:
+            yield record
+
+class QueueWriter(object):
+    """ file-like object, with data passed through a bounded queue and written to fobj by a background thread
+
+    fobj:    file object to write data
+    counter: a StageCounter
+    maxsize: max number of writes waiting in the queue
+    """
+
+    def __init__(self, fobj, counter, maxsize=64):
+        self.fobj = fobj
+        self.counter = counter
+        self.error = None
+        self.queue = Queue(maxsize)
+        self.thread = Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        counter = self.counter
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error:  # drain the queue, so write() will not block
+                continue
+            try:
+                t = time()
+                self.fobj.write(data)
+                counter.busy += time() - t
+                counter.bytes += len(data)
+                counter.records += data.count("\n") // 4
+            except Exception as e:
+                self.error = e
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        t = time()
+        self.queue.put(data)
+        self.counter.wait += time() - t
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fobj.close()
+        if self.error:
+            raise self.error
+
 #-------------------------------------------------
 # NOTE: every time add new header format, should also add re patterns to be used for checking in guess_header_format()
 
@@ -223,10 +397,164 @@ def header2ID_custom(header_line):
 
     raise Exception("Function header2ID_custom not implemented.")
 
+#-------------------------------------------------
+# packed IDs: lane, tile, x and y of a read (and run/flowcell) are packed into an integer, which takes much less
+# memory than a string ID, and is faster to hash and compare. Use packed_header2ID() to get the packed version
+# of a header2ID_* function, whose .pack(ID, table) packs an ID extracted by the unpacked version with a table of
+# flowcells of its own.
+
+flowcells = {}      # "run:flowcell" --> index, so every flowcell is stored only once
+
+def pack_ID(lane, tile, x, y, flowcell=0):
+    """ To pack flowcell index, lane, tile, x and y of a read into an integer of 63 bits.
+
+    bits: flowcell(7) | lane(4) | tile(16) | x(18) | y(18)
+
+    Return None if any field is too large to be packed.
+    """
+
+    if flowcell < 128 and lane < 16 and tile < 65536 and x < 262144 and y < 262144:
+        return ((((flowcell << 4 | lane) << 16 | tile) << 18 | x) << 18) | y
+    return None
+
+def unpack_ID(ID):
+    """ To unpack an integer generated by pack_ID() into (flowcell, lane, tile, x, y) """
+
+    return (ID >> 56, ID >> 52 & 0xF, ID >> 36 & 0xFFFF, ID >> 18 & 0x3FFFF, ID & 0x3FFFF)
+
+def pack_illumina_ID(ID, table=None):
+    """ To pack ID like "lane:tile:x:y" into an integer, return ID itself if it couldn't be packed
+
+    table is not used as there is no flowcell in ID, it is here so all .pack functions could be called in the same way.
+    """
+
+    lane, tile, x, y = ID.split(':')
+    packed = pack_ID(int(lane), int(tile), int(x), int(y))
+    return ID if packed is None else packed
+
+def pack_casava_ID(ID, table=None):
+    """ To pack ID like "[instrument:]run:flowcell:lane:tile:x:y" into an integer, return ID itself if it couldn't be packed
+
+    table: "[instrument:]run:flowcell" --> index, new flowcells are added to it, default is the global flowcells
+    """
+
+    table = flowcells if table is None else table
+    flowcell, lane, tile, x, y = ID.rsplit(':', 4)
+    idx = table.get(flowcell)
+    if idx is None:
+        idx = table.setdefault(flowcell, len(table))
+    packed = pack_ID(int(lane), int(tile), int(x), int(y), idx)
+    return ID if packed is None else packed
+
+def header2ID_illumina_packed(header_line):
+    """ The same as header2ID_illumina, but lane, tile, x and y are packed into an integer by pack_ID().
+
+    example:
+        "@FCD0R5AACXX:6:1101:2436:2161#CGATGTAT/1" --> pack_ID(6, 1101, 2436, 2161)
+    """
+
+    return pack_illumina_ID(header2ID_illumina(header_line))
+header2ID_illumina.packed = header2ID_illumina_packed
+header2ID_illumina_packed.pack = pack_illumina_ID
+
+def header2ID_illumina_new_packed(header_line):
+    """ The same as header2ID_illumina_new, but run/flowcell, lane, tile, x and y are packed into an integer by pack_casava_ID().
+
+    example:
+        "@HISEQ02:4:C4LU6ACXX:8:1101:1249:2231 1:N:0:ATCACG" --> pack_ID(8, 1101, 1249, 2231, flowcells["4:C4LU6ACXX"])
+    """
+
+    return pack_casava_ID(header_line.split(' ')[0].partition(':')[-1])
+header2ID_illumina_new.packed = header2ID_illumina_new_packed
+header2ID_illumina_new_packed.pack = pack_casava_ID
+
+def header2ID_AROS_packed(header_line):
+    """ The same as header2ID_AROS, but instrument/run/flowcell, lane, tile, x and y are packed into an integer by pack_casava_ID().
+
+    example:
+        "@HWI-ST301L:301:C1BRBACXX:3:1101:1765:2207 1:N:0:CGATGT" --> pack_ID(3, 1101, 1765, 2207, flowcells["@HWI-ST301L:301:C1BRBACXX"])
+    """
+
+    return pack_casava_ID(header_line.split()[0])
+header2ID_AROS.packed = header2ID_AROS_packed
+header2ID_AROS_packed.pack = pack_casava_ID
+
+def packed_header2ID(header2ID):
+    """ To get the packed version of a header2ID_* function, or header2ID itself if it has no packed version """
+
+    return getattr(header2ID, 'packed', header2ID)
+
+def sample_headers(fq, n=100):
+    """ To read header lines of the first n records of fq, so a file is read only once to detect the header format """
+
+    with zopen(fq, 'r') as fobj:
+        return [rec[0] for rec in islice(fastq_iter(fobj), n)]
+
+def time_header2ID(header2ID, headers, repeat=10):
+    """ To get time (in seconds) used by header2ID to extract IDs from headers for `repeat` times """
+
+    t = time()
+    for i in range(repeat):
+        for header in headers:
+            header2ID(header)
+    return time() - t
+
+# header2ID_* functions with .p1 and .p2 patterns, the most specific pattern first. Functions not in the list come after
+# them, and header2ID_illumina_old, whose patterns match any header line ending with /1 or /2, is only used if no
+# other function matches.
+header2ID_specificity = [header2ID_illumina_new, header2ID_illumina, header2ID_AROS]
+
+def rank_header2ID(header2ID):
+    """ To get the rank of header2ID in header2ID_specificity, functions with a packed version first if not in the list """
+
+    if header2ID in header2ID_specificity:
+        return (header2ID_specificity.index(header2ID), 0)
+    return (len(header2ID_specificity), 0 if hasattr(header2ID, 'packed') else 1)
+
+def matched_header2IDs(headers1, headers2=None):
+    """ To find all header2ID_* functions whose .p1 and .p2 patterns match the header lines, the most specific first
+
+    headers1, headers2: header lines of read1 and read2 (in either order), as read by sample_headers().
+                        If headers2 is None, headers1 could be header lines of either read1 or read2.
+
+    Return a list of header2ID_* functions, sorted by rank_header2ID(). header2ID_illumina_old is dropped if any other
+    function matches. Functions giving the same IDs from the header lines are ranked together, the fastest first.
+    """
+
+    def match(p, headers):
+        return all(p.match(h) for h in headers)
+
+    matched = []
+    for k, v in sorted(globals().items()):    # all header2ID_* functions with .p1 and .p2 attributes matching headers of read1/2
+        if not (k.startswith('header2ID_') and callable(v) and hasattr(v, 'p1') and hasattr(v, 'p2')):
+            continue
+        p1, p2 = v.p1, v.p2
+        if headers2 is None:
+            ok = match(p1, headers1) or match(p2, headers1)
+        else:
+            ok = (match(p1, headers1) and match(p2, headers2)) or (match(p2, headers1) and match(p1, headers2))
+        # reads from the same file should have different IDs
+        if ok and len(set(imap(v, headers1))) == len(headers1):
+            matched.append(v)
+
+    if len(matched) > 1 and header2ID_illumina_old in matched:
+        matched.remove(header2ID_illumina_old)
+
+    headers = headers1 + (headers2 or [])
+    IDs = dict((f, [f(h) for h in headers]) for f in matched)
+    ranked = []
+    for f in sorted(matched, key=rank_header2ID):
+        if f not in ranked:
+            same = [g for g in matched if IDs[g] == IDs[f]]
+            ranked.extend(sorted(same, key=lambda g: (time_header2ID(g, headers), rank_header2ID(g))))
+    return ranked
+
 def guess_header_format(fq1, fq2):
     """ To *guess* the format of the header line and return a function to extract ID.
 
-    Note: in most cases, you should not use this function as this function is very conservative and not efficient!!
+    The first 100 header lines of fq1 and fq2 are checked against patterns of all header2ID_* functions, and the
+    most specific one of those matched is used (see matched_header2IDs()). If none of them matches,
+    infer_header_format() will be used.
 
     Input:
         fq1: fqstq file one
@@ -238,87 +566,534 @@ def guess_header_format(fq1, fq2):
     """
 
     # look at the first 100 records
-    records1 = islice(fastq_iter(fq1), 100)
-    records2 = islice(fastq_iter(fq2), 100)
+    headers1, headers2 = sample_headers(fq1), sample_headers(fq2)
 
-    if (not records1) or (not records2):
+    if (not headers1) or (not headers2):
         stderr_write("[%s] Input fastq records are blank! Will exit.\n" % date())
         sys.exit()
 
     # first check if currently available read ID extraction functions could work with the data.
-
-    # currently only header2ID_illumina and header2ID_AROS are available for checking. header2ID_illumina_old is deprecated. 
-    for k,v in globals().items():    # iter over all header2ID_* functions, which already have .p1 and .p2 attributes matching headers of read1/2
-        if k.startswith('header2ID_') and callable(v) and hasattr(v, 'p1') and hasattr(v, 'p2'):
-            stderr_write("[%s] checking %s ... " % (date(), k))
-            p1, p2 = v.p1, v.p2
-            if ((all(re.search(p1, rec[0]) for rec in records1) and all(re.search(p2, rec[0]) for rec in records2)) or 
-                (all(re.search(p2, rec[0]) for rec in records1) and all(re.search(p1, rec[0]) for rec in records2))):
-                stderr_write("Yes!\n")
-                return v
-            else:
-                stderr_write("No.\n")
+    matched = matched_header2IDs(headers1, headers2)
+    if matched:
+        stderr_write("[%s] header format: %s (matched: %s)\n" % (date(), matched[0].__name__, ", ".join(f.__name__ for f in matched)))
+        return matched[0]
 
     stderr_write("[%s] couldn't recognize header format, will try to infer.\n" % date())
     stderr_write("[%s] YOU SHOULD PAY ATTENTION TO THE HEADER FORMAT.\n" % date())
 
     # if currently available header2ID_* functions don't work, will try to infer the format of header line:
-    return infer_header_format(fq1, fq2)
+    return infer_header2ID(headers1, headers2, fq1, fq2)
 
 def infer_header_format(fq1, fq2):
     """
     infer the header line format and return a function to extract read ID from header line
-    This function is (very likely to be) reliable but conservative, and might be slow. Use with caution.
+    This function is (very likely to be) reliable but conservative. Use with caution.
     """
 
     # look at the first 100 records
-    records1 = islice(fastq_iter(fq1), 100)
-    records2 = islice(fastq_iter(fq2), 100)
+    return infer_header2ID(sample_headers(fq1), sample_headers(fq2), fq1, fq2)
+
+def infer_header2ID(headers1, headers2, fq1="fq1", fq2="fq2"):
+    """ To infer the header line format from header lines of read1 and read2, and return a function to extract read ID,
+    which is the header line without the "1" or "2" indicating read1 or read2.
+
+    headers1, headers2: header lines of fq1 and fq2, as read by sample_headers()
+    fq1, fq2: names of the files, only used in error messages
+
+    Note: if the indicator is always at the same position counted from the start or the end of the header line, or
+          just after the same separator, the returned function only slices the header line. A position is only used
+          if there is no number between it and the start (or the end), as a number may have more digits in later
+          records than in the header lines sampled.
+    """
+
+    if (not headers1) or (not headers2):
+        raise Exception("header lines of %s or %s are blank" % (fq1, fq2))
 
     # '@HWI-ST301L:301:C1BRBACXX:3:1101:1765:2207 1:N:0:CGATGT' --> 
     #       ['@HWI-ST', '301', 'L:', '301', ':C', '1', 'BRBACXX:', '3', ':', '1101', ':', '1765', ':', '2207', ' ', '1', ':N:', '0', ':CGATGT']
     p = re.compile('([0-9]+)')
-    headers1 = [re.split(p, rec[0]) for rec in records1]
-    headers2 = [re.split(p, rec[0]) for rec in records2]
+    items1 = [p.split(h) for h in headers1]
+    items2 = [p.split(h) for h in headers2]
 
     # get length of items in each header line
-    L1, L2 = len(headers1[0]), len(headers2[0])
+    L1, L2 = len(items1[0]), len(items2[0])
     # check if all headers have same number of items
-    if not all(len(row) == L1 for row in headers1):
-        raise Exception("header lines in %s have different length" % fq1)
-    if not all(len(row) == L2 for row in headers2):
+    if not all(len(row) == L1 for row in items1):
         raise Exception("header lines in %s have different length" % fq1)
+    if not all(len(row) == L2 for row in items2):
+        raise Exception("header lines in %s have different length" % fq2)
     if L1 != L2:
         raise Exception("header lines in %s and %s have different length" % (fq1, fq2))
 
-    idx1 = [ i for i in range(L1) if (all(row[i] == '1' for row in headers1) or all(row[i] == '2' for row in headers1))]
-    idx2 = [ i for i in range(L2) if (all(row[i] == '1' for row in headers2) or all(row[i] == '2' for row in headers2))]
+    idx1 = [ i for i in range(L1) if (all(row[i] == '1' for row in items1) or all(row[i] == '2' for row in items1))]
+    idx2 = [ i for i in range(L2) if (all(row[i] == '1' for row in items2) or all(row[i] == '2' for row in items2))]
 
     if idx1 != idx2:
         raise Exception("header lines in %s and %s have different pattern" % (fq1, fq2))
 
-    # if int(headers1[0][i]) * int(headers2[0][i]) == 2 means headers1[0][i] and headers2[0][i] == (1,2) or (2,1)
-    idx = [i for i in idx1 if int(headers1[0][i]) * int(headers2[0][i]) == 2]
+    # if int(items1[0][i]) * int(items2[0][i]) == 2 means items1[0][i] and items2[0][i] == (1,2) or (2,1)
+    idx = [i for i in idx1 if int(items1[0][i]) * int(items2[0][i]) == 2]
     if len(idx) != 1:
         raise Exception("Couldn't guess the format of the header line. You'd better modify the script to write your own header2ID_custom function")
 
     # we have to remove the indicator "1" or "2" in the final result
     idx_rm = idx[0]
 
-    return lambda line: "".join(item for (i, item) in enumerate(re.split(p, line)) if i != idx_rm)
+    def header2ID_inferred_re(line):
+        return "".join(item for (i, item) in enumerate(p.split(line)) if i != idx_rm)
+
+    # position of the indicator in every header line, counted from the start and from the end
+    rows = items1 + items2
+    starts = set(len("".join(row[:idx_rm])) for row in rows)
+    ends = set(len("".join(row[idx_rm + 1:])) for row in rows)
+    seps = set(row[idx_rm - 1] for row in rows)     # the separator just before the indicator, e.g. "/" or " "
+    # numbers are items of odd indexes
+    digits_before = idx_rm > 1
+    digits_after = idx_rm + 2 < L1
+
+    candidates = []
+    if len(starts) == 1 and not digits_before:
+        i = starts.pop()
+        def header2ID_inferred_start(line):
+            return line[:i] + line[i + 1:]
+        candidates.append(header2ID_inferred_start)
+    if len(ends) == 1 and min(ends) > 0 and not digits_after:
+        j = -ends.pop()
+        def header2ID_inferred_end(line):
+            return line[:j - 1] + line[j:]
+        candidates.append(header2ID_inferred_end)
+    if len(seps) == 1 and min(seps):
+        sep = seps.pop()
+        def header2ID_inferred_sep(line):
+            i = line.rfind(sep) + len(sep)
+            return line[:i] + line[i + 1:]
+        candidates.append(header2ID_inferred_sep)
+
+    # the slicing functions must give the same IDs as splitting the header lines
+    headers = headers1 + headers2
+    IDs = [header2ID_inferred_re(h) for h in headers]
+    for f in candidates:
+        if [f(h) for h in headers] == IDs:
+            return f
+    return header2ID_inferred_re
 
 #-------------------------------------------------
 
-def intersect_fastq(fq1, fq2, header2ID=header2ID_illumina, output_dir=None, prefix=None, force_overwrite=False, gz=False, multi_processing=False):
+def write_records(fobj, records, N_size=10000):
+    """ To write records (str) to fobj, N_size records each time, return number of records written
+
+    fobj: file object, or None to only count the records
+    """
+
+    if fobj is None:
+        return sum(1 for record in records)
+    records, n = iter(records), 0
+    while True:
+        chunk = list(islice(records, N_size))
+        if not chunk:
+            return n
+        fobj.write("".join(chunk))
+        n += len(chunk)
+
+def join_sqlite(fq1_iter, fq2_iter, header2ID, fq1_comm, fq2_comm, N_size=500000, fq1_orphan=None, fq2_orphan=None):
+    """ To find records common in fq1_iter and fq2_iter with an in-memory sqlite3 database, and write them to fq1_comm and fq2_comm
+
+    fq1_iter, fq2_iter: fastq record iterators, as generated by fastq_iter()
+    header2ID: function to extract read unique ID from header line
+    fq1_comm, fq2_comm: file objects to write common records
+    N_size: number of records read each time
+    fq1_orphan, fq2_orphan: not supported, as unmatched records are deleted from the database along with the pairs
+
+    return number of common records, and numbers of records without mates in fq1 and fq2
+
+    Note: every time a batch is read, all records left in the database will be joined again.
+    """
+
+    if fq1_orphan is not None or fq2_orphan is not None:
+        raise Exception("orphans are not supported by sqlite engine, please use other engines.")
+
+    # prepare sqlite3
+    with sqlite3.connect(":memory:") as c:
+        c.execute("PRAGMA  synchronous = OFF;")
+        c.execute("PRAGMA  page_size = 4096;")
+        c.execute("PRAGMA  cache_size = 1000000;")
+        c.execute("PRAGMA  read_uncommitted=1;")
+        c.execute("PRAGMA  locking_mode = EXCLUSIVE;")
+        c.execute("PRAGMA  journal_mode = OFF;")
+
+        c.executescript("""create table if not exists fq1 (id TEXT PRIMARY KEY, fq TEXT);
+                           create table if not exists fq2 (id TEXT PRIMARY KEY, fq TEXT); """)
+
+        N1 = N2 = NC = 0
+        while True:
+
+            stderr_write("[%s] start to read\n" % (date()))
+            fq1_data = [(header2ID(record[0]), "".join(record)) for record in islice(fq1_iter, N_size)]
+            fq2_data = [(header2ID(record[0]), "".join(record)) for record in islice(fq2_iter, N_size)]
+            stderr_write("[%s] end to read\n" % (date()))
+
+            if (not fq1_data) and (not fq2_data):
+                stderr_write("[%s] done\n" % date())
+                NC = int(round(NC * 1e6))
+                return NC, int(round(N1 * 1e6)) - NC, int(round(N2 * 1e6)) - NC
+            if fq1_data:
+                N1 += len(fq1_data)/1e6
+                stderr_write("[%s] have read %.2f M records for fq1\n" % (date(), N1))
+                c.executemany("insert into fq1(id, fq) values (?, ?)", fq1_data)
+            if fq2_data:
+                N2 += len(fq2_data)/1e6
+                stderr_write("[%s] have read %.2f M records for fq2\n" % (date(), N2))
+                c.executemany("insert into fq2(id, fq) values (?, ?)", fq2_data)
+
+            comm_data = c.execute("""select fq1.rowid, fq2.rowid, fq1.fq, fq2.fq from fq1, fq2 where fq1.id == fq2.id;""").fetchall()
+            if comm_data:
+                stderr_write("[%s] %.2fM + %d records to output... \n" % (date(), NC, len(comm_data)))
+                NC += len(comm_data)/1e6
+                rowids_1, rowids_2, comm_1, comm_2 = izip(*comm_data)
+
+                stderr_write("[%s] start to write\n" % (date()))
+                fq1_comm.write("".join(comm_1)) # fq1
+                fq2_comm.write("".join(comm_2)) # fq2
+                stderr_write("[%s] end to write\n" % (date()))
+
+                c.executescript("""delete from fq1 where rowid <= %d;
+                                   delete from fq2 where rowid <= %d;""" % (rowids_1[-1], rowids_2[-1]))
+                stderr_write("[%s] end to delete\n" % (date()))
+
+def join_hash(fq1_iter, fq2_iter, header2ID, fq1_comm, fq2_comm, N_size=500000, pending1=None, pending2=None, fq1_orphan=None, fq2_orphan=None):
+    """ To find records common in fq1_iter and fq2_iter with two dicts of unmatched records, and write them to fq1_comm and fq2_comm
+
+    fq1_iter, fq2_iter: fastq record iterators, as generated by fastq_iter()
+    header2ID: function to extract read unique ID from header line
+    fq1_comm, fq2_comm: file objects to write common records
+    N_size: number of records read each time
+    pending1, pending2: dicts of unmatched records (ID --> record) to start with
+    fq1_orphan, fq2_orphan: file objects to write records without mates, which are the records left in pending1 and
+                            pending2 at the end, or None not to write them
+
+    return number of common records, and numbers of records without mates in fq1 and fq2
+
+    Note: only records whose mates have not been seen yet are kept in memory (pending1 and pending2),
+          and a pair is moved to the output buffer as soon as the second read of it arrives,
+          so every record is looked up only once.
+    """
+
+    # ID --> record, for records whose mate hasn't been read
+    pending1 = {} if pending1 is None else dict(pending1)
+    pending2 = {} if pending2 is None else dict(pending2)
+    N1 = N2 = NC = 0
+    while True:
+
+        stderr_write("[%s] start to read\n" % (date()))
+        fq1_data = list(islice(fq1_iter, N_size))
+        fq2_data = list(islice(fq2_iter, N_size))
+        stderr_write("[%s] end to read\n" % (date()))
+
+        if (not fq1_data) and (not fq2_data):
+            stderr_write("[%s] done, %d + %d records left unmatched\n" % (date(), len(pending1), len(pending2)))
+            return int(round(NC * 1e6)), write_records(fq1_orphan, pending1.itervalues()), write_records(fq2_orphan, pending2.itervalues())
+
+        comm_1, comm_2 = [], []
+        for record in fq1_data:
+            ID = header2ID(record[0])
+            mate = pending2.pop(ID, None)
+            if mate is None:
+                pending1[ID] = "".join(record)
+            else:
+                comm_1.append("".join(record))
+                comm_2.append(mate)
+        for record in fq2_data:
+            ID = header2ID(record[0])
+            mate = pending1.pop(ID, None)
+            if mate is None:
+                pending2[ID] = "".join(record)
+            else:
+                comm_1.append(mate)
+                comm_2.append("".join(record))
+
+        N1 += len(fq1_data)/1e6
+        N2 += len(fq2_data)/1e6
+        stderr_write("[%s] have read %.2f M records for fq1 and %.2f M records for fq2, %d + %d records unmatched\n" % (date(), N1, N2, len(pending1), len(pending2)))
+
+        if comm_1:
+            stderr_write("[%s] %.2fM + %d records to output... \n" % (date(), NC, len(comm_1)))
+            NC += len(comm_1)/1e6
+            fq1_comm.write("".join(comm_1)) # fq1
+            fq2_comm.write("".join(comm_2)) # fq2
+            stderr_write("[%s] end to write\n" % (date()))
+
+def join_merge(fq1_iter, fq2_iter, header2ID, fq1_comm, fq2_comm, N_size=500000, window=100000, fq1_orphan=None, fq2_orphan=None, tmp_dir=None):
+    """ To find records common in fq1_iter and fq2_iter, assuming reads in both files are in the same order, and write them to fq1_comm and fq2_comm
+
+    fq1_iter, fq2_iter: fastq record iterators, as generated by fastq_iter()
+    header2ID: function to extract read unique ID from header line
+    fq1_comm, fq2_comm: file objects to write common records
+    N_size: number of records read each time
+    window: max number of unmatched records to keep for each file
+    fq1_orphan, fq2_orphan: file objects to write records without mates, or None not to write them
+    tmp_dir: directory of the temporary files to spill dropped records, default is the system temp directory
+
+    return number of common records, and numbers of records without mates in fq1 and fq2
+
+    Both files are walked in lockstep. If fq1 and fq2 are both filtered from the same pair of files and the order of
+    reads is kept, once a pair is found, all unmatched records read before it will never find their mates, so they
+    are dropped, and only the records between two pairs are kept in memory.
+
+    The last `window` dropped records are kept in memory, and if a read's mate turns out to have been dropped (the
+    order is not the same), or more than `window` records are waiting for their mates, will fall back to join_hash()
+    for the rest. Records pushed out of the last `window` dropped records are spilled to temporary files, and joined
+    again by join_hash() at the end, so a mate arriving more than `window` records late is still paired (the pair is
+    written after all other pairs); only records left unmatched then are orphans.
+    """
+
+    pending1, pending2 = OrderedDict(), OrderedDict()   # ID --> record, for records whose mate hasn't been read
+    dropped1, dropped2 = OrderedDict(), OrderedDict()   # ID --> record, for the last `window` records dropped
+    orphans1, orphans2 = [], []                         # records pushed out of dropped1 and dropped2 in this batch
+    spill1, spill2 = TemporaryFile(dir=tmp_dir), TemporaryFile(dir=tmp_dir)   # all records pushed out
+
+    def match(ID, pending, pending_mate, dropped, dropped_mate, orphans, orphans_mate):
+        """ return the record of mate of ID if it is in pending_mate, and drop all records before it;
+        return None if the mate has not been read;
+        raise KeyError if the mate has been dropped or too many records are pending
+        """
+
+        if ID in pending_mate:
+            for k, v in pending.iteritems():
+                dropped[k] = v
+            pending.clear()
+            while True:
+                k, v = pending_mate.popitem(last=False)
+                if k == ID:
+                    break
+                dropped_mate[k] = v
+            while len(dropped) > window:
+                orphans.append(dropped.popitem(last=False)[1])
+            while len(dropped_mate) > window:
+                orphans_mate.append(dropped_mate.popitem(last=False)[1])
+            return v
+        elif ID in dropped_mate or len(pending) >= window:
+            raise KeyError(ID)
+        return None
+
+    def join_spilled(fq1_rest, fq2_rest):
+        """ To join spilled records, records left in memory and the rest of fq1 and fq2 with join_hash() """
+
+        for spill, dropped, pending in ((spill1, dropped1, pending1), (spill2, dropped2, pending2)):
+            write_records(spill, chain(dropped.itervalues(), pending.itervalues()))
+            spill.seek(0)
+        try:
+            return join_hash(chain(fastq_iter(spill1), fq1_rest), chain(fastq_iter(spill2), fq2_rest), header2ID, fq1_comm, fq2_comm,
+                             N_size=N_size, fq1_orphan=fq1_orphan, fq2_orphan=fq2_orphan)
+        finally:
+            spill1.close()
+            spill2.close()
+
+    N1 = N2 = NC = 0
+    while True:
+
+        stderr_write("[%s] start to read\n" % (date()))
+        fq1_data = list(islice(fq1_iter, N_size))
+        fq2_data = list(islice(fq2_iter, N_size))
+        stderr_write("[%s] end to read\n" % (date()))
+
+        if (not fq1_data) and (not fq2_data):
+            stderr_write("[%s] done, %d + %d records left unmatched, will join them again with spilled records\n" % (date(), len(pending1), len(pending2)))
+            nc, o1, o2 = join_spilled(iter([]), iter([]))
+            return int(round(NC * 1e6)) + nc, o1, o2
+
+        comm_1, comm_2 = [], []
+        n1 = n2 = 0     # number of records processed in fq1_data and fq2_data
+        try:
+            for record1, record2 in izip_longest(fq1_data, fq2_data):
+                if record1 is not None:
+                    ID = header2ID(record1[0])
+                    mate = match(ID, pending1, pending2, dropped1, dropped2, orphans1, orphans2)
+                    if mate is None:
+                        pending1[ID] = "".join(record1)
+                    else:
+                        comm_1.append("".join(record1))
+                        comm_2.append(mate)
+                    n1 += 1
+                if record2 is not None:
+                    ID = header2ID(record2[0])
+                    mate = match(ID, pending2, pending1, dropped2, dropped1, orphans2, orphans1)
+                    if mate is None:
+                        pending2[ID] = "".join(record2)
+                    else:
+                        comm_1.append(mate)
+                        comm_2.append("".join(record2))
+                    n2 += 1
+        except KeyError:
+            fallback = True
+        else:
+            fallback = False
+
+        N1 += n1/1e6
+        N2 += n2/1e6
+        stderr_write("[%s] have read %.2f M records for fq1 and %.2f M records for fq2, %d + %d records unmatched\n" % (date(), N1, N2, len(pending1), len(pending2)))
+
+        if comm_1:
+            stderr_write("[%s] %.2fM + %d records to output... \n" % (date(), NC, len(comm_1)))
+            NC += len(comm_1)/1e6
+            fq1_comm.write("".join(comm_1)) # fq1
+            fq2_comm.write("".join(comm_2)) # fq2
+            stderr_write("[%s] end to write\n" % (date()))
+        write_records(spill1, orphans1)
+        write_records(spill2, orphans2)
+        del orphans1[:], orphans2[:]
+
+        if fallback:
+            stderr_write("[%s] reads in fq1 and fq2 are not in the same order, will fall back to hash engine.\n" % date())
+            nc, o1, o2 = join_spilled(chain(fq1_data[n1:], fq1_iter), chain(fq2_data[n2:], fq2_iter))
+            return int(round(NC * 1e6)) + nc, o1, o2
+
+def is_sorted_pair(fq1, fq2, header2ID, n=10000):
+    """ To check if reads common in the first n records of fq1 and fq2 are in the same order, so join_merge() could be used.
+
+    fq1, fq2: fastq files of the same pair
+    header2ID: function to extract read unique ID from header line
+    """
+
+    with zopen(fq1, 'r') as fobj1, zopen(fq2, 'r') as fobj2:
+        IDs1 = [header2ID(rec[0]) for rec in islice(fastq_iter(fobj1), n)]
+        IDs2 = [header2ID(rec[0]) for rec in islice(fastq_iter(fobj2), n)]
+
+    comm = frozenset(IDs1).intersection(IDs2)
+    if not comm:
+        return False
+    return [ID for ID in IDs1 if ID in comm] == [ID for ID in IDs2 if ID in comm]
+
+def partition_fastq(fq_iter, header2ID, prefix, n_partitions, level=0):
+    """ To split fastq records into n_partitions bucket files by hash of read IDs, and return names of the bucket files
+
+    fq_iter: fastq record iterator, as generated by fastq_iter()
+    header2ID: function to extract read unique ID from header line
+    prefix: prefix of bucket files, bucket files will be named as prefix.0, prefix.1, ...
+    level: used to change the hash function when a bucket is partitioned again
+
+    Note: both reads of a pair will go to buckets with the same number, as long as the same level and n_partitions are used.
+    """
+
+    fnames = ["%s.%d" % (prefix, i) for i in range(n_partitions)]
+    fobjs = [open(fn, 'w', 1 << 20) for fn in fnames]
+    try:
+        for record in fq_iter:
+            fobjs[hash((level, header2ID(record[0]))) % n_partitions].write("".join(record))
+    finally:
+        for fobj in fobjs:
+            fobj.close()
+    return fnames
+
+def join_bucket(bucket1, bucket2, header2ID, fq1_comm, fq2_comm, n_partitions, memory, level=0, max_level=3, fq1_orphan=None, fq2_orphan=None):
+    """ To find records common in a pair of bucket files written by partition_fastq(), and write them to fq1_comm and fq2_comm
+
+    bucket1, bucket2: bucket files of fq1 and fq2
+    memory: max memory (in bytes) to use, if the smaller bucket is too large to be loaded into memory, both
+            buckets will be partitioned again into n_partitions buckets
+    fq1_orphan, fq2_orphan: file objects to write records without mates, or None not to write them
+
+    return number of common records, and numbers of records without mates in bucket1 and bucket2
+    """
+
+    size1, size2 = path.getsize(bucket1), path.getsize(bucket2)
+    if not (size1 and size2):
+        # all records in a bucket are orphans if the other bucket is empty
+        o1 = write_records(fq1_orphan, imap("".join, fastq_iter(bucket1))) if size1 else 0
+        o2 = write_records(fq2_orphan, imap("".join, fastq_iter(bucket2))) if size2 else 0
+        return 0, o1, o2
+    # python strings and dict take about 3 times of the size of the records in the file
+    if min(size1, size2) * 3 > memory and level < max_level:
+        buckets1 = partition_fastq(fastq_iter(bucket1), header2ID, bucket1, n_partitions, level=level + 1)
+        buckets2 = partition_fastq(fastq_iter(bucket2), header2ID, bucket2, n_partitions, level=level + 1)
+        NC = O1 = O2 = 0
+        for b1, b2 in izip(buckets1, buckets2):
+            nc, o1, o2 = join_bucket(b1, b2, header2ID, fq1_comm, fq2_comm, n_partitions, memory, level=level + 1, max_level=max_level,
+                                     fq1_orphan=fq1_orphan, fq2_orphan=fq2_orphan)
+            NC, O1, O2 = NC + nc, O1 + o1, O2 + o2
+            remove(b1)
+            remove(b2)
+        return NC, O1, O2
+
+    # load the smaller bucket into memory, and stream over the larger one
+    swapped = size1 > size2
+    if swapped:
+        bucket1, bucket2, fq1_comm, fq2_comm, fq1_orphan, fq2_orphan = bucket2, bucket1, fq2_comm, fq1_comm, fq2_orphan, fq1_orphan
+
+    records1 = dict((header2ID(record[0]), "".join(record)) for record in fastq_iter(bucket1))
+    comm_1, comm_2, orphans2 = [], [], []
+    for record in fastq_iter(bucket2):
+        mate = records1.pop(header2ID(record[0]), None)
+        if mate is not None:
+            comm_1.append(mate)
+            comm_2.append("".join(record))
+        else:
+            orphans2.append("".join(record))
+    fq1_comm.write("".join(comm_1))
+    fq2_comm.write("".join(comm_2))
+    o1 = write_records(fq1_orphan, records1.itervalues())
+    o2 = write_records(fq2_orphan, orphans2)
+    return (len(comm_1), o2, o1) if swapped else (len(comm_1), o1, o2)
+
+def join_partition(fq1_iter, fq2_iter, header2ID, fq1_comm, fq2_comm, n_partitions=64, memory=2048, tmp_dir=None, fq1_orphan=None, fq2_orphan=None):
+    """ To find records common in fq1_iter and fq2_iter by partitioning both of them into bucket files on disk, and write them to fq1_comm and fq2_comm
+
+    fq1_iter, fq2_iter: fastq record iterators, as generated by fastq_iter()
+    header2ID: function to extract read unique ID from header line
+    fq1_comm, fq2_comm: file objects to write common records
+    n_partitions: number of bucket files for each of fq1 and fq2
+    memory: max memory (in MB) to use when finding common records in a pair of buckets
+    tmp_dir: directory for the bucket files, default is the system temp directory. A local disk is preferred.
+    fq1_orphan, fq2_orphan: file objects to write records without mates, bucket by bucket, or None not to write them
+
+    return number of common records, and numbers of records without mates in fq1 and fq2
+
+    Note: the peak memory is bounded by the size of one bucket, not the size of all unmatched records,
+          but the order of the output records is different from the input.
+    """
+
+    tmp_dir = mkdtemp(prefix="intersect_fastq.", dir=tmp_dir)
+    try:
+        stderr_write("[%s] start to partition fq1 and fq2 into %d buckets in %s\n" % (date(), n_partitions, tmp_dir))
+        buckets1 = partition_fastq(fq1_iter, header2ID, path.join(tmp_dir, "fq1"), n_partitions)
+        buckets2 = partition_fastq(fq2_iter, header2ID, path.join(tmp_dir, "fq2"), n_partitions)
+        stderr_write("[%s] end to partition\n" % (date()))
+
+        NC = O1 = O2 = 0
+        for i, (b1, b2) in enumerate(izip(buckets1, buckets2)):
+            nc, o1, o2 = join_bucket(b1, b2, header2ID, fq1_comm, fq2_comm, n_partitions, memory * 2 ** 20,
+                                     fq1_orphan=fq1_orphan, fq2_orphan=fq2_orphan)
+            NC, O1, O2 = NC + nc, O1 + o1, O2 + o2
+            remove(b1)
+            remove(b2)
+            stderr_write("[%s] %d/%d buckets done, %.2f M records output\n" % (date(), i + 1, n_partitions, NC/1e6))
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
+    stderr_write("[%s] done\n" % date())
+    return NC, O1, O2
+
+# engines available to intersect_fastq()
+join_engines = {'sqlite': join_sqlite, 'hash': join_hash, 'merge': join_merge, 'partition': join_partition}
+
+def intersect_fastq(fq1, fq2, header2ID=header2ID_illumina, output_dir=None, prefix=None, force_overwrite=False, gz=False, multi_processing=False, engine="auto", n_partitions=64, memory=2048, tmp_dir=None, threads=1, pipeline=True, orphans=False, progress=60, stats_file=None):
     """ To get intersection of a pair of fastq files
 
     fq1, fq2: fastq files of the same pair
     header2ID: function to extract read unique ID from header line
     output_dir: output dir
+    engine: how to find reads common in both files, one of join_engines.keys(), or 'auto' to use 'merge' if reads
+            in both files are in the same order (checked by is_sorted_pair()), and 'hash' otherwise.
+    n_partitions, memory: only used by 'partition' engine, see join_partition()
+    tmp_dir: directory of temporary files used by 'partition' and 'merge' engines
+    threads: number of threads to compress each output file if gz is True, see zopen()
+    multi_processing: deprecated, the same as threads=2
+    pipeline: to read, join and write in different threads at the same time
+    orphans: to write records without mates to prefix_1.orphan.fq and prefix_2.orphan.fq (not supported by 'sqlite' engine)
+    progress: interval (in seconds) to report progress, 0 not to report
+    stats_file: file to save statistics of the run (number of records, throughput and time of every stage, peak RSS) as JSON
+
+    return number of common records, and numbers of records without mates in fq1 and fq2
     """
 
-    N_size = 500000   # number of records read each time
-
     #
     # -------prepare output directories and files------
     dirname_1, basename_1 = path.split(path.abspath(path.expanduser(fq1)))
@@ -357,85 +1132,245 @@ def intersect_fastq(fq1, fq2, header2ID=header2ID_illumina, output_dir=None, pre
     # output files
     fq1_fout = path.join(output_dir, "%s%s%s" % (prefix, num_1, ext_1))
     fq2_fout = path.join(output_dir, "%s%s%s" % (prefix, num_2, ext_2))
+    fq1_orphan_fout = path.join(output_dir, "%s%s.orphan%s" % (prefix, num_1, ext_1))
+    fq2_orphan_fout = path.join(output_dir, "%s%s.orphan%s" % (prefix, num_2, ext_2))
     if gz: # if output should be in .gz format
         fq1_fout += ".gz"          # add .gz to output file name if needed
         fq2_fout += ".gz"          # add .gz to output file name if needed
+        fq1_orphan_fout += ".gz"
+        fq2_orphan_fout += ".gz"
+
+    if engine == "auto":
+        engine = "merge" if is_sorted_pair(fq1, fq2, header2ID) else "hash"
+    if engine not in join_engines:
+        raise Exception("engine %s is not valid.\n\t valid engines: %s" % (engine, sorted(join_engines)))
+    if orphans and engine == "sqlite":
+        raise Exception("orphans are not supported by sqlite engine, please use other engines.")
 
     # check if output already exists
-    if path.exists(fq1_fout) or path.exists(fq2_fout):
+    fouts = [fq1_fout, fq2_fout] + ([fq1_orphan_fout, fq2_orphan_fout] if orphans else [])
+    if any(path.exists(fout) for fout in fouts):
         if not force_overwrite:
-            stderr_write("[%s] %s and/or %s already exists, will exit and not overwrite it.\n" % (date(), fq1_fout, fq2_fout))
+            stderr_write("[%s] %s already exists, will exit and not overwrite it.\n" % (date(), " and/or ".join(fouts)))
             return
         else:
-            stderr_write("[%s] %s and/or %s already exists, but will overwrite it.\n" % (date(), fq1_fout, fq2_fout))
-    stderr_write("[%s] Will output to %s and %s.\n" % (date(), fq1_fout, fq2_fout))
+            stderr_write("[%s] %s already exists, but will overwrite it.\n" % (date(), " and/or ".join(fouts)))
+    stderr_write("[%s] Will output to %s.\n" % (date(), " and ".join(fouts)))
 
-    if gz:
-        fq1_comm = gzip.open(fq1_fout, 'wb')
-        fq2_comm = gzip.open(fq2_fout, 'wb')
-    else:
-        fq1_comm = open(fq1_fout, 'w')
-        fq2_comm = open(fq2_fout, 'w')
+    if multi_processing:
+        threads = max(threads, 2)
+    fq1_comm = zopen(fq1_fout, 'w', threads=threads)    # gzip file will be compressed in other threads or process
+    fq2_comm = zopen(fq2_fout, 'w', threads=threads)
+    fq1_orphan = zopen(fq1_orphan_fout, 'w', threads=threads) if orphans else None
+    fq2_orphan = zopen(fq2_orphan_fout, 'w', threads=threads) if orphans else None
 
     #
     # ----------------do the job------------------------------
+    stderr_write("[%s] Will use %s engine to find the intersection.\n" % (date(), engine))
+
+    join = join_engines[engine]
+    if engine == "partition":
+        join = partial(join, n_partitions=n_partitions, memory=memory, tmp_dir=tmp_dir)
+    elif engine == "merge":
+        join = partial(join, tmp_dir=tmp_dir)
+
+    stats = RunStats("intersect_fastq")
+    stats.values.update(fq1=fq1, fq2=fq2, engine=engine, header2ID=getattr(header2ID, '__name__', str(header2ID)), pipeline=pipeline)
+    read1, read2, join_counter = stats.stage("read fq1"), stats.stage("read fq2"), stats.stage("join")
+    if pipeline:
+        fq1_iter, fq2_iter = pipe_reader(fastq_iter(fq1), read1), pipe_reader(fastq_iter(fq2), read2)
+        fq1_comm, fq2_comm = QueueWriter(fq1_comm, stats.stage("write fq1")), QueueWriter(fq2_comm, stats.stage("write fq2"))
+        if orphans:
+            fq1_orphan = QueueWriter(fq1_orphan, stats.stage("write fq1 orphans"))
+            fq2_orphan = QueueWriter(fq2_orphan, stats.stage("write fq2 orphans"))
+    else:
+        fq1_iter, fq2_iter = count_reader(fastq_iter(fq1), read1), count_reader(fastq_iter(fq2), read2)
+    stats.start_progress(progress)
 
-    # prepare sqlite3
-    with sqlite3.connect(":memory:") as c:
-        c.execute("PRAGMA  synchronous = OFF;")
-        c.execute("PRAGMA  page_size = 4096;")
-        c.execute("PRAGMA  cache_size = 1000000;")
-        c.execute("PRAGMA  read_uncommitted=1;")
-        c.execute("PRAGMA  locking_mode = EXCLUSIVE;")
-        c.execute("PRAGMA  journal_mode = OFF;")
-
-        c.executescript("""create table if not exists fq1 (id TEXT PRIMARY KEY, fq TEXT);
-                           create table if not exists fq2 (id TEXT PRIMARY KEY, fq TEXT); """)
-
-        def p_write(fobj, data):
-            """ write "".join(data) into fobj """
-            fobj.write("".join(data))
-
-        fq1_iter, fq2_iter  = fastq_iter(fq1), fastq_iter(fq2)
-        N1 = N2 = NC = 0
-        while True:
-
-            stderr_write("[%s] start to read\n" % (date()))
-            fq1_data = [(header2ID(record[0]), "".join(record)) for record in islice(fq1_iter, N_size)]
-            fq2_data = [(header2ID(record[0]), "".join(record)) for record in islice(fq2_iter, N_size)]
-            stderr_write("[%s] end to read\n" % (date()))
+    t = time()
+    try:
+        if orphans:
+            NC, O1, O2 = join(fq1_iter, fq2_iter, header2ID, fq1_comm, fq2_comm, fq1_orphan=fq1_orphan, fq2_orphan=fq2_orphan)
+        else:
+            NC, O1, O2 = join(fq1_iter, fq2_iter, header2ID, fq1_comm, fq2_comm)
+
+        for fout in (fq1_comm, fq2_comm, fq1_orphan, fq2_orphan):
+            if fout is not None:
+                fout.close()
+    finally:
+        stats.stop_progress()
+
+    # time spent by join = total time - time waiting for readers and writers (with the pipeline),
+    # or total time - time spent by readers (without the pipeline, time spent by writers is included)
+    if pipeline:
+        join_counter.busy = time() - t - sum(counter.wait for counter in stats.stages if counter is not join_counter)
+    else:
+        join_counter.busy = time() - t - read1.busy - read2.busy
+    join_counter.records = read1.records + read2.records
+    join_counter.bytes = read1.bytes + read2.bytes
+    stats.report()
+
+    stderr_write("[%s] %d pairs, %d + %d records without mates in fq1 and fq2%s.\n" % (date(), NC, O1, O2,
+                 " (written to %s and %s)" % (fq1_orphan_fout, fq2_orphan_fout) if orphans else ""))
+    stats.values.update(pairs=NC, orphans1=O1, orphans2=O2, outputs=fouts)
+    if stats_file:
+        stats.save(stats_file)
+    return NC, O1, O2
 
-            if (not fq1_data) and (not fq2_data):
-                stderr_write("[%s] done\n" % date())
-                break
-            if fq1_data:
-                N1 += len(fq1_data)/1e6
-                stderr_write("[%s] have read %.2f M records for fq1\n" % (date(), N1))
-                c.executemany("insert into fq1(id, fq) values (?, ?)", fq1_data)
-            if fq2_data:
-                N2 += len(fq2_data)/1e6
-                stderr_write("[%s] have read %.2f M records for fq2\n" % (date(), N2))
-                c.executemany("insert into fq2(id, fq) values (?, ?)", fq2_data)
+#-------------------------------------------------
+def test_pack_ID():
+
+    for fields in [(0, 0, 0, 0, 0), (1, 1101, 2436, 2161, 0), (15, 65535, 262143, 262143, 127), (8, 2104, 15343, 197393, 3)]:
+        lane, tile, x, y, flowcell = fields
+        ID = pack_ID(lane, tile, x, y, flowcell)
+        assert 0 <= ID < 2 ** 63
+        assert unpack_ID(ID) == (flowcell, lane, tile, x, y)
+
+    # fields too large to be packed
+    assert pack_ID(16, 1, 1, 1) is None
+    assert pack_ID(1, 65536, 1, 1) is None
+    assert pack_ID(1, 1, 262144, 1) is None
+    assert pack_ID(1, 1, 1, 262144) is None
+    assert pack_ID(1, 1, 1, 1, 128) is None
+
+    # the text ID is kept if it couldn't be packed
+    assert unpack_ID(pack_illumina_ID("6:1101:2436:2161")) == (0, 6, 1101, 2436, 2161)
+    assert pack_illumina_ID("6:1101:262144:2161") == "6:1101:262144:2161"
+
+    # flowcells are indexed in the order they are seen, in the table given
+    table = {}
+    ID1 = pack_casava_ID("4:C4LU6ACXX:8:1101:1249:2231", table)
+    ID2 = pack_casava_ID("5:D2XXXACXX:8:1101:1249:2231", table)
+    assert table == {"4:C4LU6ACXX": 0, "5:D2XXXACXX": 1}
+    assert unpack_ID(ID1) == (0, 8, 1101, 1249, 2231) and unpack_ID(ID2) == (1, 8, 1101, 1249, 2231)
+    assert pack_casava_ID("4:C4LU6ACXX:8:1101:1249:2231", table) == ID1
+    assert pack_casava_ID("4:C4LU6ACXX:8:1101:1249:262144", table) == "4:C4LU6ACXX:8:1101:1249:262144"
+
+    # packed and unpacked header2ID_* give the same pairs
+    line1 = "@HISEQ02:4:C4LU6ACXX:8:1101:1249:2231 1:N:0:ATCACG\n"
+    line2 = "@HISEQ02:4:C4LU6ACXX:8:1101:1249:2231 2:N:0:ATCACG\n"
+    for header2ID in (header2ID_illumina_new, header2ID_AROS):
+        packed = packed_header2ID(header2ID)
+        assert packed(line1) == packed(line2) == packed.pack(header2ID(line1), flowcells)
+    assert packed_header2ID(header2ID_illumina_old) is header2ID_illumina_old
+
+def test_matched_header2IDs():
+
+    names = lambda fs: [f.__name__ for f in fs]
+
+    # Casava 1.8: illumina_new is more specific than AROS, illumina_old doesn't match
+    h1 = ['@HISEQ02:4:C4LU6ACXX:8:1101:1249:%d 1:N:0:ATCACG\n' % i for i in range(20)]
+    h2 = [h.replace(' 1:', ' 2:') for h in h1]
+    assert names(matched_header2IDs(h1, h2)) == ['header2ID_illumina_new', 'header2ID_AROS']
+    assert names(matched_header2IDs(h2, h1)) == ['header2ID_illumina_new', 'header2ID_AROS']
+    assert names(matched_header2IDs(h1)) == ['header2ID_illumina_new', 'header2ID_AROS']
+
+    # illumina_old also matches, but is dropped
+    h1 = ['@FCD0R5AACXX:6:1101:2436:%d#CGATGTAT/1\n' % i for i in range(20)]
+    h2 = [h.replace('/1\n', '/2\n') for h in h1]
+    assert names(matched_header2IDs(h1, h2)) == ['header2ID_illumina']
+
+    # only illumina_old matches
+    h1 = ['@read%d/1\n' % i for i in range(20)]
+    h2 = [h.replace('/1\n', '/2\n') for h in h1]
+    assert names(matched_header2IDs(h1, h2)) == ['header2ID_illumina_old']
+
+    # reads from the same file with the same ID
+    assert matched_header2IDs(['@read/1\n'] * 2, ['@read/2\n'] * 2) == []
+    assert matched_header2IDs(h1, h1) == []
+
+def test_infer_header2ID():
+
+    # the indicator follows numbers of growing length, so it is not at a fixed offset from the start
+    fmt = '@SRR001666.%d.%d HWI-EAS1_s_7 length=36\n'
+    h1 = [fmt % (spot, 1) for spot in range(9999900, 10000000)]
+    h2 = [fmt % (spot, 2) for spot in range(9999900, 10000000)]
+    header2ID = infer_header2ID(h1, h2)
+    for spot in (9999900, 10000000, 123456789012):
+        assert header2ID(fmt % (spot, 1)) == header2ID(fmt % (spot, 2)) == '@SRR001666.%d. HWI-EAS1_s_7 length=36\n' % spot
+    assert header2ID(fmt % (10000000, 1)) != header2ID(fmt % (10000001, 1))
+
+    # a number follows the indicator, so it is not at a fixed offset from the end
+    fmt = '@read_%d_%d\n'
+    header2ID = infer_header2ID([fmt % (1, i) for i in range(10, 99)], [fmt % (2, i) for i in range(10, 99)])
+    assert header2ID.__name__ != 'header2ID_inferred_end'
+    assert header2ID(fmt % (1, 123456)) == header2ID(fmt % (2, 123456)) == '@read__123456\n'
+
+    # no numbers on the anchored side, slicing at a fixed offset is safe
+    fmt = '@x%d %d\n'
+    header2ID = infer_header2ID([fmt % (i, 1) for i in range(10, 99)], [fmt % (i, 2) for i in range(10, 99)])
+    assert header2ID.__name__ == 'header2ID_inferred_end'
+    assert header2ID(fmt % (123456, 1)) == header2ID(fmt % (123456, 2)) == '@x123456 \n'
+
+    # no "1"/"2" at the same place in both files
+    try:
+        infer_header2ID(['@a%d_1\n' % i for i in range(3)], ['@a%d_1\n' % i for i in range(3)])
+    except Exception:
+        pass
+    else:
+        raise AssertionError("infer_header2ID() should fail without an indicator")
 
-            comm_data = c.execute("""select fq1.rowid, fq2.rowid, fq1.fq, fq2.fq from fq1, fq2 where fq1.id == fq2.id;""").fetchall()
-            if comm_data:
-                stderr_write("[%s] %.2fM + %d records to output... \n" % (date(), NC, len(comm_data)))
-                NC += len(comm_data)/1e6
-                rowids_1, rowids_2, comm_1, comm_2 = izip(*comm_data)
+def make_test_pair(n=300, late=()):
+    """ To make a pair of fastq record lists for tests of the engines, with reads in fq2 in the same order as in fq1,
+    except that reads in `late` are moved 100 reads later, and the pair in every 10 reads after read 100 is swapped
 
-                stderr_write("[%s] start to write\n" % (date()))
-                if not multi_processing:
-                    fq1_comm.write("".join(comm_1)) # fq1
-                    fq2_comm.write("".join(comm_2)) # fq2
-                else:
-                    w_procs = [Process(target=p_write, args=(fobj, data)) for fobj, data in ((fq1_comm, comm_1), (fq2_comm, comm_2))]
-                    for job in w_procs: job.start()
-                    for job in w_procs: job.join()
-                stderr_write("[%s] end to write\n" % (date()))
+    return records of fq1 and fq2, IDs of common reads, and IDs of reads only in fq1 and only in fq2
+    """
 
-                c.executescript("""delete from fq1 where rowid <= %d;
-                                   delete from fq2 where rowid <= %d;""" % (rowids_1[-1], rowids_2[-1]))
-                stderr_write("[%s] end to delete\n" % (date()))
+    record = lambda i, mate: ["@read%d/%d\n" % (i, mate), "ACGT\n", "+\n", "IIII\n"]
+    IDs1 = [i for i in range(n) if i % 10 != 3]     # reads missing in fq1, their mates are orphans of fq2
+    IDs2 = [i for i in range(n) if i % 10 != 7]     # reads missing in fq2, their mates are orphans of fq1
+    for i in late:
+        IDs2.insert(IDs2.index(i) + 100, IDs2.pop(IDs2.index(i)))
+    if not late:
+        for k in range(IDs2.index(101), len(IDs2) - 1, 10):
+            IDs2[k], IDs2[k + 1] = IDs2[k + 1], IDs2[k]
+    name = lambda IDs: set("@read%d" % i for i in IDs)
+    return ([record(i, 1) for i in IDs1], [record(i, 2) for i in IDs2],
+            name(set(IDs1) & set(IDs2)), name(set(IDs1) - set(IDs2)), name(set(IDs2) - set(IDs1)))
+
+def check_test_outputs(out1, out2, orphan1, orphan2, comm, only1, only2):
+    """ To check outputs (str) of an engine with the IDs returned by make_test_pair() """
+
+    IDs = lambda out: [ln[:-3] for ln in out.splitlines(True)[::4]]
+    assert IDs(out1) == [ID.replace("/1", "/2") for ID in IDs(out2)]     # mates are written in the same order
+    assert set(IDs(out1)) == comm and len(IDs(out1)) == len(comm)
+    assert out1.count("ACGT\n+\nIIII\n") == len(comm)
+    assert set(IDs(orphan1)) == only1 and set(IDs(orphan2)) == only2
+
+def test_join_engines():
+
+    from StringIO import StringIO
+
+    for late in ((), (12, 13, 150)):
+        records1, records2, comm, only1, only2 = make_test_pair(late=late)
+        # 'merge' falls back to 'hash' when pairs are swapped, and spills late reads with a window of 4 records
+        for join in (partial(join_hash, N_size=16), partial(join_merge, N_size=16, window=4),
+                     partial(join_partition, n_partitions=4, memory=0)):   # memory=0 to partition the buckets again
+            fouts = [StringIO() for i in range(4)]
+            nc, o1, o2 = join(iter(records1), iter(records2), header2ID_illumina_old, fouts[0], fouts[1],
+                              fq1_orphan=fouts[2], fq2_orphan=fouts[3])
+            assert (nc, o1, o2) == (len(comm), len(only1), len(only2))
+            check_test_outputs(*[fout.getvalue() for fout in fouts] + [comm, only1, only2])
+
+def test_intersect_fastq():
+
+    tmp_dir = mkdtemp(prefix="intersect_fastq.test.")
+    try:
+        records1, records2, comm, only1, only2 = make_test_pair()
+        fq1, fq2 = path.join(tmp_dir, "s_1.fq"), path.join(tmp_dir, "s_2.fq")
+        for fq, records in ((fq1, records1), (fq2, records2)):
+            with open(fq, 'w') as fout:
+                fout.write("".join("".join(record) for record in records))
+        for engine in ("hash", "merge", "partition"):
+            for pipeline in (True, False):
+                result = intersect_fastq(fq1, fq2, header2ID_illumina_old, prefix="out", force_overwrite=True, engine=engine,
+                                         n_partitions=4, memory=0, pipeline=pipeline, orphans=True, progress=0)
+                assert result == (len(comm), len(only1), len(only2))
+                outs = [open(path.join(tmp_dir, f)).read() for f in ("out_1.fq", "out_2.fq", "out_1.orphan.fq", "out_2.orphan.fq")]
+                check_test_outputs(*outs + [comm, only1, only2])
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
 
 #-------------------------------------------------
 # names for all header2ID_* functions
@@ -451,14 +1386,27 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='To get intersection of a pair of fastq files that have been filtered separately.')
     parser.add_argument('-f', '--header_format', default="guess", choices=header_formats, help="header line format of the fastq file, default is 'guess', and it should work for most cases.")
+    parser.add_argument('-k', '--packed_ID', default=False, action="store_true", help="pack lane, tile, x and y of read IDs into integers to save memory, only for 'illumina', 'illumina_new' and 'AROS' header formats. Default is 'False'.")
     parser.add_argument('-o', '--output_dir', default=None, metavar="output_dir", help="directory of the output files")
     parser.add_argument('-p', '--prefix', default=None, metavar="prefix", help="prefix of the output files. If prefix is relative path, it will be joined to output_dir; If prefix is absolute path, output_dir will be ignored.")
     parser.add_argument('-F', '--force_overwrite', default=False, action="store_true", help="force overwrite if output file already exists. Default is 'False'.")
     parser.add_argument('-z', '--gzip', default=True, dest="gz", action="store_true", help="output file in gzip format. Default is 'False'.")
-    parser.add_argument('-m', '--multi_processing', default=False, dest="multi_processing", action="store_true", help="to use multiprocessing to speed up the writing of output files. Default if 'False'. Note: 1) if you submit job with PBS, you may need to assign ncpus=3 for every job; 2) multi_processing could only help if the output is in .gzip format.")
+    parser.add_argument('-m', '--multi_processing', default=False, dest="multi_processing", action="store_true", help="deprecated, the same as '--threads 2'.")
+    parser.add_argument('-t', '--threads', default=1, type=int, metavar="N", help="number of threads to compress each output file, only used if the output is in .gzip format. pigz will be used if it is available. Note: if you submit job with PBS, you may need to assign ncpus=2*N+1 for every job. Default is 1.")
+    parser.add_argument('-e', '--engine', default="auto", choices=['auto'] + sorted(join_engines), help="engine to find the intersection. 'hash' keeps only unmatched records in memory and writes each pair as soon as both reads are read; 'merge' walks both files in lockstep with constant memory, assuming reads in both files are in the same order, and falls back to 'hash' if not; 'partition' splits both files into bucket files on disk and processes them bucket by bucket, for files too large to fit in memory; 'sqlite' is the old engine using an in-memory sqlite3 database; 'auto' will use 'merge' if the first reads of both files are in the same order, and 'hash' otherwise. Default is 'auto'.")
+    parser.add_argument('-n', '--partitions', default=64, type=int, dest="n_partitions", metavar="N", help="number of bucket files for each input used by '--engine partition'. Default is 64.")
+    parser.add_argument('-M', '--memory', default=2048, type=int, metavar="MB", help="max memory (in MB) used to find common records in a pair of buckets by '--engine partition', larger buckets will be partitioned again. Default is 2048.")
+    parser.add_argument('-T', '--tmp_dir', default=None, metavar="tmp_dir", help="directory for the bucket files used by '--engine partition' and records spilled by '--engine merge', a local disk is preferred. Default is the system temp directory.")
+    parser.add_argument('--no_pipeline', default=True, dest="pipeline", action="store_false", help="not to read, join and write in different threads. Default is to use the pipeline.")
+    parser.add_argument('-s', '--assume-sorted', default=False, dest="assume_sorted", action="store_true", help="reads in both files are in the same order, the same as '--engine merge'.")
+    parser.add_argument('-O', '--orphans', default=False, action="store_true", help="also output records without mates to prefix_1.orphan.fq and prefix_2.orphan.fq (with .gz if --gzip), not supported by '--engine sqlite'. Default is 'False'.")
+    parser.add_argument('-P', '--progress', default=60, type=int, metavar="SECONDS", help="interval (in seconds) to report progress, 0 not to report. Default is 60.")
+    parser.add_argument('-S', '--stats', default=None, dest="stats_file", metavar="stats_file", help="save statistics of the run (records, throughput and time of every stage, peak RSS) to stats_file as JSON.")
     parser.add_argument('file_list', nargs=2, metavar="fq_file", help="fastq1 and fastq2 (could be gzip file)")
 
     args = parser.parse_args()
+    if args.assume_sorted:
+        args.engine = "merge"
     if args.header_format == "guess":    # guess the format of header line
         header2ID = guess_header_format(*args.file_list)
     elif args.header_format == "infer":
@@ -467,5 +1415,7 @@ if __name__ == '__main__':
         header2ID = locals()['header2ID_' + args.header_format]
     else:
         raise Exception("Don't recognize '--header_format %s', will now exit." % (args.header_format))
+    if args.packed_ID:
+        header2ID = packed_header2ID(header2ID)
 
-    intersect_fastq(args.file_list[0], args.file_list[1], header2ID=header2ID, output_dir=args.output_dir, prefix=args.prefix, force_overwrite=args.force_overwrite, gz=args.gz, multi_processing=args.multi_processing)
+    intersect_fastq(args.file_list[0], args.file_list[1], header2ID=header2ID, output_dir=args.output_dir, prefix=args.prefix, force_overwrite=args.force_overwrite, gz=args.gz, multi_processing=args.multi_processing, threads=args.threads, engine=args.engine, n_partitions=args.n_partitions, memory=args.memory, tmp_dir=args.tmp_dir, pipeline=args.pipeline, orphans=args.orphans, progress=args.progress, stats_file=args.stats_file)
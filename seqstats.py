@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import sys
+import numpy as np
+from functools import partial
+from fastx import fastq_batches, fasta_batches, make_batch, parallel_reduce
+
+"""
+per-cycle base composition, per-cycle quality distribution, GC content and length distribution of fastq/fasta files,
+computed in one pass over batches of records generated by fastx.fastq_batches()/fasta_batches().
+
+SeqStats of different chunks of a file (or different files) could be merged by .merge() or "+", so they could be
+computed by different workers and merged at the end.
+
+usage: seqstats.py [-h] [-a] [-n N] [-o OUTPUT] [-p N] input
+
+Note: this replaces Fastq.alphabet_percycle and Fasta.alphabet_percycle which were commented out in fastx.py.
+
+created: 2026.10.18
+last modified: 2026.10.18 - codes of bases and quality scores are uint8, bincount() is done over blocks of rows with
+                            int32 indices, so the temporaries are not 8 times the size of a batch
+"""
+
+#-----------------------------------------------------------------------------
+BASES = "ACGTN"
+N_QUALS = 94        # phred scores 0 - 93
+BLOCK_CELLS = 1 << 22   # cells of a batch counted by one np.bincount(), which copies its input to an int64 array
+
+# code of every byte: A/C/G/T --> 0/1/2/3 (either case), 0 (padding) --> 5, all others are counted as N --> 4
+base_codes = np.full(256, 4, dtype=np.uint8)
+for i, b in enumerate("ACGT"):
+    base_codes[ord(b)] = base_codes[ord(b.lower())] = i
+base_codes[0] = 5
+
+def qual_codes(phred_offset):
+    """ To get the code of every byte of quality strings: phred score clipped to 0 - 93, 0 (padding) --> 94 """
+
+    codes = np.clip(np.arange(256) - phred_offset, 0, N_QUALS - 1).astype(np.uint8)
+    codes[0] = N_QUALS
+    return codes
+
+def count_percycle(codes, n_codes):
+    """ To count codes (a 2D uint8 array, a row per read) at every cycle, return an array of shape (n_codes, cycles) """
+
+    n, L = codes.shape
+    dtype = np.int32 if n_codes * L < 1 << 31 else np.int64
+    cycles = np.arange(L, dtype=dtype)
+    counts = np.zeros(n_codes * L, dtype=np.int64)
+    step = max(1, BLOCK_CELLS // max(L, 1))
+    for i in range(0, n, step):
+        index = codes[i:i + step].astype(dtype) * dtype(L) + cycles
+        counts += np.bincount(index.ravel(), minlength=n_codes * L)
+    return counts.reshape(n_codes, L)
+
+def grow(a, n):
+    """ To pad 2D array a with rows of 0 to have at least n rows, or 1D array to have at least n items """
+
+    if len(a) >= n:
+        return a
+    b = np.zeros((n,) + a.shape[1:], dtype=a.dtype)
+    b[:len(a)] = a
+    return b
+
+class SeqStats(object):
+    """ statistics of fastq/fasta records
+
+    n_reads:      number of reads
+    base_counts:  counts of A/C/G/T/N at every cycle, shape (cycles, 5)
+    qual_counts:  counts of phred scores 0-93 at every cycle, shape (cycles, 94)
+    gc_hist:      number of reads with GC content of 0%, 1%, ..., 100%
+    length_hist:  number of reads with length 0, 1, 2, ...
+    """
+
+    def __init__(self, phred_offset=33):
+        self.phred_offset = phred_offset
+        self.qual_codes = qual_codes(phred_offset)
+        self.n_reads = 0
+        self.base_counts = np.zeros((0, len(BASES)), dtype=np.int64)
+        self.qual_counts = np.zeros((0, N_QUALS), dtype=np.int64)
+        self.gc_hist = np.zeros(101, dtype=np.int64)
+        self.length_hist = np.zeros(0, dtype=np.int64)
+
+    def update(self, batch):
+        """ To add records in batch (a fastx.RecordBatch) to the statistics """
+
+        n, L = batch.seqs.shape
+        if not n:
+            return self
+        self.n_reads += n
+
+        # counts of every base at every cycle, padding (code 5) is dropped
+        codes = base_codes[batch.seqs]
+        counts = count_percycle(codes, 6)
+        self.base_counts = grow(self.base_counts, L)
+        self.base_counts[:L] += counts[:len(BASES)].T
+
+        # counts of every quality score at every cycle, padding (code N_QUALS) is dropped
+        if batch.quals is not None:
+            counts = count_percycle(self.qual_codes[batch.quals], N_QUALS + 1)
+            self.qual_counts = grow(self.qual_counts, L)
+            self.qual_counts[:L] += counts[:N_QUALS].T
+
+        # GC content (in percent) of every read
+        gc = ((codes == 1) | (codes == 2)).sum(axis=1)
+        lengths = batch.lengths
+        gc_percent = np.round(100.0 * gc[lengths > 0] / lengths[lengths > 0]).astype(np.int64)
+        self.gc_hist += np.bincount(gc_percent, minlength=101)
+
+        counts = np.bincount(lengths)
+        self.length_hist = grow(self.length_hist, len(counts))
+        self.length_hist[:len(counts)] += counts
+
+        return self
+
+    def merge(self, other):
+        """ To add statistics in other (a SeqStats) to self """
+
+        if other.phred_offset != self.phred_offset:
+            raise Exception("Couldn't merge SeqStats with different phred_offset: %d, %d" % (self.phred_offset, other.phred_offset))
+        self.n_reads += other.n_reads
+        for name in ("base_counts", "qual_counts", "length_hist"):
+            a, b = getattr(self, name), getattr(other, name)
+            a = grow(a, len(b))
+            a[:len(b)] += b
+            setattr(self, name, a)
+        self.gc_hist = self.gc_hist + other.gc_hist
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        return SeqStats(self.phred_offset).merge(self).merge(other)
+
+    def base_percent(self):
+        """ percentage of A/C/G/T/N at every cycle """
+
+        total = self.base_counts.sum(axis=1).reshape(-1, 1)
+        return 100.0 * self.base_counts / np.maximum(total, 1)
+
+    def mean_quality(self):
+        """ mean quality score at every cycle """
+
+        total = self.qual_counts.sum(axis=1)
+        return self.qual_counts.dot(np.arange(N_QUALS)) / np.maximum(total, 1).astype(float)
+
+    def quality_quantiles(self, q=(0.1, 0.25, 0.5, 0.75, 0.9)):
+        """ quantiles of quality scores at every cycle, shape (cycles, len(q)) """
+
+        cum = self.qual_counts.cumsum(axis=1)
+        total = np.maximum(cum[:, -1:], 1)
+        return np.array([(cum < total * p).sum(axis=1) for p in q]).T
+
+    def write(self, fobj=sys.stdout):
+        """ To write per-cycle statistics as a tab-delimited table """
+
+        percent = self.base_percent()
+        fobj.write("cycle\t%s\tmean_quality\n" % "\t".join(BASES))
+        if self.qual_counts.shape[0]:
+            means = self.mean_quality()
+        else:
+            means = np.zeros(len(percent))
+        for i, (row, m) in enumerate(zip(percent, means)):
+            fobj.write("%d\t%s\t%.2f\n" % (i + 1, "\t".join("%.2f" % v for v in row), m))
+
+def fastq_stats(f, n=int(1e6), phred_offset=33):
+    """ To get SeqStats of a fastq file, reading n records each time """
+
+    stats = SeqStats(phred_offset)
+    for batch in fastq_batches(f, n):
+        stats.update(batch)
+    return stats
+
+def fasta_stats(f, n=int(1e5)):
+    """ To get SeqStats of a fasta file, reading n records each time """
+
+    stats = SeqStats()
+    for batch in fasta_batches(f, n):
+        stats.update(batch)
+    return stats
+
+def records_stats(records, fasta=False, phred_offset=33):
+    """ To get SeqStats of records generated by fastx.fastq_iter/fasta_iter, used by parallel_stats() """
+
+    block = list(records)
+    stats = SeqStats(phred_offset)
+    if fasta:
+        return stats.update(make_batch([rec[0].rstrip("\n") for rec in block], [rec[1] for rec in block]))
+    return stats.update(make_batch([rec[0].rstrip("\n") for rec in block],
+                                   [rec[1].rstrip("\n") for rec in block],
+                                   [rec[3].rstrip("\n") for rec in block]))
+
+def parallel_stats(f, processes=None, fasta=False, phred_offset=33):
+    """ To get SeqStats of a fastq/fasta file with a pool of processes, see fastx.parallel_map() """
+
+    func = partial(records_stats, fasta=fasta, phred_offset=phred_offset)
+    return parallel_reduce(func, f, SeqStats.merge, SeqStats(phred_offset), processes=processes,
+                           fmt="fasta" if fasta else "fastq", n_records=int(1e5))
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+
+    # so python will exit gracefully when in a pipe
+    from signal import signal, SIGPIPE, SIG_DFL
+    signal(SIGPIPE, SIG_DFL)
+
+    parser = argparse.ArgumentParser(description='To get per-cycle base composition and quality of a fastq/fasta file.')
+    parser.add_argument('-a', '--fasta', default=False, action="store_true", help="input is a fasta file. Default is fastq.")
+    parser.add_argument('-n', default=int(1e6), type=int, metavar="N", help="number of records read each time. Default is 1000000.")
+    parser.add_argument('-o', '--output', default='-', help="output file, default to stdout")
+    parser.add_argument('-p', '--processes', default=1, type=int, metavar="N", help="number of processes. Default is 1.")
+    parser.add_argument('input', help="input fastq/fasta file (could be gzip file)")
+
+    args = parser.parse_args()
+    if args.processes > 1:
+        stats = parallel_stats(args.input, processes=args.processes, fasta=args.fasta)
+    else:
+        stats = fasta_stats(args.input, args.n) if args.fasta else fastq_stats(args.input, args.n)
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w')
+    stats.write(fout)
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+import sys
+import zlib
+import gzip
+import struct
+from threading import Thread
+from signal import signal, SIGPIPE, SIG_DFL
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+
+try:
+    from Queue import Queue, Empty
+    from distutils.spawn import find_executable
+except ImportError:     # python3, so modules importing zopen (e.g. fastx by biomart.py) could be used in python3
+    from queue import Queue, Empty
+    from shutil import which as find_executable
+    basestring = str
+
+"""
+to open plain or gzip files for reading and writing, with decompression and compression run in other threads or processes,
+so the program itself could spend its time on parsing and processing the data.
+
+    zopen(f, 'r')   --> plain file, or gzip file decompressed by an external pigz, or by a background thread (ReadAheadReader)
+    zopen(f, 'w')   --> plain file, or gzip file compressed by an external pigz, or by a pool of threads (BgzfWriter),
+                        or by gzip module if threads == 1
+
+BgzfWriter writes BGZF files (blocked gzip, as used by samtools), which are valid gzip files and could be read by gzip, zcat
+and all other gzip tools.
+BgzfReader reads BGZF files (e.g. BAM files) with blocks decompressed by a pool of threads.
+
+created: 2026.10.18
+"""
+
+#-----------------------------------------------------------------------------
+DEBUG = False
+
+pigz = find_executable("pigz")    # path of pigz, None if it is not available
+
+#-----------------------------------------------------------------------------
+class LineReader(object):
+    """ mixin to provide line iteration, readline() and readlines() for readers with a read_block() method returning "" at EOF """
+
+    def _init_lines(self):
+        self._lines = []        # lines have been read but not returned, in reversed order
+        self._left = ""         # the incomplete last line of the last block
+
+    def _fill(self):
+        """ read blocks until there are complete lines, return False at EOF """
+
+        while not self._lines:
+            block = self.read_block()
+            if not block:
+                if self._left:
+                    self._lines, self._left = [self._left], ""
+                    return True
+                return False
+            lines = (self._left + block).split("\n")
+            self._left = lines.pop()
+            self._lines = [ln + "\n" for ln in reversed(lines)]
+        return True
+
+    def readline(self):
+        if self._lines or self._fill():
+            return self._lines.pop()
+        return ""
+
+    def readlines(self, sizehint=0):
+        """ read complete lines of about sizehint bytes, or all lines if sizehint <= 0 """
+
+        lines, size = [], 0
+        while self._lines or self._fill():
+            while self._lines:
+                ln = self._lines.pop()
+                lines.append(ln)
+                size += len(ln)
+            if 0 < sizehint <= size:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._lines or self._fill():
+            return self._lines.pop()
+        raise StopIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ReadAheadReader(LineReader):
+    """ To read a file object in a background thread, so reading and decompression run along with processing of the data.
+
+    fobj:      a file object with .read(), e.g. generated by gzip.open()
+    blocksize: number of bytes to read each time
+    n_blocks:  max number of blocks read ahead
+    """
+
+    def __init__(self, fobj, blocksize=2 ** 20, n_blocks=16):
+        self.fobj = fobj
+        self.blocksize = blocksize
+        self.queue = Queue(n_blocks)
+        self._closed = False
+        self.thread = Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+        self._eof = False
+        self._init_lines()
+
+    def _read(self):
+        try:
+            while not self._closed:
+                block = self.fobj.read(self.blocksize)
+                self.queue.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.queue.put(e)
+
+    def read_block(self):
+        if self._eof:
+            return ""
+        block = self.queue.get()
+        if isinstance(block, Exception):
+            self._eof = True
+            raise block
+        if not block:
+            self._eof = True
+        return block
+
+    def close(self):
+        """ To stop the reading thread, which may be blocked on a full queue, before closing the file object """
+
+        self._eof = self._closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self.fobj.close()
+
+class PipeReader(LineReader):
+    """ To read a gzip file decompressed by an external program, default is pigz """
+
+    def __init__(self, f, cmd=None, blocksize=2 ** 20):
+        self.f = f
+        self.blocksize = blocksize
+        # SIGPIPE is restored in the child (python ignores it), so the decompressor exits quietly when closed early
+        self.proc = Popen((cmd or [pigz or "gzip", "-dc"]) + [f], stdout=PIPE, bufsize=-1,
+                          preexec_fn=lambda: signal(SIGPIPE, SIG_DFL))
+        self._init_lines()
+
+    def read_block(self):
+        block = self.proc.stdout.read(self.blocksize)
+        if not block and self.proc.wait():
+            raise Exception("Error when decompressing %s, return code: %d" % (self.f, self.proc.returncode))
+        return block
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+
+class PipeWriter(object):
+    """ To write a gzip file compressed by an external program, default is pigz """
+
+    def __init__(self, f, threads=1, level=6, cmd=None):
+        self.f = f
+        self.fout = open(f, 'wb')
+        self.proc = Popen(cmd or [pigz or "gzip", "-c", "-%d" % level] + (["-p", str(threads)] if pigz and not cmd else []),
+                          stdin=PIPE, stdout=self.fout, bufsize=-1)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.fout.close()
+        if self.proc.returncode:
+            raise Exception("Error when compressing %s, return code: %d" % (self.f, self.proc.returncode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#-----------------------------------------------------------------------------
+# BGZF: every block of at most 64 KB is a gzip member, with the size of the compressed block saved in the extra field "BC"
+
+BGZF_BLOCK_SIZE = 0xff00     # the same as samtools, so the compressed block is always smaller than 64 KB
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+def bgzf_block(data, level=6):
+    """ To compress data (no more than BGZF_BLOCK_SIZE bytes) into a BGZF block """
+
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    return ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00" +
+            struct.pack("<H", len(cdata) + 25) + cdata +
+            struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+
+class BgzfWriter(object):
+    """ To write a BGZF file, with blocks compressed by a pool of threads (zlib releases the GIL when compressing).
+
+    f:       file name or a file object opened in 'wb' mode
+    threads: number of threads to compress blocks
+    level:   compression level
+    """
+
+    def __init__(self, f, threads=2, level=6):
+        self.fout = open(f, 'wb') if isinstance(f, basestring) else f
+        self.level = level
+        self.pool = ThreadPool(threads)
+        self.n_blocks = threads * 4       # number of blocks compressed each time
+        self.data, self.size = [], 0
+
+    def _compress(self, data):
+        return bgzf_block(data, self.level)
+
+    def _flush(self, final=False):
+        data = "".join(self.data)
+        n = len(data) if final else len(data) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE
+        blocks = [data[i:i + BGZF_BLOCK_SIZE] for i in range(0, n, BGZF_BLOCK_SIZE)]
+        self.data = [data[n:]] if n < len(data) else []
+        self.size = len(data) - n
+        for cdata in self.pool.imap(self._compress, blocks):
+            self.fout.write(cdata)
+
+    def write(self, data):
+        self.data.append(data)
+        self.size += len(data)
+        if self.size >= BGZF_BLOCK_SIZE * self.n_blocks:
+            self._flush()
+
+    def close(self):
+        if self.fout.closed:
+            return
+        self._flush(final=True)
+        self.fout.write(BGZF_EOF)
+        self.fout.close()
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BgzfReader(LineReader):
+    """ To read a BGZF file, with blocks decompressed by a pool of threads (zlib releases the GIL when decompressing).
+
+    f:       file name or a file object opened in 'rb' mode
+    threads: number of threads to decompress blocks
+
+    Data could be read by .read(size), or by lines, but not both.
+    """
+
+    def __init__(self, f, threads=1):
+        self.f = f
+        self.fobj = open(f, 'rb') if isinstance(f, basestring) else f
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.n_blocks = max(threads, 1) * 4       # number of blocks decompressed each time
+        self.buffer, self.pos = "", 0
+        self._init_lines()
+
+    def _next_block(self):
+        """ To read the next BGZF block, return (compressed data, size of uncompressed data), or None at EOF """
+
+        header = self.fobj.read(18)
+        if not header:
+            return None
+        if len(header) < 18 or header[:4] != "\x1f\x8b\x08\x04":
+            raise Exception("%s is not a BGZF file" % self.f)
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = header[12:] + self.fobj.read(xlen - 6)
+        bsize, i = None, 0
+        while i + 4 <= len(extra):      # find subfield "BC", which is the size of the block - 1
+            slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == "BC":
+                bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise Exception("%s is not a BGZF file" % self.f)
+        data = self.fobj.read(bsize + 1 - 12 - xlen)
+        if len(data) != bsize + 1 - 12 - xlen:
+            raise Exception("%s is truncated" % self.f)
+        return data[:-8], struct.unpack("<I", data[-4:])[0]
+
+    @staticmethod
+    def _decompress(block):
+        cdata, size = block
+        data = zlib.decompress(cdata, -15)
+        if len(data) != size:
+            raise Exception("BGZF block is corrupted")
+        return data
+
+    def read_block(self):
+        """ To read and decompress the next n_blocks blocks, return "" at EOF """
+
+        blocks = []
+        while len(blocks) < self.n_blocks:
+            block = self._next_block()
+            if block is None:
+                break
+            blocks.append(block)
+        if self.pool is not None and len(blocks) > 1:
+            return "".join(self.pool.map(self._decompress, blocks))
+        return "".join(map(self._decompress, blocks))
+
+    def read(self, size=-1):
+        """ To read size bytes, or all data left if size < 0 """
+
+        while size < 0 or len(self.buffer) - self.pos < size:
+            block = self.read_block()
+            if not block:
+                break
+            self.buffer, self.pos = self.buffer[self.pos:] + block, 0
+        end = len(self.buffer) if size < 0 else self.pos + size
+        data, self.pos = self.buffer[self.pos:end], min(end, len(self.buffer))
+        return data
+
+    def close(self):
+        self.fobj.close()
+        if self.pool is not None:
+            self.pool.close()
+
+#-----------------------------------------------------------------------------
+def zopen(f, mode='r', threads=1, method="auto", level=6):
+    """ To open a plain file, or a gzip file if f ends with ".gz".
+
+    f:       file name
+    mode:    'r' or 'w' ('rb' and 'wb' are the same)
+    threads: number of threads to compress gzip files
+    method:  how to decompress/compress gzip files:
+                 'pigz':   by an external pigz process
+                 'thread': decompress with ReadAheadReader, compress with BgzfWriter (or gzip module if threads == 1)
+                 'gzip':   by gzip module in the same thread
+                 'auto':   'pigz' if pigz is available, 'thread' otherwise
+
+    Return a file-like object, which could be iterated over lines, and has .readline(), .readlines(), .write() and .close()
+    """
+
+    mode = mode.rstrip('b')
+    if mode not in ('r', 'w'):
+        raise Exception("mode %s is not valid, should be 'r' or 'w'" % mode)
+    if not f.endswith(".gz"):
+        return open(f, mode)
+
+    if method == "auto":
+        method = "pigz" if pigz else "thread"
+    if DEBUG:
+        sys.stderr.write("zopen %s with %s, mode: %s, threads: %d\n" % (f, method, mode, threads))
+
+    if method == "pigz":
+        return PipeReader(f) if mode == 'r' else PipeWriter(f, threads=threads, level=level)
+    elif method == "thread":
+        if mode == 'r':
+            return ReadAheadReader(gzip.open(f, 'rb'))
+        return BgzfWriter(f, threads=threads, level=level) if threads > 1 else gzip.open(f, 'wb', level)
+    elif method == "gzip":
+        return gzip.open(f, mode + 'b', level) if mode == 'w' else gzip.open(f, 'rb')
+    else:
+        raise Exception("method %s is not valid, should be one of 'auto', 'pigz', 'thread', 'gzip'" % method)